@@ -110,12 +110,47 @@ class EthereumBlockchain:
     def setup_event_callbacks(self,
                               log_handlers,
                               pending_handlers,
+                              batch_log_handlers = {},
+                              end_block_handler = False,
                               ):
+        """
+        - log_handlers:       {event_sig or 'DEFAULT':func(msg, is_noop, is_pending)}, called per log.
+        - batch_log_handlers: optional {event_sig or 'DEFAULT':func(msgs, is_noop, is_pending)}. Handlers here take
+                              precedence over log_handlers for confirmed blocks, and receive each run of consecutive
+                              logs of the block that dispatch to them in one call, so block order is kept.
+        - end_block_handler:  optional func(block_hash, block_number), called once after all logs of each confirmed
+                              block, including blocks with no logs. For per-block work.
+        """
         self.log_handlers = log_handlers
         self.log_handlers_hashed = {((x == 'DEFAULT') and 'DEFAULT' or self.event_sig_to_topic_id(x)):y
                                     for x,y
                                     in log_handlers.items()}
+        self.batch_log_handlers_hashed = {((x == 'DEFAULT') and 'DEFAULT' or self.event_sig_to_topic_id(x)):y
+                                          for x,y
+                                          in batch_log_handlers.items()}
         self.pending_handlers = pending_handlers
+        self.end_block_handler = end_block_handler
+    
+    def _log_handlers_for(self, msg):
+        """ [(topic, func, is_batch), ...] for each handler `msg` dispatches to. """
+        rr = []
+        for topic in msg.get('topics', ['DEFAULT']):
+            func = self.batch_log_handlers_hashed.get(topic, False)
+            if func is not False:
+                rr.append((topic, func, True))
+                continue
+            func = self.log_handlers_hashed.get(topic, False)
+            if func is not False:
+                rr.append((topic, func, False))
+                continue
+            func = self.batch_log_handlers_hashed.get('DEFAULT', False)
+            if func is not False:
+                rr.append((topic, func, True))
+                continue
+            func = self.log_handlers_hashed.get('DEFAULT', False)
+            assert func is not False, ('Unknown topic_id and no DEFAULT handler.', topic)
+            rr.append((topic, func, False))
+        return rr
     
     def logic_callback(self, msg, *args, **kw):
         default_func = self.log_handlers_hashed.get('DEFAULT', False)
@@ -132,6 +167,35 @@ class EthereumBlockchain:
             assert func is not False, ('Unknown topic_id and no DEFAULT handler.', topic, kw)
             func(msg, *args, **kw)
     
+    def logic_batch_callback(self, msgs, *args, **kw):
+        """
+        Dispatch all logs of a confirmed block. Consecutive logs for the same batch handler are passed to it together,
+        all others go to their per-log handler, in block order.
+        """
+        run_func = False
+        run = []
+        
+        for msg in msgs:
+            for topic, func, is_batch in self._log_handlers_for(msg):
+                if run and ((not is_batch) or (func is not run_func)):
+                    print ('PROXY logic_batch_callback()', len(run), '->', run_func)
+                    run_func(run, *args, **kw)
+                    run = []
+                if is_batch:
+                    run_func = func
+                    run.append(msg)
+                else:
+                    print ('PROXY logic_callback()', topic, '->', func)
+                    func(msg, *args, **kw)
+        
+        if run:
+            print ('PROXY logic_batch_callback()', len(run), '->', run_func)
+            run_func(run, *args, **kw)
+    
+    def end_block_callback(self, block_hash, block_number):
+        if self.end_block_handler is not False:
+            self.end_block_handler(block_hash, block_number)
+    
     def simulate_pending(self,
                          args_sig,
                          args,
@@ -161,6 +225,25 @@ class EthereumBlockchain:
             rh[k] = ethereum.utils.parse_int_or_hex(rh[k])
         
         return rh
+
+    def get_block_by_num_callback(self, block_num):
+        """
+        Get block currently at block_num on the canonical chain. Only used for prefetching, the caller checks
+        its hash against the expected one, since the canonical chain may have reorged since.
+        
+        https://github.com/ethereum/wiki/wiki/JSON-RPC#eth_getblockbynumber
+        """
+        print ('bcc.get_block_by_num_callback()', block_num)
+        
+        rh = self.con.eth_getBlockByNumber(block_num)
+        
+        if not rh:
+            return None
+        
+        for k in ['number', 'timestamp']:
+            rh[k] = ethereum.utils.parse_int_or_hex(rh[k])
+        
+        return rh
         
     
     def get_logs_by_block_num_callback(self, block_num):
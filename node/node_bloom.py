@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+"""
+Scalable Bloom filter, for answering "definitely absent" membership queries in O(1), without touching the
+underlying data.
+
+Used by StateManager to skip materializing table states for keys that were never written, see
+`StateManager._lookup_one()`.
+
+A plain Bloom filter needs its capacity up front. Since tables grow without bound, this keeps a list of filter
+slices instead: once the newest slice is full, a new one with twice the capacity and half the false positive rate is
+added, so the overall false positive rate stays below 2 * `error_rate`. Keys can't be removed, which is fine for
+StateManager, since keys are never deleted from confirmed states.
+
+Hashes are derived from python's hash(), so filters are only meaningful within one process, and are never persisted.
+"""
+
+from math import log, ceil
+
+MASK_64 = 0xffffffffffffffff
+
+
+def _mix(key):
+    """ 64-bit hash of `key`, finalized so that nearby hash() values, e.g. of small ints, spread over all bits. """
+    h = hash(key) & MASK_64
+    h = ((h ^ (h >> 33)) * 0xff51afd7ed558ccd) & MASK_64
+    h = ((h ^ (h >> 33)) * 0xc4ceb9fe1a85ec53) & MASK_64
+    return h ^ (h >> 33)
+
+
+class _BloomSlice(object):
+    """
+    Fixed capacity Bloom filter. Bit positions use double hashing: h1 + i * h2.
+    """
+    __slots__ = ('bits', 'num_bits', 'num_hashes', 'capacity', 'count')
+
+    def __init__(self, capacity, error_rate):
+        self.num_bits = max(64, int(ceil(-capacity * log(error_rate) / (log(2) ** 2))))
+        self.num_hashes = max(1, int(round((float(self.num_bits) / capacity) * log(2))))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.capacity = capacity
+        self.count = 0
+
+    def _positions(self, h):
+        h1 = h & 0xffffffff
+        h2 = (h >> 32) | 1
+        for i in xrange(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, h):
+        for x in self._positions(h):
+            self.bits[x >> 3] |= (1 << (x & 7))
+        self.count += 1
+
+    def contains(self, h):
+        for x in self._positions(h):
+            if not (self.bits[x >> 3] & (1 << (x & 7))):
+                return False
+        return True
+
+
+class BloomFilter(object):
+    """
+    Set-like membership sketch: `key in xx` is False only if `key` was never added. Supports add(), `in`, len().
+    """
+    __slots__ = ('slices', 'initial_capacity', 'error_rate', 'count')
+
+    def __init__(self,
+                 initial_capacity = 1024,
+                 error_rate = 0.001,
+                 ):
+        assert 0.0 < error_rate < 1.0, error_rate
+        self.initial_capacity = initial_capacity
+        self.error_rate = error_rate
+        self.slices = []
+        self.count = 0
+
+    def add(self, key):
+        h = _mix(key)
+        for xx in self.slices:
+            if xx.contains(h):
+                return
+        if (not self.slices) or (self.slices[-1].count >= self.slices[-1].capacity):
+            n = len(self.slices)
+            self.slices.append(_BloomSlice(self.initial_capacity << n, self.error_rate / (2 ** (n + 1))))
+        self.slices[-1].add(h)
+        self.count += 1
+
+    def update(self, keys):
+        for key in keys:
+            self.add(key)
+
+    def __contains__(self, key):
+        h = _mix(key)
+        for xx in self.slices:
+            if xx.contains(h):
+                return True
+        return False
+
+    def __len__(self):
+        """ Approximate number of distinct keys added. """
+        return self.count
+
+    def size_bytes(self):
+        return sum(len(xx.bits) for xx in self.slices)
+
+
+def test_bloom_filter():
+    print ('START test_bloom_filter()')
+
+    xx = BloomFilter(initial_capacity = 64, error_rate = 0.01)
+    keys = ['user_%d' % c for c in xrange(2000)] + range(2000) + [('a', c) for c in xrange(100)]
+    xx.update(keys)
+
+    ## Never a false negative, even across slices:
+    assert len(xx.slices) > 1, len(xx.slices)
+    for key in keys:
+        assert key in xx, key
+
+    ## Equal keys hash equally:
+    assert u'user_5' in xx
+
+    ## False positives stay near the target rate:
+    fp = len([c for c in xrange(10000) if ('missing_%d' % c) in xx])
+    assert fp < 10000 * 0.02 * 2, fp
+
+    assert 'x' not in BloomFilter()
+    print ('PASSED')
+
+
+if __name__ == '__main__':
+    test_bloom_filter()
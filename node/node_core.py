@@ -3,6 +3,7 @@
 from node_temporal import TemporalDB, T_ANY_FORK
 from node_mc import MediachainQueue
 from node_blockchain import solidity_string_decode, solidity_string_encode, loads_compact, dumps_compact
+from node_records import PostRecord, address_bin, address_hex, vote_key, split_vote_key
 
 import bitcoin as btc
 import ethereum.utils ## Slow...
@@ -15,6 +16,7 @@ from Crypto.Cipher import AES
 from Crypto.Random import get_random_bytes
 
 from collections import Counter
+from heapq import nlargest
 
 from os import urandom
 from time import time
@@ -210,6 +212,8 @@ class CCCoinCore:
         self.mode = mode
 
         self.genesis_users = genesis_users
+        
+        self.logged_block_hash = False ## Latest confirmed block that had logs, see process_end_block().
 
         
         ## Local state for this web node, that shouldn't be written to the blockchain:
@@ -287,6 +291,7 @@ class CCCoinCore:
         self.latest_rewarded_block_number = -1
         
         self.posts_by_post_id = {}        ## {post_id:post}
+        
         self.post_ids_by_block_num = {}   ## {block_num:[post_id,...]}
         self.votes_lookup = {}            ## {(user_id, item_id): direction}
         
@@ -331,6 +336,7 @@ class CCCoinCore:
                                                        'DEFAULT':self.process_thelog,
                                                        },
                                        pending_handlers = {'DEFAULT':self.simulate_pending_transaction},
+                                       end_block_handler = self.process_end_block,
                                        )
         
         self.sdb = sdb
@@ -358,6 +364,9 @@ class CCCoinCore:
                                              'earned_rewards_per_user',
                                              'earned_rewards_per_post',
                                              ],
+                              ## Feed filtering by user matches either the full or 20 char prefix of creator_address:
+                              indexes = {'posts_by_creator':('posts', lambda post_id, post:address_hex(post.status.creator_address)[:20]),
+                                         },
                               )
         
         
@@ -613,6 +622,7 @@ class CCCoinCore:
                            is_pending = is_pending,
                            cur_hash = msg['blockHash'],
                            nonce = payload_decoded['nonce'],
+                           sender = creator_address,
                            #is_pending_dependent_on_hash = payload_decoded['cur_hash'],
                            #is_pending_timeout = False,
                            #is_pending_replaces_nonce = False,
@@ -683,6 +693,7 @@ class CCCoinCore:
                                            username_norm,
                                            cur_hash = blind_credit_block_hash, #msg['blockHash'],
                                            nonce = payload_decoded['nonce'],
+                                           sender = creator_address,
                                            is_pending = is_pending,
                                            #is_pending_dependent_on_hash = payload_decoded['cur_hash'],
                                            #is_pending_timeout = False,
@@ -734,9 +745,10 @@ class CCCoinCore:
                         
                     self.sdb.store('posts',
                                    post['post_id'],
-                                   post,
+                                   PostRecord.from_json(post),
                                    cur_hash = blind_credit_block_hash, #msg['blockHash'],
                                    nonce = payload_decoded['nonce'],
+                                   sender = creator_address,
                                    is_pending = is_pending,
                                    #is_pending_dependent_on_hash = payload_decoded['cur_hash'],
                                    #is_pending_timeout = False,
@@ -753,20 +765,26 @@ class CCCoinCore:
                         
             elif payload_decoded['item_type'] == 'votes':
                 
+                voter_bin = address_bin(creator_address)
+                
                 for vote in payload_inner['votes']:
                     
+                    voter_item_key = vote_key(creator_address, vote['item_id'])
+                    
                     ## Record {(voter, item_id) -> direction} present lookup:
                     
                     if (int(vote['direction']) in [-1, 1, 0]):
                         
                         with self.sdb.the_lock:
                             
-                            cur_dir = self.sdb.lookup('unblinded_votes',
-                                                      creator_address + '|' + vote['item_id'],
-                                                      default = 0,
-                                                      at_hash = msg['blockHash'],
-                                                      allow_pending = True,
-                                                      )#[0]
+                            cur_dir, cur_score, cur_score_user = self.sdb.lookup_many([('unblinded_votes', voter_item_key),
+                                                                                       ('scores', vote['item_id']),
+                                                                                       ('scores_per_user', creator_address),
+                                                                                       ],
+                                                                                      default = 0,
+                                                                                      at_hash = msg['blockHash'],
+                                                                                      allow_pending = True,
+                                                                                      )
                             
                             if cur_dir == -1:
                                 if vote['direction'] == -1:
@@ -790,41 +808,15 @@ class CCCoinCore:
                                 elif vote['direction'] == 1:
                                     out_dir = 0
                             
-                            cur_score = self.sdb.lookup('scores',
-                                                        vote['item_id'],
-                                                        default = 0,
-                                                        at_hash = msg['blockHash'],
-                                                        allow_pending = True,
-                                                        )#[0]
-                            
-                            self.sdb.store('scores',
-                                           vote['item_id'],
-                                           cur_score + out_dir,
-                                           cur_hash = msg['blockHash'],
-                                           nonce = False,
-                                           is_pending = is_pending,
-                                           #is_pending_dependent_on_hash = payload_decoded['cur_hash'],
-                                           #is_pending_timeout = False,
-                                           #is_pending_replaces_nonce = False,
-                                           )
-                            
-                            cur_score_user = self.sdb.lookup('scores_per_user',
-                                                             creator_address,
-                                                             default = 0,
-                                                             at_hash = msg['blockHash'],
-                                                             allow_pending = True,
-                                                             )#[0]
-                            
-                            self.sdb.store('scores_per_user',
-                                           creator_address,
-                                           cur_score_user + out_dir,
-                                           cur_hash = msg['blockHash'],
-                                           nonce = False,
-                                           is_pending = is_pending,
-                                           #is_pending_dependent_on_hash = payload_decoded['cur_hash'],
-                                           #is_pending_timeout = False,
-                                           #is_pending_replaces_nonce = False,
-                                           )
+                            self.sdb.store_many([('scores', vote['item_id'], cur_score + out_dir, False),
+                                                 ('scores_per_user', creator_address, cur_score_user + out_dir, False),
+                                                 ],
+                                                cur_hash = msg['blockHash'],
+                                                is_pending = is_pending,
+                                                #is_pending_dependent_on_hash = payload_decoded['cur_hash'],
+                                                #is_pending_timeout = False,
+                                                #is_pending_replaces_nonce = False,
+                                                )
                     
                     ## Record {item_id -> voters} historic lookup:
                     
@@ -832,9 +824,10 @@ class CCCoinCore:
                     
                     self.sdb.store('post_voters_' + str(int(vote['direction'])),
                                    vote['item_id'],
-                                   creator_address,
+                                   voter_bin,
                                    cur_hash = msg['blockHash'], #blind_credit_block_hash,
                                    nonce = payload_decoded['nonce'],
+                                   sender = creator_address,
                                    is_pending = is_pending,
                                    as_set_op = True,
                                    #is_pending_dependent_on_hash = payload_decoded['cur_hash'],
@@ -846,9 +839,10 @@ class CCCoinCore:
                         try:
                             self.sdb.store('post_voters_' + str(1),
                                            vote['item_id'],
-                                           creator_address,
+                                           voter_bin,
                                            cur_hash = msg['blockHash'], #blind_credit_block_hash,
                                            nonce = payload_decoded['nonce'],
+                                           sender = creator_address,
                                            is_pending = is_pending,
                                            as_set_op = True,
                                            set_remove = True,
@@ -862,9 +856,10 @@ class CCCoinCore:
                         try:
                             self.sdb.store('post_voters_' + str(-1),
                                            vote['item_id'],
-                                           creator_address,
+                                           voter_bin,
                                            cur_hash = msg['blockHash'], #blind_credit_block_hash,
                                            nonce = payload_decoded['nonce'],
+                                           sender = creator_address,
                                            is_pending = is_pending,
                                            as_set_op = True,
                                            set_remove = True,
@@ -878,9 +873,10 @@ class CCCoinCore:
                         #try:
                         self.sdb.store('post_voters_' + str(-1),
                                        vote['item_id'],
-                                       creator_address,
+                                       voter_bin,
                                        cur_hash = msg['blockHash'], #blind_credit_block_hash,
                                        nonce = payload_decoded['nonce'],
+                                       sender = creator_address,
                                        is_pending = is_pending,
                                        as_set_op = True,
                                        set_remove = True,
@@ -893,9 +889,10 @@ class CCCoinCore:
                         #try:
                         self.sdb.store('post_voters_' + str(1),
                                        vote['item_id'],
-                                       creator_address,
+                                       voter_bin,
                                        cur_hash = msg['blockHash'], #blind_credit_block_hash,
                                        nonce = payload_decoded['nonce'],
+                                       sender = creator_address,
                                        is_pending = is_pending,
                                        as_set_op = True,
                                        set_remove = True,
@@ -909,9 +906,10 @@ class CCCoinCore:
                         try:
                             self.sdb.store('post_voters_' + str(2),
                                            vote['item_id'],
-                                           creator_address,
+                                           voter_bin,
                                            cur_hash = msg['blockHash'], #blind_credit_block_hash,
                                            nonce = payload_decoded['nonce'],
+                                           sender = creator_address,
                                            is_pending = is_pending,
                                            as_set_op = True,
                                            set_remove = True,
@@ -925,9 +923,10 @@ class CCCoinCore:
                         try:
                             self.sdb.store('post_voters_' + str(-2),
                                            vote['item_id'],
-                                           creator_address,
+                                           voter_bin,
                                            cur_hash = msg['blockHash'], #blind_credit_block_hash,
                                            nonce = payload_decoded['nonce'],
+                                           sender = creator_address,
                                            is_pending = is_pending,
                                            as_set_op = True,
                                            set_remove = True,
@@ -941,9 +940,10 @@ class CCCoinCore:
                         try:
                             self.sdb.store('post_voters_' + str(3),
                                            vote['item_id'],
-                                           creator_address,
+                                           voter_bin,
                                            cur_hash = msg['blockHash'], #blind_credit_block_hash,
                                            nonce = payload_decoded['nonce'],
+                                           sender = creator_address,
                                            is_pending = is_pending,
                                            as_set_op = True,
                                            set_remove = True,
@@ -957,9 +957,10 @@ class CCCoinCore:
                         try:
                             self.sdb.store('post_voters_' + str(-3),
                                            vote['item_id'],
-                                           creator_address,
+                                           voter_bin,
                                            cur_hash = msg['blockHash'], #blind_credit_block_hash,
                                            nonce = payload_decoded['nonce'],
+                                           sender = creator_address,
                                            is_pending = is_pending,
                                            as_set_op = True,
                                            set_remove = True,
@@ -978,10 +979,11 @@ class CCCoinCore:
                     if vote['direction'] in [1, -1]:
                         
                         self.sdb.store('unblinded_votes',
-                                       creator_address + '|' + vote['item_id'],
+                                       voter_item_key,
                                        vote['direction'],
                                        cur_hash = msg['blockHash'], #blind_credit_block_hash,
                                        nonce = payload_decoded['nonce'],
+                                       sender = creator_address,
                                        is_pending = is_pending,
                                        #is_pending_dependent_on_hash = payload_decoded['cur_hash'],
                                        #is_pending_timeout = False,
@@ -991,10 +993,11 @@ class CCCoinCore:
                     elif vote['direction'] == 0:
 
                         self.sdb.store('unblinded_votes',
-                                       creator_address + '|' + vote['item_id'],
+                                       voter_item_key,
                                        vote['direction'],
                                        cur_hash = msg['blockHash'], #blind_credit_block_hash,
                                        nonce = payload_decoded['nonce'],
+                                       sender = creator_address,
                                        is_pending = is_pending,
                                        #is_pending_dependent_on_hash = payload_decoded['cur_hash'],
                                        #is_pending_timeout = False,
@@ -1005,10 +1008,11 @@ class CCCoinCore:
                     elif vote['direction'] == 2:
                                                 
                         self.sdb.store('unblinded_flags',
-                                       creator_address + '|' + vote['item_id'],
+                                       voter_item_key,
                                        vote['direction'],
                                        cur_hash = msg['blockHash'], #blind_credit_block_hash,
                                        nonce = payload_decoded['nonce'],
+                                       sender = creator_address,
                                        is_pending = is_pending,
                                        #is_pending_dependent_on_hash = payload_decoded['cur_hash'],
                                        #is_pending_timeout = False,
@@ -1018,10 +1022,11 @@ class CCCoinCore:
                     elif vote['direction'] == -2:
                         
                         self.sdb.store('unblinded_flags',
-                                       creator_address + '|' + vote['item_id'],
+                                       voter_item_key,
                                        vote['direction'],
                                        cur_hash = msg['blockHash'], #blind_credit_block_hash,
                                        nonce = payload_decoded['nonce'],
+                                       sender = creator_address,
                                        is_pending = is_pending,
                                        #is_pending_dependent_on_hash = payload_decoded['cur_hash'],
                                        #is_pending_timeout = False,
@@ -1030,10 +1035,11 @@ class CCCoinCore:
                         
                     elif vote['direction'] == 3:
                         self.sdb.store('unblinded_approvals',
-                                       creator_address + '|' + vote['item_id'],
+                                       voter_item_key,
                                        vote['direction'],
                                        cur_hash = msg['blockHash'], #blind_credit_block_hash,
                                        nonce = payload_decoded['nonce'],
+                                       sender = creator_address,
                                        is_pending = is_pending,
                                        #is_pending_dependent_on_hash = payload_decoded['cur_hash'],
                                        #is_pending_timeout = False,
@@ -1042,10 +1048,11 @@ class CCCoinCore:
                         
                     elif vote['direction'] == -3:                        
                         self.sdb.store('unblinded_approvals',
-                                       creator_address + '|' + vote['item_id'],
+                                       voter_item_key,
                                        vote['direction'],
                                        cur_hash = msg['blockHash'], #blind_credit_block_hash,
                                        nonce = payload_decoded['nonce'],
+                                       sender = creator_address,
                                        is_pending = is_pending,
                                        #is_pending_dependent_on_hash = payload_decoded['cur_hash'],
                                        #is_pending_timeout = False,
@@ -1067,294 +1074,299 @@ class CCCoinCore:
         elif payload_decoded['command'] == 'account_settings':
             pass
         
-        block_number = False
-        
-        ## Compute block rewards, for actions older than MAX_UNBLIND_DELAY, to allow time for unblinding:
+        ## Block rewards are computed once per block with logs, after all of them, see process_end_block().
         
         if not is_pending:
+            self.logged_block_hash = msg['blockHash']
+        
+        if False and (not is_pending):
+            print
+            print '====STATE===='
+            print 'is_pending:', is_pending
+            print 'block_number:', msg['blockNumber']
+            print 'command:', payload_decoded['command']
+            print 'payload_decoded:', payload_decoded
+            #print 'doing_block_num:',doing_block_num
+            #print "the_db['votes']", the_db['votes']
+            #print "the_db['posts']", the_db['posts']
+            #print "the_db['scores']", the_db['scores']
+            #print 'self.blind_lookup', self.blind_lookup
+
             
-            ##
-            #### START REWARDS CALCULATION:
-            ##
+            print 'feed_history:'
+            for c, xx in enumerate(self.feed_history):
+                print '%04d' % c, xx
+
+            raw_input()
+        
+        return #{'item_ids':item_ids}
+    
+    def process_end_block(self,
+                          block_hash,
+                          block_number,
+                          ):
+        """
+        Per-block work, called once after all logs of a confirmed block were processed, including blocks with no logs.
+        
+        - Compute block rewards, for actions older than MAX_UNBLIND_DELAY, to allow time for unblinding. Like when
+          rewards were computed per log, blocks with no logs are skipped.
+        """
+
+        ##
+        #### START REWARDS CALCULATION:
+        ##
+        
+        #assert doing_block_num <= block_number,('TOO SOON, fix MAX_UNBLIND_DELAY', doing_block_num, block_number)
+        
+        #print 'GREATER?', (block_number, self.latest_block_number, doing_block_num)
+        #raw_input()
+        
+        #if (block_number > self.latest_block_number) and (doing_block_num > 0):
+        if self.logged_block_hash == block_hash:
             
-            block_number = msg['blockNumber']
+            #### GOT NEW BLOCK:
             
-            #assert doing_block_num <= block_number,('TOO SOON, fix MAX_UNBLIND_DELAY', doing_block_num, block_number)
+            #self.latest_block_number = max(block_number, self.latest_block_number)
             
-            #print 'GREATER?', (msg['blockNumber'], self.latest_block_number, doing_block_num)
-            #raw_input()
+            ## Mint TOK rewards for the old block, upon each block update:
             
-            #if (msg['blockNumber'] > self.latest_block_number) and (doing_block_num > 0):
-            if True:
-                
-                #### GOT NEW BLOCK:
-                
-                #self.latest_block_number = max(block_number, self.latest_block_number)
-                
-                ## Mint TOK rewards for the old block, upon each block update:
-                
-                """
-                1) divide total lock among all previous voters + posters.
-                2) some votes have less lock if voter voted multiple times this round.
-                """
+            """
+            1) divide total lock among all previous voters + posters.
+            2) some votes have less lock if voter voted multiple times this round.
+            """
+            
+            ## Divide up each voter's lock power, between all votes he made this round:
+            
+            voter_lock_cache = {} ## {voter_id:voter_lock}
+            voter_counts = {}     ## {voter_id:set(item_id,...)}
+            total_lock = 0
+            item_ids = set()
+            
+            for voter_id_item_id, direction in self.sdb.iter_items('unblinded_votes',
+                                                                   at_hash = block_hash,
+                                                                   block_offset = -self.rw['MAX_UNBLIND_DELAY'],
+                                                                   allow_pending = False,
+                                                                   ):
+                voter_id, item_id = split_vote_key(voter_id_item_id)
                 
-                ## Divide up each voter's lock power, between all votes he made this round:
+                if voter_id not in voter_counts:
+                    voter_lock = self.sdb.lookup('min_lock_per_user',
+                                                 voter_id,
+                                                 default = 1.0, #(voter_id in self.genesis_users and 1.0 or 0.0),
+                                                 block_offset = -self.rw['MAX_UNBLIND_DELAY'], 
+                                                 at_hash = block_hash,
+                                                 allow_pending = True,
+                                                 )#[0]
+                    voter_lock_cache[voter_id] = voter_lock
+                    total_lock += voter_lock
                 
-                voter_lock_cache = {} ## {voter_id:voter_lock}
-                voter_counts = {}     ## {voter_id:set(item_id,...)}
-                total_lock = 0
-                item_ids = set()
+                if voter_id not in voter_counts:
+                    voter_counts[voter_id] = set()
+                voter_counts[voter_id].add(item_id)
                 
-                for voter_id_item_id, direction in self.sdb.iterate_items('unblinded_votes',
-                                                                          at_hash = msg['blockHash'],
-                                                                          block_offset = -self.rw['MAX_UNBLIND_DELAY'],
-                                                                          allow_pending = False,
-                                                                          ):
-                    voter_id, item_id = voter_id_item_id.split('|')
-                    
-                    if voter_id not in voter_counts:
-                        voter_lock = self.sdb.lookup('min_lock_per_user',
-                                                     voter_id,
-                                                     default = 1.0, #(voter_id in self.genesis_users and 1.0 or 0.0),
-                                                     block_offset = -self.rw['MAX_UNBLIND_DELAY'], 
-                                                     at_hash = msg['blockHash'],
-                                                     allow_pending = True,
-                                                     )#[0]
-                        voter_lock_cache[voter_id] = voter_lock
-                        total_lock += voter_lock
-                    
-                    if voter_id not in voter_counts:
-                        voter_counts[voter_id] = set()
-                    voter_counts[voter_id].add(item_id)
-                    
-                    item_ids.add(item_id)
+                item_ids.add(item_id)
+            
+            print 'voter_counts:', voter_counts
+            print 'voter_lock_cache:', voter_lock_cache
+            print 'total_lock:', total_lock
+            #print 'PRESS ENTER...'
+            #raw_input()
                 
-                print 'voter_counts:', voter_counts
-                print 'voter_lock_cache:', voter_lock_cache
-                print 'total_lock:', total_lock
-                #print 'PRESS ENTER...'
-                #raw_input()
-                    
-                total_lock_per_item = Counter()
-                lock_per_user = {}
+            total_lock_per_item = Counter()
+            lock_per_user = {}
+            
+            for voter_id_item_id, direction in self.sdb.iter_items('unblinded_votes',
+                                                                   at_hash = block_hash,
+                                                                   block_offset = -self.rw['MAX_UNBLIND_DELAY'],
+                                                                   allow_pending = False,
+                                                                   ):
+                voter_id, item_id = split_vote_key(voter_id_item_id)
                 
-                for voter_id_item_id, direction in self.sdb.iterate_items('unblinded_votes',
-                                                                          at_hash = msg['blockHash'],
-                                                                          block_offset = -self.rw['MAX_UNBLIND_DELAY'],
-                                                                          allow_pending = False,
-                                                                          ):
-                    voter_id, item_id = voter_id_item_id.split('|')
-                    
-                    ## Spread among all posts he voted on:
-                    voter_lock = voter_lock_cache[voter_id] / float(len(voter_counts[voter_id]))
-                    lock_per_user[voter_id] = voter_lock
-                    total_lock_per_item[item_id] += voter_lock
-                    
+                ## Spread among all posts he voted on:
+                voter_lock = voter_lock_cache[voter_id] / float(len(voter_counts[voter_id]))
+                lock_per_user[voter_id] = voter_lock
+                total_lock_per_item[item_id] += voter_lock
                 
-                ## Get list of all old voters, for each post:
+            
+            ## Count all old voters, for each post:
+            
+            num_old_voters = {}
+            
+            item_ids = list(item_ids)
+            
+            item_posts = self.sdb.lookup_many([('posts', item_id) for item_id in item_ids],
+                                              default = False,
+                                              at_hash = block_hash,
+                                              allow_pending = True,
+                                              )
+            
+            for item_id, post in zip(item_ids, item_posts):
                 
-                old_voters = {}
+                ## Only voters still in the set. Voters that since un-voted no longer dilute the rewards of the others,
+                ## unlike when this was len() of the raw set, which also counted removed members:
+                num_old_voters[item_id] = self.sdb.set_cardinality('post_voters_1', ## Upvoters only, for v1.
+                                                                   item_id,
+                                                                   block_offset = -self.rw['MAX_UNBLIND_DELAY'], 
+                                                                   at_hash = block_hash,
+                                                                   allow_pending = True,
+                                                                   )
                 
-                for item_id in item_ids:
-                    old_voters[item_id] = []
-                    
-                    old_voters[item_id] = self.sdb.lookup('post_voters_1',  ## Upvoters only, for v1.
-                                                          item_id,
-                                                          default = {},
-                                                          block_offset = -self.rw['MAX_UNBLIND_DELAY'], 
-                                                          at_hash = msg['blockHash'],
-                                                          allow_pending = True,
-                                                          ).keys()#[0].keys()
-                    old_voters[item_id]
-                    
-                    ## Treat poster as just another voter:
+                ## Treat poster as just another voter:
 
-                    post = False
-                    post = self.sdb.lookup('posts',
-                                           item_id,
-                                           default = False,
-                                           at_hash = msg['blockHash'],
-                                           allow_pending = True,
-                                           )#[0]
-                    if post is False:
-                        ## TODO -
-                        ## We got a vote for a post that's not yet fully confirmed...
-                        ## Later reward the submitter... 
-                        pass
-                    else:
-                        item_poster_id = post['status']['creator_address']
-                        old_voters[item_id].append(item_poster_id)
-                
-                #### Compute curation rewards:
-                
-                all_lock = float(sum(total_lock_per_item.values()))
+                if post is False:
+                    ## TODO -
+                    ## We got a vote for a post that's not yet fully confirmed...
+                    ## Later reward the submitter... 
+                    pass
+                else:
+                    num_old_voters[item_id] += 1
+            
+            #### Compute curation rewards:
+            
+            all_lock = float(sum(total_lock_per_item.values()))
 
-                if all_lock:
+            if all_lock:
 
-                    #### Have some rewards to record:
+                #### Have some rewards to record:
 
-                    new_rewards_curator = Counter()
-                    new_rewards_sponsor = Counter()
+                new_rewards_curator = Counter()
+                new_rewards_sponsor = Counter()
 
-                    for item_id, x_old_voters in old_voters.iteritems():
+                for item_id, x_num_old_voters in num_old_voters.iteritems():
 
-                        if all_lock and len(old_voters[item_id]):
-                            xrw = (total_lock_per_item[item_id] / all_lock) / len(old_voters[item_id])
-                        else:
-                            xrw = 0
+                    if all_lock and x_num_old_voters:
+                        xrw = (total_lock_per_item[item_id] / all_lock) / x_num_old_voters
+                    else:
+                        xrw = 0
 
-                        new_rewards_curator[voter_id] += xrw
+                    new_rewards_curator[voter_id] += xrw
 
-                        ## Sponsor rewards for curation:
+                    ## Sponsor rewards for curation:
 
-                        post = self.sdb.lookup('posts',
-                                               item_id,
-                                               at_hash = msg['blockHash'],
-                                               allow_pending = True,
-                                               )#[0]
-                        if 'sponsor' in post:
-                            new_rewards_curator[post['sponsor']] += xrw
+                    post = self.sdb.lookup('posts',
+                                           item_id,
+                                           at_hash = block_hash,
+                                           allow_pending = True,
+                                           )#[0]
+                    if post.get('sponsor'):
+                        new_rewards_curator[post.get('sponsor')] += xrw
 
 
-                    ## Re-weight rewards to proper totals:
+                ## Re-weight rewards to proper totals:
 
-                    aa = float(sum(new_rewards_curator.values()))
-                    if aa:
-                        conv = self.rw['REWARDS_CURATION'] / aa
-                        new_rewards_curator = [(x,(y * conv)) for x,y in new_rewards_curator.iteritems()]
-                    else:
-                        new_rewards_curator = []
+                aa = float(sum(new_rewards_curator.values()))
+                if aa:
+                    conv = self.rw['REWARDS_CURATION'] / aa
+                    new_rewards_curator = [(x,(y * conv)) for x,y in new_rewards_curator.iteritems()]
+                else:
+                    new_rewards_curator = []
 
-                    bb = float(sum(new_rewards_sponsor.values()))
-                    if bb:
-                        conv = self.rw['REWARDS_SPONSOR'] / bb
-                        new_rewards_sponsor = [(x,(y * conv)) for x,y in new_rewards_sponsor.iteritems()]
-                    else:
-                        new_rewards_sponsor = []
+                bb = float(sum(new_rewards_sponsor.values()))
+                if bb:
+                    conv = self.rw['REWARDS_SPONSOR'] / bb
+                    new_rewards_sponsor = [(x,(y * conv)) for x,y in new_rewards_sponsor.iteritems()]
+                else:
+                    new_rewards_sponsor = []
 
-                    ## Mark as earned:
+                ## Mark as earned:
 
-                    for user_id, reward in (new_rewards_curator + new_rewards_sponsor):
-                        
-                        with self.sdb.the_lock:
-                            self.sdb.store('earned_rewards_per_user',
-                                           user_id,
-                                           reward + self.sdb.lookup('earned_rewards_per_user',
-                                                                    user_id,
-                                                                    default = 0,
-                                                                    at_hash = msg['blockHash'],
-                                                                    #is_pending_dependent_on_hash = payload_decoded['cur_hash'],
-                                                                    #is_pending_timeout = False,
-                                                                    #is_pending_replaces_nonce = False,
-                                                                    ),#[0],
-                                           cur_hash = msg['blockHash'],
-                                           is_pending = True,
-                                           #is_pending_dependent_on_hash = payload_decoded['cur_hash'],
-                                           #is_pending_timeout = False,
-                                           #is_pending_replaces_nonce = False,
-                                           )
+                for user_id, reward in (new_rewards_curator + new_rewards_sponsor):
+                    
+                    with self.sdb.the_lock:
+                        self.sdb.store('earned_rewards_per_user',
+                                       user_id,
+                                       reward + self.sdb.lookup('earned_rewards_per_user',
+                                                                user_id,
+                                                                default = 0,
+                                                                at_hash = block_hash,
+                                                                #is_pending_dependent_on_hash = payload_decoded['cur_hash'],
+                                                                #is_pending_timeout = False,
+                                                                #is_pending_replaces_nonce = False,
+                                                                ),#[0],
+                                       cur_hash = block_hash,
+                                       is_pending = True,
+                                       #is_pending_dependent_on_hash = payload_decoded['cur_hash'],
+                                       #is_pending_timeout = False,
+                                       #is_pending_replaces_nonce = False,
+                                       )
 
-                
-                assert not is_pending
 
-                ##
-                #### Occasionally distribute rewards:
-                ##
+            ##
+            #### Occasionally distribute rewards:
+            ##
+            
+            if (self.mode == 'rewards') and (block_number % self.rw['REWARDS_FREQUENCY']) == (self.rw['REWARDS_FREQUENCY'] - 1):
                 
-                if (self.mode == 'rewards') and (block_number % self.rw['REWARDS_FREQUENCY']) == (self.rw['REWARDS_FREQUENCY'] - 1):
-                    
-                    ## Compute net owed:
-                    
-                    old_rewards_block_num = doing_block_num - (self.rw['REWARDS_FREQUENCY'] * 2)
+                ## Compute net owed:
+                
+                old_rewards_block_num = doing_block_num - (self.rw['REWARDS_FREQUENCY'] * 2)
+                
+                net_earned = 0.0
+                
+                for user_id, earned_lock in self.sdb.iterate_items('earned_rewards_lock',
+                                                                   at_hash = block_hash,
+                                                                   block_offset = -self.rw['MAX_UNBLIND_DELAY'],
+                                                                   allow_pending = False,
+                                                                   ):
                     
-                    net_earned = 0.0
+                    paid_lock = self.sdb.lookup('paid_rewards_lock',
+                                                user_id,
+                                                default = 0.0,
+                                                at_hash = block_hash,
+                                                block_offset = -self.rw['MAX_UNBLIND_DELAY'],
+                                                allow_pending = False,
+                                                )#[0]
                     
-                    for user_id, earned_lock in self.sdb.iterate_items('earned_rewards_lock',
-                                                                       at_hash = msg['blockHash'],
-                                                                       block_offset = -self.rw['MAX_UNBLIND_DELAY'],
-                                                                       allow_pending = False,
-                                                                       ):
-                        
-                        paid_lock = self.sdb.lookup('paid_rewards_lock',
-                                                    user_id,
-                                                    default = 0.0,
-                                                    at_hash = msg['blockHash'],
-                                                    block_offset = -self.rw['MAX_UNBLIND_DELAY'],
-                                                    allow_pending = False,
-                                                    )#[0]
-                        
-                        net_earned += float(max(0.0, earned_lock - paid_lock))
+                    net_earned += float(max(0.0, earned_lock - paid_lock))
+                
+                ## Distribute rewards:
+                
+                rrr = []
+                tot_lock_paying_now = 0.0
+                for reward, user_id in sorted(new_rewards_curator + new_rewards_sponsor, reverse = True):
                     
-                    ## Distribute rewards:
+                    if tot_lock_paying_now / net_earned >= self.rw['REWARDS_CUTOFF']:
+                        break
                     
-                    rrr = []
-                    tot_lock_paying_now = 0.0
-                    for reward, user_id in sorted(new_rewards_curator + new_rewards_sponsor, reverse = True):
-                        
-                        if tot_lock_paying_now / net_earned >= self.rw['REWARDS_CUTOFF']:
-                            break
+                    if reward < self.rw['MIN_REWARD_LOCK']:
+                        break
                         
-                        if reward < self.rw['MIN_REWARD_LOCK']:
-                            break
-                            
-                        tot_lock_paying_now += reward
+                    tot_lock_paying_now += reward
 
-                        rrr.append([reward, user_id])
-                        
-                    for reward_tok, user_id in rrr:
-                        
-                        reward_tok = 0.9 * reward_lock
-                        tot_tok_paying_now = 0.9 * tot_lock_paying_now
-                        
-                        tx = self.bcc.send_transaction('mintTokens(address, uint, uint, uint, uint, uint, uint)',
-                                                      [reward_tok,
-                                                       reward_lock,
-                                                       user_id,
-                                                       tot_tok_paying_now,
-                                                       tot_lock_paying_now,
-                                                       block_number,
-                                                       self.rw['REWARDS_FREQUENCY'],
-                                                       ],
-                                                      gas_limit = self.rw['MAX_GAS_REWARDS'],
-                                                      )
+                    rrr.append([reward, user_id])
                     
+                for reward_tok, user_id in rrr:
                     
-                ## Cleanup:
-                #self.sdb.prune_historical(max_blocks = 50)
+                    reward_tok = 0.9 * reward_lock
+                    tot_tok_paying_now = 0.9 * tot_lock_paying_now
                     
+                    tx = self.bcc.send_transaction('mintTokens(address, uint, uint, uint, uint, uint, uint)',
+                                                  [reward_tok,
+                                                   reward_lock,
+                                                   user_id,
+                                                   tot_tok_paying_now,
+                                                   tot_lock_paying_now,
+                                                   block_number,
+                                                   self.rw['REWARDS_FREQUENCY'],
+                                                   ],
+                                                  gas_limit = self.rw['MAX_GAS_REWARDS'],
+                                                  )
+                
+                
+            ## Cleanup:
+            #self.sdb.prune_historical(max_blocks = 50)
+                
 
-            ### END REWARDS
-            
-            #for xnum in xrange(last_block_rewarded,
-            #                   latest_block_ready,
-            #                   ):
-            #    pass
-
-            #if not self.offline_testing_mode:
-            #    self.prev_block_number = msg['blockNumber']
+        ### END REWARDS
         
-        if False and (not is_pending):
-            print
-            print '====STATE===='
-            print 'is_pending:', is_pending
-            print 'block_number:', block_number
-            print 'command:', payload_decoded['command']
-            print 'payload_decoded:', payload_decoded
-            #print 'doing_block_num:',doing_block_num
-            #print "the_db['votes']", the_db['votes']
-            #print "the_db['posts']", the_db['posts']
-            #print "the_db['scores']", the_db['scores']
-            #print 'self.blind_lookup', self.blind_lookup
+        #for xnum in xrange(last_block_rewarded,
+        #                   latest_block_ready,
+        #                   ):
+        #    pass
 
-            
-            print 'feed_history:'
-            for c, xx in enumerate(self.feed_history):
-                print '%04d' % c, xx
+        #if not self.offline_testing_mode:
+        #    self.prev_block_number = block_number
 
-            raw_input()
-        
-        return #{'item_ids':item_ids}
-        
     def get_current_tok_per_lock(self,
                                  genesis_tm,
                                  current_tm,
@@ -1566,61 +1578,69 @@ class CCCoinCore:
             
         assert sort_by in ['score', 'created_time'], sort_by
         
-        ## Filter:
+        ## Read everything from the same published head view, without locking out block ingestion:
+        
+        view = self.sdb.head_view
+        
+        ## Filter, streaming over the posts table so only the requested page is held in memory:
         
         if filter_users:
-            rr = []
             #for post in self.posts_by_post_id.itervalues():
-            for post_id, post in self.sdb.iterate_items('posts',
-                                                        at_hash = 'latest',
-                                                        ):
-                if (post['status']['creator_address'] in filter_users) or (post['status']['creator_address'][:20] in filter_users):
-                    rr.append(post)
+            rr = {}
+            for user in set(x[:20] for x in filter_users):
+                for post_id, post in view.index_lookup('posts_by_creator', user):
+                    creator_address = address_hex(post.status.creator_address)
+                    if (creator_address in filter_users) or (creator_address[:20] in filter_users):
+                        rr[post_id] = post
+            rr = rr.values()
                 
         elif filter_ids:
             rr = []
             for xx in filter_ids:
                 #rr = self.posts_by_post_id.get(xx, False)
-                post = self.sdb.lookup('posts',
-                                       xx,
-                                       at_hash = 'latest',
-                                       default = False
-                                       )#[0]
+                post = view.lookup('posts',
+                                   xx,
+                                   default = False
+                                   )#[0]
                 if post:
                     rr.append(post)
         
         else:
             #rr = self.posts_by_post_id.values()
-            rr = []
-            for post_id, post in self.sdb.iterate_items('posts',
-                                                        at_hash = 'latest',
-                                                        ):
-                rr.append(post)
+            rr = (post
+                  for post_id, post in view.iter_items('posts')
+                  )
 
                 
         ## Use highest score from any consensus state:
         
         #the_db = self.DBL['all_dbs'].get(via, [])
-        for post in rr:
-            #post['status']['score'] = max(the_db['scores'].get(post['post_id'], 0) + 1, post['status'].get('score', 1))
-            #post['status']['score'] = len(self.tdb.lookup('post_voters_' + str(1),
-            #                                              T_ANY_FORK,
-            #                                              post['post_id'],
-            #                                              default = set(),
-            #                                              as_set_op = True,
-            #                                              )[0])
-            post['status']['score']  = self.sdb.lookup('scores',
-                                                       post['post_id'],
-                                                       at_hash = 'latest',
-                                                       default = 0,
-                                                      )#[0]
-            print ('SCORE', post['status']['score'])
+        def with_scores(rr):
+            for post in rr:
+                #post['status']['score'] = max(the_db['scores'].get(post['post_id'], 0) + 1, post['status'].get('score', 1))
+                #post['status']['score'] = len(self.tdb.lookup('post_voters_' + str(1),
+                #                                              T_ANY_FORK,
+                #                                              post['post_id'],
+                #                                              default = set(),
+                #                                              as_set_op = True,
+                #                                              )[0])
+                score = view.lookup('scores',
+                                    post.post_id,
+                                    default = 0,
+                                    )#[0]
+                print ('SCORE', score)
+                if sort_by == 'score':
+                    yield score, score, post
+                else:
+                    yield post.status.created_time, score, post
         
-        ## Sort:
+        ## Sort, keeping only the top `offset + increment`:
         
-        rr = list(sorted([(x['status'][sort_by],x) for x in rr], reverse=True))
-        rr = rr[offset:offset + increment]
-        rr = [y for x,y in rr]
+        rr = nlargest(offset + increment, with_scores(rr), key = lambda x:x[0])
+        
+        ## Back to JSON, only for the returned page:
+        
+        rr = [post.to_json(score = score) for sort_key, score, post in rr[offset:offset + increment]]
         
         ## Done:
         
@@ -29,6 +29,14 @@ DEPLOY_WITH_TRUFFLE = True
 CONTRACT_ADDRESS_TRUFFLE_FN = '../build/contracts/CCCoinToken.json'
 CONTRACT_ADDRESS_FN = DATA_DIR + 'cccoin_contract_address.txt'
 
+## Periodic state snapshots, so restarts only process blocks newer than the snapshot. Set to False to disable:
+STATE_SNAPSHOT_FN = DATA_DIR + 'state_snapshot_%s.pkl' ## %s = node mode
+STATE_SNAPSHOT_INTERVAL = 1000    ## In blocks.
+STATE_SNAPSHOT_CONFIRM_DEPTH = 12 ## Only snapshot blocks this deep, so they won't get reorged out.
+
+## Number of blocks to prefetch headers & logs for, concurrently, when catching up. 0 to disable:
+STATE_PREFETCH_WINDOW = 16
+
 MAIN_CONTRACT_FN = '../contracts/CCCoinToken.sol'
 
 from node_contract import DEFAULT_RPC_HOST, DEFAULT_RPC_PORT
@@ -49,6 +57,13 @@ CORE_SETTINGS = {'REWARDS_CURATION':49.0,     ## Voting rewards
                  'NEW_USER_LOCK_DONATION':1,  ## Free LOCK given to new users that signup through this node.
                  }
 
+## Blocks this deep are final: older block states get collapsed into one, and orphaned forks freed.
+## Must cover the deepest block_offset lookups, plus the snapshot confirmation depth as reorg margin:
+STATE_FINALITY_DEPTH = CORE_SETTINGS['MAX_UNBLIND_DELAY'] + STATE_SNAPSHOT_CONFIRM_DEPTH
+
+## Pending writes not confirmed within this many blocks are dropped from the pending view:
+STATE_PENDING_TIMEOUT = CORE_SETTINGS['MAX_UNBLIND_DELAY']
+
 ## Number of blocks to wait before advancing to each new state:
 
 DEFAULT_CONFIRM_STATES = {'BLOCKCHAIN_PENDING':0,
@@ -293,6 +308,62 @@ def test_rewards(via_cli = False):
     ## u1 should have a vote reward, u3 should have a post reward:
 
 
+def test_snapshot(via_cli = False):
+    """
+    Posts and votes written by CCCoinCore survive save_snapshot() & load_snapshot() into a new CCCoinCore.
+    """
+    import tempfile, shutil
+    from node_state import MockBlockchain, make_test_blocks
+    from node_records import PostRecord, vote_key, split_vote_key
+    
+    class MockCoreBlockchain(MockBlockchain):
+        def setup_event_callbacks(self, log_handlers, pending_handlers, end_block_handler):
+            ## Mock blocks have no CCCoin logs:
+            self.log_handlers = {'DEFAULT':lambda *args, **kw: None}
+    
+    def make_core():
+        bcc = MockCoreBlockchain(blocks)
+        sdb = StateManager(bcc)
+        return CCCoinCore(sdb = sdb, bcc = bcc, settings_rewards = CORE_SETTINGS)
+    
+    creator = '0x' + '12' * 20
+    voter = '0x' + '34' * 20
+    post = {'post_id':'p1',
+            'image_title':'a',
+            'status':{'confirmed':True,
+                      'created_time':100,
+                      'created_block_num':5,
+                      'created_block_hash':'h5',
+                      'creator_address':creator,
+                      'creator_pub':'04' + 'ab' * 64,
+                      },
+            }
+    
+    dd = tempfile.mkdtemp()
+    fn = join(dd, 'snapshot.pkl')
+    
+    try:
+        blocks = make_test_blocks()
+        cca = make_core()
+        cca.sdb.loop_once()
+        cca.sdb.store('posts', 'p1', PostRecord.from_json(post), cur_hash = 'h5')
+        cca.sdb.store('unblinded_votes', vote_key(voter, 'p1'), 1, cur_hash = 'h5')
+        assert cca.sdb.save_snapshot(fn, confirm_depth = 1, history = 1) == 'h5'
+        
+        ## Resume in a new core, that has never seen these item IDs or public keys:
+        
+        cca = make_core()
+        assert cca.sdb.load_snapshot(fn) == 'h5'
+        cca.sdb.loop_once()
+        
+        assert cca.get_sorted_posts()['items'] == [dict(post, status = dict(post['status'], score = 0))]
+        
+        cca.sdb.store('unblinded_votes', vote_key(voter, 'p2'), -1, cur_hash = 'h6')
+        assert sorted([split_vote_key(x) for x, direction in cca.sdb.iter_items('unblinded_votes')]) == \
+               [(voter, 'p1'), (voter, 'p2')]
+    finally:
+        shutil.rmtree(dd)
+
 
 def test_3(via_cli = False):
     """
@@ -519,7 +590,17 @@ def start_inner(mode,
     
     bcc = EthereumBlockchain(the_address = the_address)
     
-    sdb = StateManager(bcc)
+    snapshot_fn = STATE_SNAPSHOT_FN and (STATE_SNAPSHOT_FN % mode)
+    
+    sdb = StateManager(bcc,
+                       snapshot_fn = snapshot_fn,
+                       snapshot_interval = STATE_SNAPSHOT_INTERVAL,
+                       snapshot_confirm_depth = STATE_SNAPSHOT_CONFIRM_DEPTH,
+                       snapshot_history = CORE_SETTINGS['MAX_UNBLIND_DELAY'],
+                       finality_depth = STATE_FINALITY_DEPTH,
+                       pending_timeout = STATE_PENDING_TIMEOUT,
+                       prefetch_window = STATE_PREFETCH_WINDOW,
+                       )
 
     ## Must be created prior to forking, for the shared in-memory DBs:    
     cccoin = CCCoinCore(sdb = sdb,
@@ -529,6 +610,10 @@ def start_inner(mode,
                         mediachain_api_url = MC_API_URL,
                         )
     
+    ## Resume from last snapshot if there's a valid one, otherwise replays all blocks:
+    if snapshot_fn:
+        sdb.load_snapshot(snapshot_fn)
+    
     sdb.start_background_thread(start_in_foreground = (mode != 'web'),
                                 terminate_on_exception = (mode != 'web'),
                                 )
@@ -576,6 +661,7 @@ functions=['deploy_contract',
            'test_2',
            'test_3',
            'test_rewards',
+           'test_snapshot',
            ]
 
 def main():    
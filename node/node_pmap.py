@@ -0,0 +1,517 @@
+#!/usr/bin/env python
+
+"""
+Persistent (immutable, structurally-shared) hash map.
+
+Used by StateManager as the per-block state container: deriving a child block's state from its parent is O(1),
+and each store() into the child only copies the O(log n) trie nodes on the path to the changed key, sharing
+everything else with the parent.
+
+Implementation is a hash array mapped trie (HAMT), 5 bits of the key hash per level, with collision nodes
+at the bottom for keys whose full hashes are equal.
+
+MemberMap is the PersistentMap variant holding the members of set-valued keys, which also counts present members.
+"""
+
+BITS = 5
+WIDTH = 1 << BITS
+MASK = WIDTH - 1
+HASH_MASK = 0xffffffff
+MAX_SHIFT = 30 ## Last level that still has hash bits left.
+
+def _popcount(x):
+    return bin(x).count('1')
+
+def _hash(key):
+    return hash(key) & HASH_MASK
+
+
+class _BitmapNode(object):
+    """
+    Interior node. `array` holds, in bit order, either (key, value) leaf tuples or child nodes.
+    Never mutated after construction.
+    """
+    __slots__ = ('bitmap', 'array')
+
+    def __init__(self, bitmap, array):
+        self.bitmap = bitmap
+        self.array = array
+
+    def find(self, shift, h, key, default):
+        bit = 1 << ((h >> shift) & MASK)
+        if not (self.bitmap & bit):
+            return default
+        x = self.array[_popcount(self.bitmap & (bit - 1))]
+        if type(x) is tuple:
+            if x[0] == key:
+                return x[1]
+            return default
+        return x.find(shift + BITS, h, key, default)
+
+    def assoc(self, shift, h, key, value):
+        """ Returns (new_node, added_new_key). """
+        bit = 1 << ((h >> shift) & MASK)
+        idx = _popcount(self.bitmap & (bit - 1))
+
+        if not (self.bitmap & bit):
+            array = self.array[:]
+            array.insert(idx, (key, value))
+            return _BitmapNode(self.bitmap | bit, array), True
+
+        x = self.array[idx]
+
+        if type(x) is tuple:
+            if x[0] == key:
+                if x[1] is value:
+                    return self, False
+                array = self.array[:]
+                array[idx] = (key, value)
+                return _BitmapNode(self.bitmap, array), False
+            ## Push both leaves down a level:
+            child = _make_node(shift + BITS, _hash(x[0]), x, h, (key, value))
+            array = self.array[:]
+            array[idx] = child
+            return _BitmapNode(self.bitmap, array), True
+
+        child, added = x.assoc(shift + BITS, h, key, value)
+        if child is x:
+            return self, False
+        array = self.array[:]
+        array[idx] = child
+        return _BitmapNode(self.bitmap, array), added
+
+    def without(self, shift, h, key):
+        """ Returns new node, self if key is missing, or None if the node became empty. """
+        bit = 1 << ((h >> shift) & MASK)
+        if not (self.bitmap & bit):
+            return self
+        idx = _popcount(self.bitmap & (bit - 1))
+        x = self.array[idx]
+
+        if type(x) is tuple:
+            if x[0] != key:
+                return self
+            if self.bitmap == bit:
+                return None
+            array = self.array[:]
+            del array[idx]
+            return _BitmapNode(self.bitmap ^ bit, array)
+
+        child = x.without(shift + BITS, h, key)
+        if child is x:
+            return self
+        array = self.array[:]
+        if child is None:
+            if self.bitmap == bit:
+                return None
+            del array[idx]
+            return _BitmapNode(self.bitmap ^ bit, array)
+        array[idx] = child
+        return _BitmapNode(self.bitmap, array)
+
+    def iteritems(self):
+        for x in self.array:
+            if type(x) is tuple:
+                yield x
+            else:
+                for y in x.iteritems():
+                    yield y
+
+
+class _CollisionNode(object):
+    """
+    Leaf bucket for keys sharing the same full hash.
+    """
+    __slots__ = ('h', 'items')
+
+    def __init__(self, h, items):
+        self.h = h
+        self.items = items
+
+    def find(self, shift, h, key, default):
+        for k, v in self.items:
+            if k == key:
+                return v
+        return default
+
+    def assoc(self, shift, h, key, value):
+        if h != self.h:
+            ## Different full hash, split this bucket off into a new level:
+            return _BitmapNode(1 << ((self.h >> shift) & MASK), [self]).assoc(shift, h, key, value)
+        for c, (k, v) in enumerate(self.items):
+            if k == key:
+                if v is value:
+                    return self, False
+                items = self.items[:]
+                items[c] = (key, value)
+                return _CollisionNode(self.h, items), False
+        return _CollisionNode(self.h, self.items + [(key, value)]), True
+
+    def without(self, shift, h, key):
+        items = [x for x in self.items if x[0] != key]
+        if len(items) == len(self.items):
+            return self
+        if not items:
+            return None
+        return _CollisionNode(self.h, items)
+
+    def iteritems(self):
+        return iter(self.items)
+
+
+def _changed(old_value, value):
+    return (old_value is not value) and (old_value != value)
+
+
+def _iter_changes(node, old_node, shift):
+    """ Leaves of `node` whose key is missing from `old_node`, or has a different value there. """
+    if node is old_node:
+        return
+    
+    if (type(node) is not _BitmapNode) or (type(old_node) is not _BitmapNode):
+        for k, v in node.iteritems():
+            if _changed(old_node.find(shift, _hash(k), k, KeyError), v):
+                yield k, v
+        return
+    
+    idx = 0
+    for b in xrange(WIDTH):
+        bit = 1 << b
+        if not (node.bitmap & bit):
+            continue
+        x = node.array[idx]
+        idx += 1
+        
+        if not (old_node.bitmap & bit):
+            if type(x) is tuple:
+                yield x
+            else:
+                for y in x.iteritems():
+                    yield y
+            continue
+        
+        y = old_node.array[_popcount(old_node.bitmap & (bit - 1))]
+        
+        if x is y:
+            continue
+        
+        if type(x) is tuple:
+            if type(y) is tuple:
+                if y[0] != x[0]:
+                    old_value = KeyError
+                else:
+                    old_value = y[1]
+            else:
+                old_value = y.find(shift + BITS, _hash(x[0]), x[0], KeyError)
+            if _changed(old_value, x[1]):
+                yield x
+        elif type(y) is tuple:
+            for k, v in x.iteritems():
+                if (k != y[0]) or _changed(y[1], v):
+                    yield k, v
+        else:
+            for z in _iter_changes(x, y, shift + BITS):
+                yield z
+
+
+def _make_node(shift, h1, leaf1, h2, leaf2):
+    """ Node holding two leaves that collided at the previous level. """
+    if shift > MAX_SHIFT or h1 == h2:
+        return _CollisionNode(h1, [leaf1, leaf2])
+    b1 = (h1 >> shift) & MASK
+    b2 = (h2 >> shift) & MASK
+    if b1 == b2:
+        return _BitmapNode(1 << b1, [_make_node(shift + BITS, h1, leaf1, h2, leaf2)])
+    if b1 < b2:
+        return _BitmapNode((1 << b1) | (1 << b2), [leaf1, leaf2])
+    return _BitmapNode((1 << b1) | (1 << b2), [leaf2, leaf1])
+
+
+class PersistentMap(object):
+    """
+    Immutable mapping. `set()` and `delete()` return new maps, the original is never modified.
+
+    Supports the read side of the dict API: get, [], in, len, iteration, keys/values/items and iter* variants.
+    """
+    __slots__ = ('_root', '_count')
+
+    def __init__(self, items = None):
+        self._root = _BitmapNode(0, [])
+        self._count = 0
+        if items:
+            if hasattr(items, 'iteritems'):
+                items = items.iteritems()
+            rr = self.update(items)
+            self._root = rr._root
+            self._count = rr._count
+
+    @classmethod
+    def _from_root(cls, root, count):
+        rr = cls.__new__(cls)
+        rr._root = root
+        rr._count = count
+        return rr
+
+    def set(self, key, value):
+        root, added = self._root.assoc(0, _hash(key), key, value)
+        if root is self._root:
+            return self
+        return self._from_root(root, self._count + (added and 1 or 0))
+
+    def delete(self, key):
+        """ Return new map without `key`. Raises KeyError if missing. """
+        rr = self.discard(key)
+        if rr is self:
+            raise KeyError(key)
+        return rr
+
+    def discard(self, key):
+        """ Return new map without `key`, or this map if `key` is missing. """
+        root = self._root.without(0, _hash(key), key)
+        if root is self._root:
+            return self
+        if root is None:
+            root = _BitmapNode(0, [])
+        return self._from_root(root, self._count - 1)
+
+    def update(self, items):
+        """ Return new map with all (key, value) pairs from `items` applied. """
+        if hasattr(items, 'iteritems'):
+            items = items.iteritems()
+        rr = self
+        for k, v in items:
+            rr = rr.set(k, v)
+        return rr
+
+    def get(self, key, default = None):
+        return self._root.find(0, _hash(key), key, default)
+
+    def __getitem__(self, key):
+        rr = self._root.find(0, _hash(key), key, KeyError)
+        if rr is KeyError:
+            raise KeyError(key)
+        return rr
+
+    def __contains__(self, key):
+        return self._root.find(0, _hash(key), key, KeyError) is not KeyError
+
+    def has_key(self, key):
+        return key in self
+
+    def __len__(self):
+        return self._count
+
+    def __nonzero__(self):
+        return self._count > 0
+
+    def __iter__(self):
+        for k, v in self._root.iteritems():
+            yield k
+
+    def iterkeys(self):
+        return iter(self)
+
+    def itervalues(self):
+        for k, v in self._root.iteritems():
+            yield v
+
+    def iteritems(self):
+        return self._root.iteritems()
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def items(self):
+        return list(self.iteritems())
+
+    def to_dict(self):
+        return dict(self.iteritems())
+
+    def iterchanges(self, old):
+        """
+        (key, value) of keys that `old`, another PersistentMap, lacks or has a different value for. Removed keys are
+        not included. Skips the subtrees shared with `old`, so for maps derived from one another, costs O(changes).
+        """
+        return _iter_changes(self._root, old._root, 0)
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if not isinstance(other, (PersistentMap, dict)):
+            return NotImplemented
+        if len(self) != len(other):
+            return False
+        for k, v in self.iteritems():
+            if other.get(k, KeyError) != v:
+                return False
+        return True
+
+    def __ne__(self, other):
+        rr = self.__eq__(other)
+        if rr is NotImplemented:
+            return rr
+        return not rr
+
+    __hash__ = None
+
+    def __reduce__(self):
+        ## Pickle as plain items, not as the trie nodes:
+        return (PersistentMap, (self.to_dict(),))
+
+    def __repr__(self):
+        return 'PersistentMap(%r)' % (self.to_dict(),)
+
+
+EMPTY_MAP = PersistentMap()
+
+
+def _is_live(entry):
+    return (entry is not KeyError) and bool(entry[0])
+
+
+class MemberMap(PersistentMap):
+    """
+    Members of a set-valued key, {member:(is_present, nonce)}. Removed members stay as tombstones, to keep their
+    nonce, so this also keeps count of the present ones, for O(1) cardinality. See `StateManager.set_cardinality()`.
+    """
+    __slots__ = ('_live',)
+
+    def __init__(self, items = None):
+        PersistentMap.__init__(self)
+        self._live = 0
+        if items:
+            rr = self.update(items)
+            self._root = rr._root
+            self._count = rr._count
+            self._live = rr._live
+
+    def set(self, member, entry):
+        old_entry = self.get(member, KeyError)
+        rr = PersistentMap.set(self, member, entry)
+        if rr is not self:
+            rr._live = self._live - _is_live(old_entry) + _is_live(entry)
+        return rr
+
+    def discard(self, member):
+        old_entry = self.get(member, KeyError)
+        rr = PersistentMap.discard(self, member)
+        if rr is not self:
+            rr._live = self._live - _is_live(old_entry)
+        return rr
+
+    def live_count(self):
+        """ Number of present members, excluding tombstones. """
+        return self._live
+
+    def __reduce__(self):
+        return (MemberMap, (self.to_dict(),))
+
+    def __repr__(self):
+        return 'MemberMap(%r)' % (self.to_dict(),)
+
+
+EMPTY_MEMBERS = MemberMap()
+
+
+def test_persistent_map():
+    print ('START test_persistent_map()')
+    from random import Random
+
+    rnd = Random(1)
+
+    xx = EMPTY_MAP
+    hh = {}
+    history = []
+    for c in xrange(5000):
+        k = rnd.randint(0, 800)
+        if rnd.random() < 0.3:
+            xx = xx.discard(k)
+            hh.pop(k, None)
+        else:
+            xx = xx.set(k, c)
+            hh[k] = c
+        history.append((xx, dict(hh)))
+
+    ## All older versions must be unaffected by later updates:
+    for xx, hh in history[::97] + history[-1:]:
+        assert len(xx) == len(hh), (len(xx), len(hh))
+        assert xx == hh
+        assert sorted(xx.keys()) == sorted(hh.keys())
+        for k in xrange(810):
+            assert xx.get(k, -1) == hh.get(k, -1), k
+            assert (k in xx) == (k in hh), k
+
+    assert EMPTY_MAP.set('a', 1).delete('a') == {}
+    try:
+        EMPTY_MAP.delete('a')
+        assert False, 'expected KeyError'
+    except KeyError:
+        pass
+
+    ## Unchanged value returns same map:
+    yy = EMPTY_MAP.set('a', 'b')
+    assert yy.set('a', yy['a']) is yy
+    assert yy.discard('zz') is yy
+    
+    ## Changes between versions, derived from one another or not:
+    for (xx, hh), (old_xx, old_hh) in zip(history[::97], history[::89]) + [(history[-1], (EMPTY_MAP, {}))]:
+        expected = sorted((k, v) for k, v in hh.iteritems() if old_hh.get(k, -1) != v)
+        assert sorted(xx.iterchanges(old_xx)) == expected, (len(expected))
+        assert sorted(xx.iterchanges(PersistentMap(old_hh))) == expected
+    print ('PASSED')
+
+
+def test_persistent_map_collisions():
+    print ('START test_persistent_map_collisions()')
+
+    class K(object):
+        def __init__(self, n, h):
+            self.n = n
+            self.h = h
+        def __hash__(self):
+            return self.h
+        def __eq__(self, other):
+            return self.n == other.n
+        def __ne__(self, other):
+            return self.n != other.n
+
+    keys = [K(x, x % 3) for x in xrange(30)] + [K(x, (x % 3) + (1 << 20)) for x in xrange(30, 40)]
+    xx = PersistentMap((k, k.n) for k in keys)
+    assert len(xx) == 40
+    for k in keys:
+        assert xx[K(k.n, k.h)] == k.n
+    for k in keys[::2]:
+        xx = xx.delete(k)
+    assert len(xx) == 20
+    assert sorted(xx.values()) == range(1, 40, 2)
+    yy = xx.set(keys[1], -1).set(K(50, 1), 50)
+    assert sorted((k.n, v) for k, v in yy.iterchanges(xx)) == [(1, -1), (50, 50)]
+    print ('PASSED')
+
+
+def test_member_map():
+    print ('START test_member_map()')
+    import cPickle as pickle
+
+    xx = EMPTY_MEMBERS.set('a', (True, 1)).set('b', (True, 1)).set('c', (False, 2))
+    assert (len(xx), xx.live_count()) == (3, 2)
+    
+    yy = xx.set('a', (False, 3)).set('c', (True, 3)).set('d', (False, 3))
+    assert (len(yy), yy.live_count()) == (4, 2)
+    assert yy.discard('b').live_count() == 1
+    assert yy.update([('e', (True, 4))]).live_count() == 3
+    assert (len(xx), xx.live_count()) == (3, 2)
+    
+    zz = pickle.loads(pickle.dumps(yy, pickle.HIGHEST_PROTOCOL))
+    assert isinstance(zz, MemberMap) and (zz == yy) and (zz.live_count() == 2)
+    assert MemberMap({'a':(True, 1)}).live_count() == 1
+    print ('PASSED')
+
+
+if __name__ == '__main__':
+    test_persistent_map()
+    test_persistent_map_collisions()
+    test_member_map()
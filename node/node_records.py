@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+
+"""
+Compact in-memory representations of state table keys and values.
+
+State tables hold one entry per (voter, item) pair and per post, so their per-entry overhead bounds how many users
+fit in RAM. Instead of the JSON shapes that arrive in blockchain logs:
+
+- Addresses are kept as 20-byte binary strings, see `address_bin()`.
+- Item IDs and public keys are interned byte strings, so each distinct one is held once, see `compact_str()`.
+- Composite keys are tuples, e.g. (voter_address_bin, item_id) for the `unblinded_*` tables, see `vote_key()`.
+- Posts are `PostRecord`s, with a `PostStatus`, both using `__slots__`.
+
+Everything is converted back to the original JSON shapes at the web boundary, via `split_vote_key()` and
+`PostRecord.to_json()`.
+
+Keys and records are self-describing, with no codes assigned by the process, so they stay valid when persisted by
+StateManager.save_snapshot() or SQLiteStateStorage, and then loaded by another process.
+"""
+
+import binascii
+
+
+def compact_str(x):
+    """ Interned utf8 byte string of `x`, so equal strings share memory, and compare equal to the unicode original. """
+    if isinstance(x, unicode):
+        x = x.encode('utf8')
+    return intern(x)
+
+
+def address_bin(address):
+    """ '0x' + 40 hex chars address, to 20-byte binary. """
+    assert (len(address) == 42) and address.startswith('0x'), ('BAD_ADDRESS', address)
+    return binascii.unhexlify(address[2:])
+
+def address_hex(address):
+    """ 20-byte binary address, back to '0x' + 40 hex chars. """
+    return '0x' + binascii.hexlify(address)
+
+
+def vote_key(address, item_id):
+    """ Key of the `unblinded_*` tables, replacing `address + '|' + item_id`. """
+    return (address_bin(address), compact_str(item_id))
+
+def split_vote_key(key):
+    """ Inverse of `vote_key()`, returns (address, item_id). """
+    return address_hex(key[0]), key[1]
+
+
+class Record(object):
+    """
+    Base of records stored in state tables. Read-only once created, since one instance is shared by every block state
+    and head view holding it. Derived values, e.g. a post's score, are returned alongside records instead.
+    """
+    __slots__ = ()
+
+    def _set(self, **kw):
+        for x, y in kw.iteritems():
+            object.__setattr__(self, x, y)
+
+    def __setattr__(self, name, value):
+        assert False, ('READ_ONLY_RECORD', type(self).__name__, name)
+
+    def __getstate__(self):
+        return tuple([getattr(self, x) for x in self.__slots__])
+
+    def __setstate__(self, state):
+        for x, y in zip(self.__slots__, state):
+            object.__setattr__(self, x, y)
+
+
+class PostStatus(Record):
+    """
+    Status of a post. Creator is stored once, as binary address + interned public key.
+    """
+    __slots__ = ('confirmed',
+                 'created_time',
+                 'created_block_num',
+                 'created_block_hash',
+                 'creator_address',
+                 'creator_pub',
+                 )
+
+    def __init__(self,
+                 creator_address,
+                 creator_pub,
+                 confirmed = False,
+                 created_time = False,
+                 created_block_num = False,
+                 created_block_hash = None,
+                 ):
+        """
+        - creator_address: 20-byte binary address.
+        - creator_pub: public key, see `compact_str()`.
+        - created_block_hash: only set once confirmed.
+        """
+        self._set(creator_address = creator_address,
+                  creator_pub = creator_pub,
+                  confirmed = confirmed,
+                  created_time = created_time,
+                  created_block_num = created_block_num,
+                  created_block_hash = created_block_hash,
+                  )
+
+
+class PostRecord(Record):
+    """
+    Post, as stored in the `posts` table.
+
+    Fields other than the common ones, e.g. `use_id`, are kept in the `extra` dict, or None if there are none.
+    """
+    __slots__ = ('post_id',
+                 'image_url',
+                 'image_title',
+                 'extra',
+                 'status',
+                 )
+
+    COMMON_FIELDS = ('post_id', 'image_url', 'image_title')
+
+    def __init__(self, post_id, image_url, image_title, status, extra = None):
+        self._set(post_id = post_id,
+                  image_url = image_url,
+                  image_title = image_title,
+                  status = status,
+                  extra = extra or None,
+                  )
+
+    def get(self, name, default = None):
+        """ Common or extra field `name`. """
+        if name in self.COMMON_FIELDS:
+            return getattr(self, name)
+        if self.extra is None:
+            return default
+        return self.extra.get(name, default)
+
+    @classmethod
+    def from_json(cls, post):
+        """ From the JSON shape, a dict with a 'status' dict. """
+        ss = post['status']
+        status = PostStatus(creator_address = address_bin(ss['creator_address']),
+                            creator_pub = compact_str(ss['creator_pub']),
+                            confirmed = ss['confirmed'],
+                            created_time = ss['created_time'],
+                            created_block_num = ss['created_block_num'],
+                            created_block_hash = ss.get('created_block_hash'),
+                            )
+        extra = dict([(x, y) for x, y in post.iteritems() if (x not in cls.COMMON_FIELDS) and (x != 'status')])
+        return cls(post_id = post['post_id'],
+                   image_url = post.get('image_url'),
+                   image_title = post.get('image_title'),
+                   status = status,
+                   extra = extra,
+                   )
+
+    def to_json(self, score = None):
+        """ Back to the JSON shape. Returns new dicts, so callers are free to modify them. """
+        ss = self.status
+        status = {'confirmed':ss.confirmed,
+                  'created_time':ss.created_time,
+                  'created_block_num':ss.created_block_num,
+                  'creator_address':address_hex(ss.creator_address),
+                  'creator_pub':ss.creator_pub,
+                  }
+        if ss.created_block_hash is not None:
+            status['created_block_hash'] = ss.created_block_hash
+        if score is not None:
+            status['score'] = score
+        rr = dict(self.extra or {})
+        rr['post_id'] = self.post_id
+        for x in ['image_url', 'image_title']:
+            if getattr(self, x) is not None:
+                rr[x] = getattr(self, x)
+        rr['status'] = status
+        return rr
+
+
+def test_records():
+    print ('START test_records()')
+    import cPickle as pickle
+
+    addr = '0x' + 'ab' * 20
+    kk = vote_key(addr, 'i123')
+    assert kk == (binascii.unhexlify('ab' * 20), 'i123'), kk
+    assert vote_key(addr, u'i123') == kk
+    assert vote_key(addr, u'i\xe9')[1] == 'i\xc3\xa9'
+    assert split_vote_key(kk) == (addr, 'i123')
+    
+    ## Keys are self-describing, so survive pickling into another process, unlike process-local codes:
+    assert split_vote_key(pickle.loads(pickle.dumps(kk, pickle.HIGHEST_PROTOCOL))) == (addr, 'i123')
+
+    try:
+        address_bin('u1')
+        assert False, 'SHOULD_FAIL'
+    except AssertionError as e:
+        assert 'BAD_ADDRESS' in str(e), e
+
+    post = {'post_id':'i123',
+            'image_url':'http://x',
+            'image_title':'a',
+            'use_id':'p1',
+            'status':{'confirmed':True,
+                      'created_time':100,
+                      'created_block_num':False,
+                      'created_block_hash':'0x' + '11' * 32,
+                      'creator_address':addr,
+                      'creator_pub':'04' + 'cd' * 64,
+                      },
+            }
+    xx = PostRecord.from_json(post)
+    assert xx.get('use_id') == 'p1'
+    assert xx.get('sponsor') is None
+    assert xx.to_json() == post, xx.to_json()
+
+    ## Survives pickling, e.g. by SQLiteStateStorage:
+    yy = pickle.loads(pickle.dumps(xx, pickle.HIGHEST_PROTOCOL))
+    assert yy.to_json(score = 3)['status']['score'] == 3
+    assert yy.to_json()['status'] == post['status']
+    
+    ## Shared by all states holding them, so read-only:
+    for rec, name in [(xx, 'post_id'), (xx.status, 'confirmed'), (yy.status, 'score')]:
+        try:
+            setattr(rec, name, 1)
+            assert False, 'SHOULD_FAIL'
+        except AssertionError as e:
+            assert 'READ_ONLY_RECORD' in str(e), e
+    assert xx.to_json(score = 3) != xx.to_json()
+    assert 'score' not in xx.to_json()['status']
+
+    ## Same creator held once:
+    post['post_id'] = 'i456'
+    post['status']['creator_pub'] = unicode('04' + 'cd' * 64)
+    assert PostRecord.from_json(post).status.creator_pub is xx.status.creator_pub
+    print ('PASSED')
+
+
+if __name__ == '__main__':
+    test_records()
@@ -14,6 +14,8 @@ Usage:
     + Does store(), lookup(), iterate_items() calls back to the state manager, to compute its derived view of the blockchain state
       at each block in the transaction tree.
     + Does send_transaction() calls to modify the blockchain state.
+    Blockchain callbacks may also implement `logic_batch_callback()`, to receive all logs of a block in one call instead,
+    and `end_block_callback()`, called once after each block's logs. See EthereumBlockchain.setup_event_callbacks().
 
 Roles:
 - Maintains a rigorously defined view of derived state, based on the confirmation or rejection of input values coming 
@@ -32,15 +34,420 @@ Confirmation level types:
 """
 
 
-from copy import deepcopy
+from node_pmap import PersistentMap, EMPTY_MAP, EMPTY_MEMBERS
+from node_storage import MemoryStateStorage
+from node_bloom import BloomFilter
 from Queue import Queue
+from collections import OrderedDict, deque
 
-from threading import current_thread,Thread
+from threading import current_thread,Thread,RLock
 from Queue import Queue
 from time import sleep, time
+from os import rename
+from os.path import exists
+from sys import maxint
+from hashlib import sha256
+import cPickle as pickle
 import json
 import traceback
-import multiprocessing
+from multiprocessing.pool import ThreadPool
+import heapq
+from contextlib import contextmanager
+from functools import wraps
+
+SNAPSHOT_MAGIC = 'CCCOIN_STATE_SNAPSHOT'
+SNAPSHOT_VERSION = 2
+
+## Pending writes dependent on a block hash are dropped once that block is no longer within this many
+## ancestors of the head, same limit as the contract's blockhash() check:
+PENDING_DEPENDENT_HASH_MAX_DEPTH = 256
+
+
+class PendingPool:
+    """
+    Bookkeeping of pending writes, indexed by (sender, nonce), so they can be evicted once they are confirmed,
+    time out, get replaced, or the block they depend on is reorged out.
+    
+    StateManager keeps the fused pending view of each table in `hh_pending`, and rebuilds a key's view there
+    from its remaining writes after any evictions.
+    """
+    def __init__(self):
+        self.writes = {}            ## {write_id:{'table', 'key', 'value', 'nonce', 'as_set_op', 'set_remove', 'sender', 'dependent_on_hash'}}
+        self.by_key = {}            ## {(table, key):[write_id, ...]}, in arrival order.
+        self.by_sender_nonce = {}   ## {(sender, nonce):set([write_id, ...])}
+        self.by_dependent_hash = {} ## {blockHash:set([write_id, ...])}
+        self.expiry = []            ## Heap of (expire_block_num, write_id). Evicted writes are skipped lazily.
+        self.next_id = 0
+
+    def __len__(self):
+        return len(self.writes)
+
+    def add(self, table, key, value, nonce, as_set_op, set_remove, sender, expire_block_num, dependent_on_hash):
+        write_id = self.next_id
+        self.next_id += 1
+        
+        self.writes[write_id] = {'table':table,
+                                 'key':key,
+                                 'value':value,
+                                 'nonce':nonce,
+                                 'as_set_op':as_set_op,
+                                 'set_remove':set_remove,
+                                 'sender':sender,
+                                 'dependent_on_hash':dependent_on_hash,
+                                 }
+        self.by_key.setdefault((table, key), []).append(write_id)
+        self.by_sender_nonce.setdefault((sender, nonce), set()).add(write_id)
+        if dependent_on_hash is not False:
+            self.by_dependent_hash.setdefault(dependent_on_hash, set()).add(write_id)
+        if expire_block_num is not False:
+            heapq.heappush(self.expiry, (expire_block_num, write_id))
+        
+        return write_id
+
+    def remove(self, write_id):
+        """ Remove write from the pool, returns its record. """
+        ww = self.writes.pop(write_id)
+        
+        xx = self.by_key[(ww['table'], ww['key'])]
+        xx.remove(write_id)
+        if not xx:
+            del self.by_key[(ww['table'], ww['key'])]
+        
+        xx = self.by_sender_nonce[(ww['sender'], ww['nonce'])]
+        xx.discard(write_id)
+        if not xx:
+            del self.by_sender_nonce[(ww['sender'], ww['nonce'])]
+        
+        if ww['dependent_on_hash'] is not False:
+            xx = self.by_dependent_hash[ww['dependent_on_hash']]
+            xx.discard(write_id)
+            if not xx:
+                del self.by_dependent_hash[ww['dependent_on_hash']]
+        
+        return ww
+
+    def copy(self):
+        """ Copy of the pool's bookkeeping. Write records are never modified once added, so they're shared. """
+        rr = PendingPool()
+        rr.writes = dict(self.writes)
+        rr.by_key = dict((k, list(v)) for k, v in self.by_key.iteritems())
+        rr.by_sender_nonce = dict((k, set(v)) for k, v in self.by_sender_nonce.iteritems())
+        rr.by_dependent_hash = dict((k, set(v)) for k, v in self.by_dependent_hash.iteritems())
+        rr.expiry = list(self.expiry)
+        rr.next_id = self.next_id
+        return rr
+
+    def key_writes(self, table, key):
+        """ [(write_id, record), ...] for a key, in arrival order. """
+        return [(write_id, self.writes[write_id]) for write_id in self.by_key.get((table, key), [])]
+
+    def pop_expired(self, block_num):
+        """ Ids of writes that expire before `block_num`. """
+        rr = []
+        while self.expiry and (self.expiry[0][0] < block_num):
+            expire_block_num, write_id = heapq.heappop(self.expiry)
+            if write_id in self.writes:
+                rr.append(write_id)
+        return rr
+
+class StateStats:
+    """
+    Operation counters and latency histograms of a StateManager, see StateManager.stats().
+    
+    Updated without locking, so counts of lookups from concurrent threads are approximate.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.since = time()
+        self.tables = {}           ## {table:{'stores', 'lookups', 'misses', 'filtered'}}
+        self.ops = {}              ## {op:{'count', 'total_time', 'max_time', 'histogram':{max_micros:count}}}
+        self.offset_walks = {}     ## {num_hops:count}, of block_offset resolutions not already cached.
+        self.offset_cached = 0
+        self.resolutions = {'confirmed':0, 'pending':0, 'missing':0, 'set':0}
+        self.check_block_loaded = {'calls':0, 'already_loaded':0, 'blocks_applied':0}
+
+    def count(self, table, what):
+        tt = self.tables.get(table)
+        if tt is None:
+            tt = self.tables[table] = {'stores':0, 'lookups':0, 'misses':0, 'filtered':0}
+        tt[what] += 1
+
+    def timed(self, op, seconds):
+        """ Record one `op` call. Histogram buckets are powers of 2 microseconds, keyed by their upper bound. """
+        oo = self.ops.get(op)
+        if oo is None:
+            oo = self.ops[op] = {'count':0, 'total_time':0.0, 'max_time':0.0, 'histogram':{}}
+        oo['count'] += 1
+        oo['total_time'] += seconds
+        oo['max_time'] = max(oo['max_time'], seconds)
+        bucket = 1 << int(seconds * 1e6).bit_length()
+        oo['histogram'][bucket] = oo['histogram'].get(bucket, 0) + 1
+
+    def snapshot(self):
+        return {'since':self.since,
+                'duration':time() - self.since,
+                'tables':dict((k, dict(v)) for k, v in self.tables.iteritems()),
+                'ops':dict((k, dict(v, histogram = dict(v['histogram']))) for k, v in self.ops.iteritems()),
+                'offset_walks':dict(self.offset_walks),
+                'offset_cached':self.offset_cached,
+                'resolutions':dict(self.resolutions),
+                'check_block_loaded':dict(self.check_block_loaded),
+                }
+
+
+def timed_op(op):
+    """
+    Record latency of a StateManager method as `op`, while stats are enabled. Otherwise costs one attribute check.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(self, *args, **kw):
+            if not self.stats_enabled:
+                return func(self, *args, **kw)
+            t0 = time()
+            try:
+                return func(self, *args, **kw)
+            finally:
+                with self.the_lock:
+                    self.the_stats.timed(op, time() - t0)
+        return wrapper
+    return decorator
+
+
+def resolution_outcome(rr, rr2):
+    """
+    Which side fuse_entries() takes for these entries: 'confirmed', 'pending', 'missing', or 'set' if fused per member.
+    """
+    if (rr is KeyError) and (rr2 is KeyError):
+        return 'missing'
+    elif isinstance(rr, PersistentMap) or isinstance(rr2, PersistentMap):
+        return 'set'
+    elif (rr is not KeyError) and (rr2 is not KeyError):
+        return (rr2[1] > rr[1]) and 'pending' or 'confirmed'
+    elif rr is not KeyError:
+        return 'confirmed'
+    else:
+        return 'pending'
+
+
+def fuse_entries(rr, rr2, default):
+    """
+    Fuse a key's confirmed entry `rr` with its pending entry `rr2`, either may be KeyError if missing.
+    """
+    if (rr is KeyError) and (rr2 is KeyError):
+        ## lookup(s) failed:
+        if default is not KeyError:
+            return default
+        raise KeyError
+    
+    elif isinstance(rr, PersistentMap) or isinstance(rr2, PersistentMap):
+        ## set-valued, prioritize by nonces per member. Copies, see set_contains() etc. to avoid that:
+        return dict(iter_fused_set_entries(rr, rr2))
+    
+    elif (rr is not KeyError) and (rr2 is not KeyError):
+        ## prioritize by nonces:    
+        if rr2[1] > rr[1]:
+            return rr2[0]
+        else:
+            return rr[0]
+    
+    elif (rr is not KeyError):
+        ## confirmed:
+        return rr[0]
+    
+    elif (rr2 is not KeyError):
+        ## pending:
+        return rr2[0]
+    
+    else:
+        assert False, 'cannot get here'
+
+def iter_fused_set_entries(rr, rr2):
+    """
+    Yield (member, is_present) of a set-valued key, fusing its confirmed members `rr` with its pending members `rr2`,
+    either may be KeyError if missing. Same priority as fuse_entries(), per member. Includes removed members.
+    """
+    if rr is KeyError:
+        rr = EMPTY_MEMBERS
+    if rr2 is KeyError:
+        rr2 = EMPTY_MEMBERS
+    
+    for member, (is_present, nonce) in rr.iteritems():
+        xx = rr2.get(member, KeyError)
+        if (xx is not KeyError) and (xx[1] > nonce):
+            yield member, xx[0]
+        else:
+            yield member, is_present
+    
+    for member, (is_present, nonce) in rr2.iteritems():
+        if member not in rr:
+            yield member, is_present
+
+def iter_fused_set_members(rr, rr2):
+    """ Yield present members only, see iter_fused_set_entries(). """
+    for member, is_present in iter_fused_set_entries(rr, rr2):
+        if is_present:
+            yield member
+
+def fused_set_contains(rr, rr2, member):
+    xx = (rr is KeyError) and KeyError or rr.get(member, KeyError)
+    yy = (rr2 is KeyError) and KeyError or rr2.get(member, KeyError)
+    if (yy is not KeyError) and ((xx is KeyError) or (yy[1] > xx[1])):
+        xx = yy
+    return (xx is not KeyError) and bool(xx[0])
+
+def fused_set_cardinality(rr, rr2):
+    """
+    Number of present members. O(1) for the confirmed members, plus O(pending members) of this key.
+    """
+    if rr is KeyError:
+        rr = EMPTY_MEMBERS
+    
+    if hasattr(rr, 'live_count'):
+        n = rr.live_count()
+    else:
+        ## Stored before sets were kept as MemberMap's, e.g. in old snapshots:
+        n = len([x for x in rr.itervalues() if x[0]])
+    
+    if rr2 is not KeyError:
+        for member, (is_present, nonce) in rr2.iteritems():
+            xx = rr.get(member, KeyError)
+            if xx is KeyError:
+                n += bool(is_present)
+            elif nonce > xx[1]:
+                n += bool(is_present) - bool(xx[0])
+    
+    return n
+
+def drop_tombstones(entry, tombstones):
+    """
+    Set entry without the given [(member, (False, nonce)), ...] tombstones. Members since re-added, or removed again
+    with another nonce, are kept.
+    """
+    for member, xx in tombstones:
+        if entry.get(member, KeyError) == xx:
+            entry = entry.discard(member)
+    return entry
+
+def iter_fused_items(confirmed, pending, prefix):
+    """
+    Single pass merge of the confirmed and pending states, confirmed keys first.
+    """
+    for kk, rr in confirmed.iteritems():
+        if (prefix is not False) and not (isinstance(kk, basestring) and kk.startswith(prefix)):
+            continue
+        yield kk, fuse_entries(rr, pending.get(kk, KeyError), KeyError)
+    
+    for kk, rr2 in pending.iteritems():
+        if (prefix is not False) and not (isinstance(kk, basestring) and kk.startswith(prefix)):
+            continue
+        if kk in confirmed:
+            continue
+        yield kk, fuse_entries(KeyError, rr2, KeyError)
+
+def fused_index_items(index_func, index_key, confirmed, pending, confirmed_index, pending_index):
+    """
+    Items with the given index key, from a table's confirmed & pending states and those of its index. Items are
+    re-checked against `index_func`, since pending and confirmed values may disagree on an item's index key.
+    """
+    keys = set(confirmed_index.get(index_key, EMPTY_MAP))
+    keys.update(pending_index.get(index_key, EMPTY_MAP))
+    
+    rr = []
+    for key in keys:
+        try:
+            value = fuse_entries(confirmed.get(key, KeyError), pending.get(key, KeyError), KeyError)
+        except KeyError:
+            continue
+        if index_func(key, value) == index_key:
+            rr.append((key, value))
+    
+    return rr
+
+
+class HeadView:
+    """
+    Immutable view of all tables as of the end of one head block, fused with the pending state as of when the view
+    was published. StateManager publishes a new view after each block, and after each pending write, see
+    `StateManager.head_view`.
+    
+    Readers in other threads, e.g. web handlers, just grab the current view in O(1) and read from it without any
+    locking. They always see a consistent state, never one with a block partially applied.
+    """
+    def __init__(self, block_hash, block_num, states, pending, indexes):
+        self.block_hash = block_hash
+        self.block_num = block_num
+        self.states = states   ## {table:PersistentMap}
+        self.pending = pending ## {table:PersistentMap}
+        self.indexes = indexes ## {index_name:(table, index_func)}
+
+    def _pending(self, table, allow_pending):
+        if allow_pending:
+            return self.pending[table]
+        return EMPTY_MAP
+
+    def lookup(self,
+               table,                ## Table name.
+               key,                  ## Key.
+               default = KeyError,   ## Default value if missing.
+               allow_pending = True, ## Consider pending transactions.
+               ):
+        """ Same as StateManager.lookup() at the head block. """
+        return fuse_entries(self.states[table].get(key, KeyError),
+                            self._pending(table, allow_pending).get(key, KeyError),
+                            default,
+                            )
+
+    def lookup_many(self,
+                    keys,                 ## List of (table, key) pairs.
+                    default = KeyError,   ## Default value for any missing keys.
+                    allow_pending = True, ## Consider pending transactions.
+                    ):
+        return [self.lookup(table, key, default = default, allow_pending = allow_pending) for table, key in keys]
+
+    def iter_items(self,
+                   table,                ## Table name.
+                   allow_pending = True, ## Consider pending transactions.
+                   prefix = False,       ## Only yield string keys starting with this prefix.
+                   ):
+        """ Same as StateManager.iter_items() at the head block. """
+        return iter_fused_items(self.states[table], self._pending(table, allow_pending), prefix)
+
+    def iterate_items(self,
+                      table,                ## Table name.
+                      allow_pending = True, ## Consider pending transactions.
+                      ):
+        return list(self.iter_items(table, allow_pending = allow_pending))
+
+    def _set_entries(self, table, key, allow_pending):
+        return self.states[table].get(key, KeyError), self._pending(table, allow_pending).get(key, KeyError)
+
+    def set_contains(self, table, key, member, allow_pending = True):
+        return fused_set_contains(*self._set_entries(table, key, allow_pending) + (member,))
+
+    def set_cardinality(self, table, key, allow_pending = True):
+        return fused_set_cardinality(*self._set_entries(table, key, allow_pending))
+
+    def iter_set_members(self, table, key, allow_pending = True):
+        return iter_fused_set_members(*self._set_entries(table, key, allow_pending))
+
+    def index_lookup(self,
+                     index_name,           ## Index name, as passed to setup_tables().
+                     index_key,            ## Index key, as returned by the index function.
+                     allow_pending = True, ## Consider pending transactions.
+                     ):
+        """ Same as StateManager.index_lookup() at the head block. """
+        table, index_func = self.indexes[index_name]
+        return fused_index_items(index_func,
+                                 index_key,
+                                 self.states[table],
+                                 self._pending(table, allow_pending),
+                                 self.states[index_name],
+                                 self._pending(index_name, allow_pending),
+                                 )
+
 
 class StateManager:    
     def __init__(self,
@@ -48,35 +455,128 @@ class StateManager:
                  starting_block_hash = False,
                  starting_block_num = 1,
                  background_thread_sleep_time = 1,
+                 state_mode = 'full',
+                 checkpoint_interval = 64,
+                 view_cache_size = 32,
+                 storage = False,
+                 snapshot_fn = False,
+                 snapshot_interval = 1000,
+                 snapshot_confirm_depth = 12,
+                 snapshot_history = 20,
+                 finality_depth = False,
+                 pending_timeout = False,
+                 prefetch_window = 0,
+                 prefetch_threads = 4,
+                 key_filter_error_rate = 0.001,
+                 compaction_batch = 100,
+                 stats_enabled = False,
              ):
+        """
+        - state_mode: how per-block state is kept:
+          + full:  every block holds its full state, as a PersistentMap sharing structure with its parent.
+          + delta: every block holds only its own write-set. Full states are only materialized every
+                   `checkpoint_interval` blocks, and other blocks are resolved from the nearest checkpoint.
+        - view_cache_size: in delta mode, number of recently materialized block states to cache, per table. Each
+                           applied block touches most tables, so the LRU holds this many times the number of tables.
+        - storage: where block states are kept, see node_storage.py. Defaults to MemoryStateStorage. On-disk
+                   backends require delta mode, so that only write-sets and checkpoints get written.
+        - snapshot_fn: if set, save_snapshot() to this file every `snapshot_interval` blocks, of the block
+                       `snapshot_confirm_depth` behind the head, plus `snapshot_history` ancestors. Load with load_snapshot().
+        - finality_depth: if set, blocks this far behind the head are considered final. The newest final checkpoint
+                          becomes the root, older blocks and branches not descending from the root are freed, and
+                          lookups further back than the root raise PREVIOUSLY_PRUNED_REQUESTED_BLOCK. Should be at
+                          least the deepest `block_offset` used, plus a margin for reorgs. In delta mode, up to
+                          `checkpoint_interval` - 1 more blocks are kept.
+        - pending_timeout: default number of blocks after which pending writes are dropped, for store() calls that don't
+                           pass `is_pending_timeout`. False to keep them until confirmed or replaced.
+        - prefetch_window: when backfilling, fetch logs (and, if the blockchain callbacks provide
+                           get_block_by_num_callback(), headers) up to this many blocks ahead of the block being
+                           processed, using a pool of `prefetch_threads` threads. Prefetched data that went stale due
+                           to a reorg is detected by its block hash and refetched. 0 to fetch sequentially. See close().
+        - key_filter_error_rate: keep a Bloom filter of all keys ever written to each table, so lookups of keys that
+                                 were never written skip reading the confirmed state. This false positive rate
+                                 bounds the share of such lookups that still read it. False to disable.
+        - compaction_batch: with finality_depth, max number of set-valued keys per block whose removed members get
+                            compacted away once final, see _compact_tombstones().
+        - stats_enabled: collect per-table operation counts and latency histograms, see stats(). Can also be toggled
+                         later with enable_stats().
+        """
         
         assert starting_block_num >= 1, '1 is smallest possible value for starting_block_num in ethereum'
 
+        assert state_mode in ['full', 'delta'], state_mode
+        assert checkpoint_interval >= 1, checkpoint_interval
+        
+        if storage is False:
+            storage = MemoryStateStorage()
+        
+        assert storage.in_memory or (state_mode == 'delta'), 'On-disk storage requires state_mode = delta.'
+        
+        assert (finality_depth is False) or (finality_depth >= 1), finality_depth
+        assert (finality_depth is False) or (not snapshot_fn) or (finality_depth >= snapshot_confirm_depth + snapshot_history), \
+            ('finality_depth must cover the snapshot blocks', finality_depth, snapshot_confirm_depth, snapshot_history)
+
         ## Don't try to access a block_num larger than this within logic_callback, as it may not yet be loaded:
         self.head_block_num = -1 
         self.head_block_hash = -1 
         
-        self.manager = multiprocessing.Manager()
-        self.the_lock = self.manager.RLock()
+        ## Only shared between threads of this process. Held by the ingestion thread for the whole of each block,
+        ## see block_transaction():
+        self.the_lock = RLock()
             
         self.bcc = blockchain_callbacks
         self.starting_block_hash = starting_block_hash
         self.starting_block_num = starting_block_num
 
-        #import leveldb
-        #self.the_db = leveldb.LevelDB(db_name)
+        ## Per-block states are PersistentMap's, so each new block shares its parent's state instead of copying it.
+        ## In delta mode, only checkpoint blocks hold a full state, the rest hold their write-set:
+        self.storage = storage
+        self.hh_pending = {} ## {table:PersistentMap}
+        self.pending_pool = PendingPool()
+        self.pending_timeout = pending_timeout
         
-        self.hh = {}
-        self.hh_pending = {}
+        self.state_mode = state_mode
+        self.checkpoint_interval = checkpoint_interval
+        self.view_cache_size = view_cache_size
+        self.view_cache = OrderedDict() ## {(table, blockHash):PersistentMap}, in LRU order, shared by all tables.
+        
+        self.snapshot_fn = snapshot_fn
+        self.snapshot_interval = snapshot_interval
+        self.snapshot_confirm_depth = snapshot_confirm_depth
+        self.snapshot_history = snapshot_history
+        self.last_snapshot_block_num = -1
+        
+        ## Oldest block still kept, once pruning has started. Its state holds everything before it:
+        self.finality_depth = finality_depth
+        self.pruned_root_hash = False
+        self.pruned_root_num = False
+        
+        ## Set-valued keys with removed members, to compact once their removal is final:
+        self.compaction_batch = compaction_batch
+        self.compaction_queue = deque() ## [(block_num, table, key, member), ...], set removals in block order.
+        self.compaction_latest = {}     ## {(table, key, member):block_num}, of the latest queued removal of each member.
+        self.compacted_nonces = {}      ## {(table, key, member):(nonce, block_num)}, of tombstones compacted away.
         
         self.parent_lookup = {} ## {blockHash:blockParentHash}
         self.child_lookup = {} ## {blockParentHash:blockHash}
         self.block_hash_to_block_num = {}
         self.latest_hash = False
         
+        ## For resolving block_offset's in O(log n), see _index_block():
+        self.ancestor_index = {} ## {blockHash:(depth, [ancestor_1_back, ancestor_2_back, ancestor_4_back, ...])}
+        self.offset_cache = {}   ## {blockHash:{block_offset:ancestorHash}}
+        
         self.is_setup_tables = False
         #self.is_setup_logic_callback = False
         
+        self.indexes = {}       ## {index_name:(table, index_func)}
+        self.table_indexes = {} ## {table:[index_name, ...]}
+        
+        ## Keys ever written to each table's confirmed states, on any block. Keys are never deleted from states, so
+        ## a key missing from the filter is missing from every block's state:
+        self.key_filter_error_rate = key_filter_error_rate
+        self.key_filters = {} ## {table:BloomFilter}
+        
         self.send_transaction_queue = Queue()
         
         ## Just for timing info etc:
@@ -86,15 +586,57 @@ class StateManager:
 
         self.running_check_block_loaded = False
         
+        ## Blocks whose logs have all been applied. Lookups at these never need to touch the blockchain callbacks:
+        self.loaded_blocks = set()
+        
+        ## Thread running loop_once(). Only it loads blocks, other threads (e.g. web handlers) only read loaded ones:
+        self.ingestion_thread = False
+        
+        self.prefetch_window = prefetch_window
+        self.prefetch_threads = prefetch_threads
+        self.prefetch_pool = False ## Started on first use, stopped by close().
+        
+        ## Latest published HeadView, for lock-free reads from other threads. Set by setup_tables():
+        self.head_view = False
+        
+        ## Block transaction in progress, see block_transaction():
+        self.txn_hash = False
+        self.txn_thread = False
+        self.txn_writes = {} ## {table:PersistentMap}, buffered entries only.
+        self.txn_states = {} ## {table:PersistentMap}, full states with the buffered entries applied.
+        self.txn_undo = {}
+        
+        ## Instrumentation, see stats():
+        self.stats_enabled = stats_enabled
+        self.the_stats = StateStats()
+        
         
     def setup_tables(self,
                      table_names,
+                     indexes = {},
                      ):
+        """
+        - indexes: secondary indexes, {index_name:(table, index_func)}. `index_func(key, value)` returns the index key
+                   of an item, or None to leave it out. Each index is kept as an extra table of
+                   {index_key:{key:True}}, so it's consistent per block and per pending state, just like
+                   its table. Updated on each store(). See index_lookup().
+        """
+        for index_name, (table, index_func) in indexes.iteritems():
+            assert table in table_names, ('UNKNOWN_INDEXED_TABLE', index_name, table)
+            assert index_name not in table_names, ('INDEX_NAME_IS_A_TABLE', index_name)
+        
         self.is_setup_tables = True
-        self.table_names = table_names
+        self.table_names = list(table_names) + sorted(indexes)
+        self.indexes = dict(indexes)
+        self.table_indexes = {}
+        for index_name, (table, index_func) in sorted(indexes.items()):
+            self.table_indexes.setdefault(table, []).append(index_name)
         for table in self.table_names:
-            self.hh[table] = {}
-            self.hh_pending[table] = {}
+            self.hh_pending[table] = EMPTY_MAP
+        
+        self._reset_key_filters()
+        
+        self._publish_head_view()
         
     #def setup_logic_callback(self, logic_callback):
     #    self.is_setup_logic_callback = True
@@ -106,10 +648,19 @@ class StateManager:
         assert self.is_setup_tables, 'Must call setup_tables().'
         #assert self.is_setup_logic_callback, 'Must call setup_logic_callback().'
         
+        self.ingestion_thread = current_thread()
+        
         ## Read side:
         
         self._check_block_loaded(self.bcc.get_latest_block_callback()['hash'])
         
+        if self.snapshot_fn and (self.head_block_num - self.last_snapshot_block_num >= self.snapshot_interval):
+            if self.save_snapshot(self.snapshot_fn,
+                                  confirm_depth = self.snapshot_confirm_depth,
+                                  history = self.snapshot_history,
+                                  ):
+                self.last_snapshot_block_num = self.head_block_num
+        
         ## Write side:
         
         self.bcc.loop_once_blockchain()
@@ -117,6 +668,12 @@ class StateManager:
     def _start_background_thread(self,
                                  terminate_on_exception = False,
                                  ):
+        try:
+            self._background_loop(terminate_on_exception)
+        finally:
+            self.close()
+    
+    def _background_loop(self, terminate_on_exception):
         last_event = False
 
         while True:
@@ -137,7 +694,16 @@ class StateManager:
                 print ('NO_NEW_EVENTS', last_event and (time() - last_event))
             
             sleep(self.background_thread_sleep_time)
-
+    
+    def close(self):
+        """
+        Stop the prefetch threads, waiting for any prefetches in progress. A later loop_once() starts new ones if needed.
+        """
+        pool = self.prefetch_pool
+        if pool is not False:
+            self.prefetch_pool = False
+            pool.close()
+            pool.join()
         
     def start_background_thread(self,
                                 start_in_foreground = False,
@@ -156,11 +722,20 @@ class StateManager:
             self.t.start()
 
         
+    @timed_op('check_block_loaded')
     def _check_block_loaded(self, the_hash):
         """
         State management and missing block backfill.
         """
-
+        
+        if self.stats_enabled:
+            self.the_stats.check_block_loaded['calls'] += 1
+        
+        if the_hash in self.loaded_blocks:
+            if self.stats_enabled:
+                self.the_stats.check_block_loaded['already_loaded'] += 1
+            return
+        
         if self.running_check_block_loaded:
             print ("Don't recurse.")
             return
@@ -181,10 +756,21 @@ class StateManager:
 
                 c = -1
                 
+                cur_num = None
+                fetched = {}        ## {blockHash:block}, headers already fetched during this walk.
+                header_futures = {} ## {block_num:AsyncResult}, speculative prefetches of canonical headers.
+                
                 while True:
                     c += 1
                     
-                    block = self.bcc.get_block_by_hash_callback(cur_hash)
+                    block = fetched.pop(cur_hash, None) or self._fetch_header(cur_hash, cur_num, header_futures)
+
+                    if block['hash'] == self.pruned_root_hash:
+                        break
+                    
+                    if (self.pruned_root_num is not False) and (block['number'] <= self.pruned_root_num):
+                        ## Either a lookup of a pruned block, or a reorg deeper than finality_depth:
+                        assert False, ('PREVIOUSLY_PRUNED_REQUESTED_BLOCK', block['number'], block['hash'], self.pruned_root_num)
 
                     ## WARN: 'totalDifficulty' always 0x0 for testrpc:
                     if (self.latest_hash is False) or ((block['totalDifficulty'], block['number']) > self.latest_hash[0]):
@@ -213,7 +799,8 @@ class StateManager:
                                                              'parentHash':block['parentHash'],
                                                              }
                     if block['parentHash'] not in self.block_details:
-                        block_parent = self.bcc.get_block_by_hash_callback(block['parentHash'])
+                        block_parent = self._fetch_header(block['parentHash'], block['number'] - 1, header_futures)
+                        fetched[block_parent['hash']] = block_parent
                         self.block_details[block_parent['hash']] = {'timestamp':block_parent['timestamp'],
                                                                     'number':block_parent['number'],
                                                                     'hash':block_parent['hash'],
@@ -221,17 +808,13 @@ class StateManager:
                                                                     }
 
                     
-                    #if first_time:
-                    #    print '???', self.hh[self.table_names[0]]
-                    #    raw_input()
-
-                    if first_time and (block['hash'] not in self.hh[self.table_names[0]]):
+                    if first_time and (not self._has_block_state(block['hash'])):
                         buf.append((block['number'],
                                     block['hash'],
                                     c,
                                     ))
 
-                    if block['parentHash'] not in self.hh[self.table_names[0]]:
+                    if not self._has_block_state(block['parentHash']):
                         buf.append((block['number'] - 1,
                                     block['parentHash'],
                                     c,
@@ -242,7 +825,16 @@ class StateManager:
 
                     print ('backtrack_unseen_block:', block['number'], block['parentHash'], '->', cur_hash)
 
+                    if self.prefetch_window and hasattr(self.bcc, 'get_block_by_num_callback'):
+                        self._prefetch(self.bcc.get_block_by_num_callback,
+                                       [(x,) for x in xrange(max(self.starting_block_num, block['number'] - 1 - self.prefetch_window),
+                                                             block['number'] - 1,
+                                                             )],
+                                       header_futures,
+                                       )
+
                     cur_hash = block['parentHash']
+                    cur_num = block['number'] - 1
                     first_time = False
 
                 if buf:
@@ -257,56 +849,110 @@ class StateManager:
                 
                 ## Compute new state, from oldest to newest:
                 
-                for block_num, expected_hash, zz in reversed(buf):
+                ordered = list(reversed(buf))
+                log_futures = {} ## {(block_num, expected_hash):AsyncResult}
+                
+                ## Deliver each block's logs in one call, if the blockchain callbacks support it:
+                is_batch = hasattr(self.bcc, 'logic_batch_callback')
+                
+                for c, (block_num, expected_hash, zz) in enumerate(ordered):
+                    
+                    t0 = self.stats_enabled and time()
+                    
+                    if self.prefetch_window:
+                        self._prefetch(self._prefetch_logs,
+                                       [x[:2] for x in ordered[c:c + self.prefetch_window + 1]],
+                                       log_futures,
+                                       )
+                        logs, is_current = log_futures.pop((block_num, expected_hash)).get()
+                        if not is_current:
+                            ## Prefetched before a reorg, refetch:
+                            print ('STALE_PREFETCH_LOGS', block_num, expected_hash)
+                            logs = self._fetch_logs(block_num)
+                    else:
+                        logs = self._fetch_logs(block_num)
+
+                    ## Buffer the block's writes, and apply them all at once when done, or none if it fails:
                     
-                    logs = self.bcc.get_logs_by_block_num_callback(block_num)
-
-                    if not logs:
-                        ## Add noop, just so prior state gets copied:
-                        logs = [{'blockHash':expected_hash, 'blockNumber':block_num, 'is_noop':True}]
-                        self.head_block_hash = expected_hash
-                        self.head_block_num = self.block_details[self.head_block_hash]['number']
-
-                    for log in logs:
-
-                        if log["blockHash"] != expected_hash: ## genesis block or expected hash
-                            #assert False, (log["blockHash"], expected_hash, block_num)
-                            print 'ANY_WRONG', ('got:', log["blockHash"], 'expected:', expected_hash, 'block_num:', block_num, 'zz:', zz)
-                            #raw_input()
-                            #any_wrong = True
-                            #break
+                    with self.block_transaction(expected_hash):
+                    
+                        if not logs:
+                            ## Add noop, just so prior state gets copied:
+                            logs = [{'blockHash':expected_hash, 'blockNumber':block_num, 'is_noop':True}]
+                            self.head_block_hash = expected_hash
+                            self.head_block_num = self.block_details[self.head_block_hash]['number']
+
+                        loaded_now = set()
+                    
+                        for log in logs:
+
+                            if log["blockHash"] != expected_hash: ## genesis block or expected hash
+                                #assert False, (log["blockHash"], expected_hash, block_num)
+                                print 'ANY_WRONG', ('got:', log["blockHash"], 'expected:', expected_hash, 'block_num:', block_num, 'zz:', zz)
+                                #raw_input()
+                                #any_wrong = True
+                                #break
                         
-                        if log["blockHash"] not in self.hh[self.table_names[0]]:
-                            ## Copy state from preceding block:
+                            if not self._has_block_state(log["blockHash"]):
+                                ## Share state from preceding block, O(1) since states are persistent:
 
-                            print ('backfill_unseen_block', log["blockNumber"], 'of', last_block_num, log["blockHash"])
+                                print ('backfill_unseen_block', log["blockNumber"], 'of', last_block_num, log["blockHash"])
 
-                            for ccc,table in enumerate(self.table_names):
-                                if (block_num == self.starting_block_num) or (log["blockHash"] == self.starting_block_hash):
-                                    old_state = {}
-                                else:
-                                    old_state = deepcopy(self.hh[table][self.parent_lookup[log['blockHash']]]['s'])
+                                is_genesis = (block_num == self.starting_block_num) or (log["blockHash"] == self.starting_block_hash)
 
                                 self.head_block_hash = log['blockHash']
                                 self.head_block_num = self.block_details[self.head_block_hash]['number']
 
-                                self.hh[table][log["blockHash"]] = {'h':log['blockHash'],                      ## block hash
-                                                                    'p':self.parent_lookup[log['blockHash']],  ## parent block hash
-                                                                    's':old_state,                             ## state
-                                                                    }
+                                self._index_block(log['blockHash'],
+                                                  self.parent_lookup[log['blockHash']],
+                                                  is_genesis,
+                                                  )
+                            
+                                for ccc,table in enumerate(self.table_names):
+                                    self._new_block_state(table,
+                                                          log['blockHash'],
+                                                          self.parent_lookup[log['blockHash']],
+                                                          block_num,
+                                                          is_genesis,
+                                                          )
                         
-                        assert log["blockHash"] in self.hh[self.table_names[0]], ('missing', len(self.hh[self.table_names[0]]))
+                            assert self._has_block_state(log["blockHash"]), ('missing', log["blockHash"])
                         
                         
-                        ## Continue computing logic forward from this old state / old block:
+                            ## Continue computing logic forward from this old state / old block:
                         
-                        self.bcc.logic_callback(log,
-                                                is_pending = False,
-                                                is_noop = log.get('is_noop', False)
-                                                )
+                            if not is_batch:
+                                self.bcc.logic_callback(log,
+                                                        is_pending = False,
+                                                        is_noop = log.get('is_noop', False)
+                                                        )
                         
-                                                
-
+                            loaded_now.add(log['blockHash'])
+                        
+                        if is_batch:
+                            self.bcc.logic_batch_callback(logs,
+                                                          is_pending = False,
+                                                          is_noop = logs[0].get('is_noop', False)
+                                                          )
+                        
+                        if hasattr(self.bcc, 'end_block_callback'):
+                            self.bcc.end_block_callback(expected_hash, block_num)
+                    
+                    self.loaded_blocks.update(loaded_now)
+                    
+                    if self.finality_depth is not False:
+                        self._prune_finalized()
+                        self._compact_tombstones()
+                    
+                    self._expire_pending()
+                    
+                    self._publish_head_view()
+                    
+                    self.storage.flush()
+                    
+                    if t0:
+                        self.the_stats.check_block_loaded['blocks_applied'] += 1
+                        self.the_stats.timed('apply_block', time() - t0)
 
                     if any_wrong:
                         break
@@ -314,209 +960,1113 @@ class StateManager:
                 if not any_wrong:
                     break
 
-            #assert False, ('size', len(self.hh[self.table_names[0]]))
-        
         finally:
             self.running_check_block_loaded = False
+
+    @contextmanager
+    def block_transaction(self, block_hash):
+        """
+        Apply one block's logs as a transaction, holding the lock throughout.
         
-    def store(self,
-              table,                                ## Table name
-              key,                                  ## Key
-              value,                                ## Value
-              cur_hash = False,                     ## Transaction is bound to this hash in the transaction tree.
-              as_set_op = False,                    ## Do store as a set add (or remove if following flag is set) operation.
-              set_remove = False,                   ## Do store as a set remove operation.
-              nonce = False,                        ## Monotonically increasing nonce from the end user, determines priority.
-              at_block_num = False,                 ## Store at block_num, on same chain as cur_hash. Must be < cur_hash's block_num!
-              is_pending = False,                   ## Update came from pending transaction.
-              is_pending_dependent_on_hash = False, ## Ignore update if this block_hash isn't in recent committed history.
-              is_pending_timeout = False,           ## Ignore update if after this time limit.
-              is_pending_replaces_nonce = False,    ## Either accept this update, or other update with given nonce, not both.
-              ):
+        Confirmed writes into `block_hash` made by this thread are buffered, and lookups by this thread read their
+        own writes. When the block is done, its buffered writes are committed to storage together. If it fails,
+        they're discarded, along with any changes to the pending state. A block state first created within the
+        transaction is deleted too, so the block gets applied again from scratch next time it's loaded.
         """
-        Low-level key-value storage. Called from `logic_callback()`. We also attach a bunch of block-tracking info
-        to allow the manager to determine where this state lies on the transaction tree.
+        with self.the_lock:
+            
+            assert self.txn_hash is False, ('NESTED_BLOCK_TRANSACTION', self.txn_hash, block_hash)
+            
+            self.txn_hash = block_hash
+            self.txn_thread = current_thread()
+            self.txn_undo = {'head':(self.head_block_hash, self.head_block_num),
+                             'is_new_block':not self._has_block_state(block_hash),
+                             'pending':False,
+                             }
+            
+            try:
+                yield
+                self._commit_block_transaction()
+            except:
+                self._rollback_block_transaction()
+                raise
+            finally:
+                self.txn_hash = False
+                self.txn_thread = False
+                self.txn_writes = {}
+                self.txn_states = {}
+                self.txn_undo = {}
+
+    def _commit_block_transaction(self):
+        for table, writes in self.txn_writes.iteritems():
+            self.storage.put_many(table, self.txn_hash, writes.iteritems())
+            kk = (table, self.txn_hash)
+            if kk in self.view_cache:
+                self.view_cache[kk] = self.txn_states[table]
+
+    def _rollback_block_transaction(self):
+        print ('ROLLBACK_BLOCK', self.txn_hash, 'buffered_tables:', len(self.txn_writes))
         
-        General idea:
-        - Compute the tree of most likely future outcomes.
-        - Select a single most likely outcome chain based on all provided constraints.
+        self.head_block_hash, self.head_block_num = self.txn_undo['head']
         
-        - maintain both sides in 1 tree:
-          (read_val, read_nonce, is_pending, pending_val, pending_nonce, pending_hash, pending_timeout, pending_replaces_nonce)
+        if self.txn_undo['pending'] is not False:
+            self.hh_pending, self.pending_pool = self.txn_undo['pending']
         
-        Only show pending side if:
-        - nonce >= than read_side nonce
-        - latest read_side block_num < is_pending_timeout
-        - if is_pending_dependent_on_cur_hash and latest read_side has cur_hash is in its ancestors.
+        if self.txn_undo['is_new_block']:
+            for table in self.table_names:
+                if self.storage.has_block(table, self.txn_hash):
+                    self.storage.delete_block(table, self.txn_hash)
+                self.view_cache.pop((table, self.txn_hash), None)
+
+    def _in_block_transaction(self, block_hash):
+        return (block_hash == self.txn_hash) and (current_thread() is self.txn_thread)
+
+    def _prefetch(self, fetch_func, args_list, futures):
+        """
+        Start background `fetch_func(*args)` calls for any of `args_list` not already in `futures`, keyed by args.
+        """
+        if self.prefetch_pool is False:
+            self.prefetch_pool = ThreadPool(self.prefetch_threads)
         
-        Contract protections:
-        - nonce: contract only accepts transactions with increasing (sender, nonce) and abs(nonce - time()) < 90.
-        - is_pending_replaces_nonce: contract must either accept this newer (sender, nonce) transaction, or the older, but not both.
-        - is_pending_dependent_on_cur_hash: contract must ensure that cur_hash is within the last 256 ancestors of current fork.
-        - is_pending_timeout: contract refuses write if more than N blocks have passed since cur_hash's block num.
+        for args in args_list:
+            if args not in futures:
+                futures[args] = self.prefetch_pool.apply_async(fetch_func, args)
+
+    def _fetch_logs(self, block_num):
+        return list(self.bcc.get_logs_by_block_num_callback(block_num))
+    
+    def _prefetch_logs(self, block_num, expected_hash):
+        """
+        Logs of `block_num`, plus whether they're of block `expected_hash`. Judged by the logs' block hashes, or for
+        blocks without logs, by the headers at `block_num` fetched right before and after refetching the logs, so that
+        a reorg in between can't go unnoticed. False if there's no telling.
+        """
+        logs = self._fetch_logs(block_num)
+        if logs:
+            return logs, not [x for x in logs if x['blockHash'] != expected_hash]
+        if not hasattr(self.bcc, 'get_block_by_num_callback'):
+            return logs, False
         
-        get_failed() - to get list of stale direct for retrying (only for is_pending_bind_to_hash = False)
+        is_current = lambda block: bool(block) and (block['hash'] == expected_hash)
         
-        monotonic nonces: performance.now, 
-        https://developers.google.com/web/updates/2012/08/When-milliseconds-are-not-enough-performance-now
+        if not is_current(self.bcc.get_block_by_num_callback(block_num)):
+            return logs, False
         
-        """
-        assert cur_hash or is_pending
+        logs = self._fetch_logs(block_num)
+        if logs:
+            return logs, not [x for x in logs if x['blockHash'] != expected_hash]
         
-        #assert (len(cur_hash) == 66) or (cur_hash == 'latest'), (cur_hash,)
+        return logs, is_current(self.bcc.get_block_by_num_callback(block_num))
 
-        cur_hash = self.head_block_hash ## TEMP: write to head to be safe.
+    def _fetch_header(self, block_hash, block_num, header_futures):
+        """
+        Header of `block_hash`. Taken from the prefetch of `block_num` if there is one and its hash matches,
+        otherwise, e.g. if it's from a different branch or went stale after a reorg, fetched by hash.
+        """
+        future = header_futures.pop((block_num,), None)
         
-        assert cur_hash == self.head_block_hash, (self.block_details[cur_hash]['number'], self.block_details[self.head_block_hash]['number'])
+        if future is not None:
+            block = future.get()
+            if block and (block['hash'] == block_hash):
+                return block
+            print ('STALE_PREFETCH_HEADER', block_num, block_hash)
         
-        if set_remove:
-            assert as_set_op
+        return self.bcc.get_block_by_hash_callback(block_hash)
 
-        if not is_pending:
-            self._check_block_loaded(cur_hash)
-        
-        if is_pending:
-            the_state = self.hh_pending[table]
-        else:
-            the_state = self.hh[table][cur_hash]['s']
+    def _get_ancestors(self, block_hash, num):
+        """
+        Returns [block_hash, parent, grandparent, ...], up to `num` ancestors, stopping at the starting or pruned root block.
+        """
+        rr = [block_hash]
+        while len(rr) <= num:
+            if (self.block_hash_to_block_num[block_hash] == self.starting_block_num) or (block_hash == self.starting_block_hash):
+                break
+            if block_hash == self.pruned_root_hash:
+                break
+            block_hash = self.parent_lookup[block_hash]
+            rr.append(block_hash)
+        return rr
+    
+    def save_snapshot(self,
+                      fn,
+                      confirm_depth = 12,
+                      history = 20,
+                      ):
+        """
+        Persist state as of a sufficiently confirmed block, so that a restarted node can load_snapshot() and then
+        only process newer blocks, instead of replaying everything since `starting_block_num`.
         
-        if nonce is not False:
-            if key in the_state:
-                if as_set_op:
-                    old_val, old_nonce = the_state[key][value]
-                else:
-                    old_val, old_nonce = the_state[key]
-                if old_nonce >= nonce:
-                    print ('IGNORE_OLD_NONCE')
-                    return False
+        - confirm_depth: snapshot the ancestor this many blocks behind the head block.
+        - history: also include this many ancestors of the snapshot block, so `block_offset` lookups keep working
+                   after resuming. Should be at least MAX_UNBLIND_DELAY.
         
-        if as_set_op:
-            if key not in self.hh[table][cur_hash]['s']:
-                the_state[key] = {}
-            if set_remove:
-                the_state[key][value] = (False, nonce)
-            else:
-                the_state[key][value] = (True, nonce)
-        else:
-            the_state[key] = (value, nonce)
-
-        ## Propagate state forward, until a newer value is set:
+        Written atomically, with a checksum. Returns the snapshot block hash, or False if too few blocks are loaded yet.
         
-        cur = cur_hash
+        Only grabbing the states holds the_lock. They're persistent, so diffing and writing them happens outside it.
+        """
         
-        while True:
-            if cur not in self.child_lookup:
-                break
-            child = self.child_lookup[cur]
+        with self.the_lock:
             
-            if is_pending:
-                the_state = self.hh_pending[table]
-            else:
-                the_state = self.hh[table][cur]['s']
-
-            if key in the_state:
-                ## New value reached.
-                break
-
-            print ('PROPAGATE_FORWARD', table, key, cur)
-            assert False
+            if self.head_block_hash == -1:
+                return False
             
-            #the_state[key] = (value, nonce)
+            chain = self._get_ancestors(self.head_block_hash, confirm_depth + history)
             
-            if as_set_op:
-                if key not in self.hh[table][cur]['s']:
-                    the_state[key] = {}
-                if set_remove:
-                    the_state[key][value] = (False, nonce)
-                else:
-                    the_state[key][value] = (True, nonce)
-            else:
-                the_state[key] = (value, nonce)
+            if len(chain) <= confirm_depth:
+                return False
             
-            cur = child
+            chain = list(reversed(chain[confirm_depth:])) ## Oldest first, snapshot block last.
+            snapshot_num = self.block_hash_to_block_num[chain[-1]]
+            
+            states = dict((table, [self._get_state(table, block_hash) for block_hash in chain])
+                          for table in self.table_names)
+            
+            hh = {'version':SNAPSHOT_VERSION,
+                  'table_names':self.table_names,
+                  'chain':chain,
+                  'parent_lookup':{x:self.parent_lookup[x] for x in chain},
+                  'block_hash_to_block_num':{x:self.block_hash_to_block_num[x] for x in chain},
+                  'block_details':{x:self.block_details[x] for x in chain if x in self.block_details},
+                  ## Compaction as of the snapshot block, so the resumed node compacts the same as this one:
+                  'compaction_queue':[x for x in self.compaction_queue if x[0] <= snapshot_num],
+                  'compacted_nonces':dict((x, y) for x, y in self.compacted_nonces.iteritems() if y[1] <= snapshot_num),
+                  }
         
-        return True
+        ## Per table, the full state of the oldest block followed by a diff for each newer block:
+        hh['tables'] = {}
+        for table, xx in states.iteritems():
+            prev = EMPTY_MAP
+            hh['tables'][table] = []
+            for state in xx:
+                hh['tables'][table].append(dict(state.iterchanges(prev)))
+                prev = state
+        
+        payload = pickle.dumps(hh, pickle.HIGHEST_PROTOCOL)
+        
+        with open(fn + '.tmp', 'wb') as f:
+            f.write(SNAPSHOT_MAGIC + ' ' + sha256(payload).hexdigest() + '\n')
+            f.write(payload)
+        rename(fn + '.tmp', fn)
+        
+        print ('SAVED_SNAPSHOT', fn, 'block_num:', snapshot_num, 'hash:', chain[-1])
+        
+        return chain[-1]
 
-    
-    def lookup(self,
-               table,                ## Table name.
-               key,                  ## Key.
-               at_hash = 'latest',   ## Consider state as of end of the block with this block hash.
-               block_offset = 0,     ## Consider state as of the end of the given block offset, relative to at_hash.
-               default = KeyError,   ## Default value if missing.
-               allow_pending = True, ## Consider pending transactions, depending on nonces & timeouts set at store().
-               ):
+    def load_snapshot(self, fn):
         """
-        Low-level lookup of value in the key_value storage, as of `at_hash`.
+        Resume from a snapshot written by save_snapshot(). Must be called after setup_tables(), before any blocks
+        are loaded.
+        
+        Returns the snapshot block hash. Returns False if the snapshot is missing, corrupt or incompatible, in which
+        case nothing is changed and all blocks will be replayed from `starting_block_num` as usual.
         """
-        #print ('lookup', key, at_hash, block_offset, default)
+        assert self.is_setup_tables, 'Must call setup_tables() first.'
+        assert not self.block_hash_to_block_num, 'Must load snapshot before loading any blocks.'
         
-        assert block_offset <= 0
+        if not exists(fn):
+            print ('NO_SNAPSHOT', fn)
+            return False
         
-        if not at_hash:
-            #assert False, ('no at_hash', at_hash)
-            ## for is_pending:
-            at_hash = 'latest'
+        try:
+            with open(fn, 'rb') as f:
+                magic, checksum = f.readline().split()
+                payload = f.read()
+            
+            assert magic == SNAPSHOT_MAGIC, magic
+            
+            if sha256(payload).hexdigest() != checksum:
+                print ('SNAPSHOT_CHECKSUM_MISMATCH', fn)
+                return False
+            
+            hh = pickle.loads(payload)
+        except Exception as e:
+            print ('SNAPSHOT_UNREADABLE', fn, e)
+            return False
         
-        if at_hash == 'latest':
-            if self.latest_hash is False:
+        if (hh['version'] != SNAPSHOT_VERSION) or (set(hh['table_names']) != set(self.table_names)):
+            print ('SNAPSHOT_INCOMPATIBLE', fn, hh['version'], hh['table_names'])
+            return False
+        
+        chain = hh['chain']
+        
+        with self.the_lock:
+            
+            self.parent_lookup.update(hh['parent_lookup'])
+            self.block_hash_to_block_num.update(hh['block_hash_to_block_num'])
+            self.block_details.update(hh['block_details'])
+            self.compacted_nonces.update(hh['compacted_nonces'])
+            self.compaction_queue.extend(hh['compaction_queue'])
+            for block_num, table, key, member in hh['compaction_queue']:
+                self.compaction_latest[(table, key, member)] = max(block_num, self.compaction_latest.get((table, key, member), -maxint))
+            for c, block_hash in enumerate(chain):
+                self.child_lookup[self.parent_lookup[block_hash]] = block_hash
+                self._index_block(block_hash, self.parent_lookup[block_hash], c == 0)
+                self.loaded_blocks.add(block_hash)
+            
+            ## Oldest snapshot block becomes the new genesis, nothing before it will be looked up:
+            self.starting_block_hash = chain[0]
+            self.starting_block_num = self.block_hash_to_block_num[chain[0]]
+            
+            ## Filters only need to cover the snapshot's keys from now on:
+            self._reset_key_filters()
+            
+            for table in self.table_names:
+                state = EMPTY_MAP
+                for c, (block_hash, diff) in enumerate(zip(chain, hh['tables'][table])):
+                    state = state.update(diff)
+                    if self.key_filter_error_rate is not False:
+                        self.key_filters[table].update(diff)
+                    if (c == 0) or (self.state_mode == 'full'):
+                        self.storage.add_block(table, block_hash, self.parent_lookup[block_hash], state = state)
+                    else:
+                        self.storage.add_block(table, block_hash, self.parent_lookup[block_hash])
+                        for k, v in diff.iteritems():
+                            self.storage.put(table, block_hash, k, v)
+            
+            self.storage.flush()
+            
+            self.head_block_hash = chain[-1]
+            self.head_block_num = self.block_hash_to_block_num[chain[-1]]
+            self.latest_hash = [(-1, self.head_block_num), self.head_block_hash, self.head_block_num]
+            self.last_snapshot_block_num = self.head_block_num
+            
+            self._publish_head_view()
+        
+        print ('LOADED_SNAPSHOT', fn, 'block_num:', self.head_block_num, 'hash:', self.head_block_hash)
+        
+        return self.head_block_hash
+
+    def _prune_finalized(self):
+        """
+        Make the newest checkpoint at least `finality_depth` blocks behind the head the new root, then free every block
+        older than it, and every block on a branch that doesn't descend from it.
+        
+        The root must hold its full state, since the blocks its deltas apply to are going away. Only moving it to
+        existing checkpoints means pruning never writes a state. In delta mode, the root so advances once per
+        `checkpoint_interval` blocks.
+        """
+        if self.state_mode == 'full':
+            interval = 1
+        else:
+            interval = self.checkpoint_interval
+        
+        chain = self._get_ancestors(self.head_block_hash, self.finality_depth + interval - 1)
+        
+        new_root = False
+        for block_hash in chain[self.finality_depth:]:
+            if self.storage.get_block(self.table_names[0], block_hash)[1]:
+                new_root = block_hash
+                break
+        
+        if (new_root is False) or (new_root == self.pruned_root_hash):
+            return
+        
+        new_root_num = self.block_hash_to_block_num[new_root]
+        
+        ## Known blocks, including parents seen only for their block_details:
+        nums = dict(self.block_hash_to_block_num)
+        for block_hash, dd in self.block_details.iteritems():
+            nums.setdefault(block_hash, dd['number'])
+        
+        ## Parents sort before children, so a single pass finds all descendants of the root:
+        keep = set([new_root])
+        for block_hash in sorted(nums, key = nums.get):
+            if (nums[block_hash] > new_root_num) and (self.parent_lookup.get(block_hash) in keep):
+                keep.add(block_hash)
+        
+        num_pruned = 0
+        for block_hash in nums:
+            if block_hash in keep:
+                continue
+            if self._has_block_state(block_hash):
+                num_pruned += 1
+                for table in self.table_names:
+                    self.storage.delete_block(table, block_hash)
+                    self.view_cache.pop((table, block_hash), None)
+            self.loaded_blocks.discard(block_hash)
+            self.parent_lookup.pop(block_hash, None)
+            self.ancestor_index.pop(block_hash, None)
+            self.offset_cache.pop(block_hash, None)
+            self.block_hash_to_block_num.pop(block_hash, None)
+            self.block_details.pop(block_hash, None)
+        
+        for block_hash in self.child_lookup.keys():
+            if (block_hash not in keep) or (self.child_lookup[block_hash] not in keep):
+                del self.child_lookup[block_hash]
+        
+        self.pruned_root_hash = new_root
+        self.pruned_root_num = new_root_num
+        
+        if num_pruned:
+            print ('PRUNED_BLOCKS', num_pruned, 'new_root:', new_root_num, new_root)
+
+    def _compact_tombstones(self):
+        """
+        Drop removed set members (tombstones) written at or before the finality root, from all remaining blocks.
+        Processes at most `compaction_batch` queued removals per call, so the work is spread over blocks.
+        
+        Tombstones only keep the nonce of a removed member, so that writes with older nonces can't re-add it. Nothing
+        upstream rejects such replays, so each compacted tombstone's nonce is kept per member in `compacted_nonces`,
+        and _store_one() checks it just like the tombstone. Compaction never changes which stores are accepted.
+        """
+        if (self.pruned_root_hash is False) or (not self.compaction_queue) or (self.compaction_queue[0][0] > self.pruned_root_num):
+            return
+        
+        block_hashes = [x for x in self.block_hash_to_block_num if self._has_block_state(x)]
+        
+        num_compacted = 0
+        while self.compaction_queue and (num_compacted < self.compaction_batch):
+            block_num, table, key, member = self.compaction_queue[0]
+            if block_num > self.pruned_root_num:
+                break
+            self.compaction_queue.popleft()
+            if self.compaction_latest.get((table, key, member)) != block_num:
+                ## Removed again since, compacted along with that removal:
+                continue
+            del self.compaction_latest[(table, key, member)]
+            num_compacted += 1
+            
+            ## Unless re-added since, the root holds this removal's tombstone:
+            x = self.storage.get(table, self.pruned_root_hash, key, EMPTY_MEMBERS).get(member)
+            if (x is None) or x[0]:
+                continue
+            final = [(member, x)]
+            
+            if x[1] is not False:
+                self.compacted_nonces[(table, key, member)] = (x[1], block_num)
+            
+            for block_hash in block_hashes:
+                entry = self.storage.get(table, block_hash, key, None)
+                if entry is not None:
+                    new_entry = drop_tombstones(entry, final)
+                    if new_entry is not entry:
+                        self.storage.put(table, block_hash, key, new_entry)
+                kk = (table, block_hash)
+                if (kk in self.view_cache) and (key in self.view_cache[kk]):
+                    self.view_cache[kk] = self.view_cache[kk].set(key, drop_tombstones(self.view_cache[kk][key], final))
+        
+        if num_compacted:
+            print ('COMPACTED_TOMBSTONES', num_compacted, 'queued:', len(self.compaction_queue))
+
+    def _index_block(self, block_hash, parent_hash, is_genesis):
+        """
+        Add a newly loaded block to the ancestor index: its depth above the starting block, plus skip pointers
+        to its ancestors 1, 2, 4, 8, ... blocks back. Pointer i+1 is pointer i of the block pointer i leads to.
+        """
+        if is_genesis:
+            self.ancestor_index[block_hash] = (0, [])
+            return
+        
+        depth = self.ancestor_index[parent_hash][0] + 1
+        jumps = [parent_hash]
+        while True:
+            up = self.ancestor_index.get(jumps[-1])
+            if (up is None) or (len(up[1]) < len(jumps)):
+                break
+            jumps.append(up[1][len(jumps) - 1])
+        
+        self.ancestor_index[block_hash] = (depth, jumps)
+
+    def _resolve_offset(self, at_hash, block_offset):
+        """
+        Hash of the ancestor `abs(block_offset)` blocks behind `at_hash`, in O(log n) hops using the ancestor index,
+        or O(1) if already resolved for this block. Offsets reaching past the starting block stop there.
+        """
+        if not block_offset:
+            return at_hash
+        
+        depth, jumps = self.ancestor_index[at_hash]
+        
+        num_back = abs(block_offset)
+        if num_back > depth:
+            print 'GENESIS_BREAK'
+            num_back = depth
+        
+        if (self.pruned_root_hash is not False) and (depth - num_back < self.ancestor_index[self.pruned_root_hash][0]):
+            assert False, ('PREVIOUSLY_PRUNED_REQUESTED_BLOCK', at_hash, block_offset, self.pruned_root_num)
+        
+        cache = self.offset_cache.setdefault(at_hash, {})
+        if block_offset in cache:
+            if self.stats_enabled:
+                self.the_stats.offset_cached += 1
+            return cache[block_offset]
+        
+        use_hash = at_hash
+        bit = 0
+        hops = 0
+        while num_back:
+            if num_back & 1:
+                use_hash = self.ancestor_index[use_hash][1][bit]
+                hops += 1
+            num_back >>= 1
+            bit += 1
+        
+        cache[block_offset] = use_hash
+        
+        if self.stats_enabled:
+            self.the_stats.offset_walks[hops] = self.the_stats.offset_walks.get(hops, 0) + 1
+        
+        return use_hash
+
+    def _has_block_state(self, block_hash):
+        return self.storage.has_block(self.table_names[0], block_hash)
+
+    def _new_block_state(self, table, block_hash, parent_hash, block_num, is_genesis):
+        """
+        Create state for a newly seen block, starting from its parent's state.
+        """
+        if is_genesis:
+            old_state = EMPTY_MAP
+        else:
+            old_state = self._get_state(table, parent_hash)
+        
+        if (self.state_mode == 'full') or is_genesis or (block_num % self.checkpoint_interval == 0):
+            self.storage.add_block(table, block_hash, parent_hash, state = old_state)
+            if not self.storage.in_memory:
+                self._cache_view(table, block_hash, old_state)
+        else:
+            self.storage.add_block(table, block_hash, parent_hash)
+            self._cache_view(table, block_hash, old_state)
+
+    def _get_state(self, table, block_hash):
+        """
+        Full state of `table` as of the end of `block_hash`, as a PersistentMap. Includes the writes buffered so far
+        if this thread is applying `block_hash`, see block_transaction().
+        """
+        if self._in_block_transaction(block_hash):
+            if table not in self.txn_states:
+                self.txn_states[table] = self._get_committed_state(table, block_hash)
+            return self.txn_states[table]
+        
+        return self._get_committed_state(table, block_hash)
+
+    def _get_committed_state(self, table, block_hash):
+        """
+        Full state of `table` as of the end of `block_hash`, as written to storage.
+
+        In delta mode, walks back to the nearest checkpoint or cached view, then re-applies the write-sets forward.
+        """
+        kk = (table, block_hash)
+        if kk in self.view_cache:
+            rr = self.view_cache.pop(kk)
+            self.view_cache[kk] = rr
+            return rr
+        
+        deltas = []
+        cur = block_hash
+        while True:
+            if (table, cur) in self.view_cache:
+                rr = self.view_cache[(table, cur)]
+                break
+            parent_hash, is_checkpoint = self.storage.get_block(table, cur)
+            if is_checkpoint:
+                rr = self.storage.block_state(table, cur)
+                break
+            deltas.append(self.storage.block_state(table, cur))
+            cur = parent_hash
+        
+        for dd in reversed(deltas):
+            rr = rr.update(dd)
+        
+        if deltas or (not self.storage.in_memory):
+            self._cache_view(table, block_hash, rr)
+        
+        return rr
+
+    def _cache_view(self, table, block_hash, state):
+        kk = (table, block_hash)
+        self.view_cache.pop(kk, None)
+        self.view_cache[kk] = state
+        while len(self.view_cache) > self.view_cache_size * max(1, len(self.table_names)):
+            self.view_cache.popitem(last = False)
+
+    def _reset_key_filters(self):
+        if self.key_filter_error_rate is not False:
+            self.key_filters = dict((table, BloomFilter(error_rate = self.key_filter_error_rate))
+                                    for table in self.table_names)
+
+    def _put_entry(self, table, block_hash, key, entry):
+        """
+        Write the stored (value, nonce) tuple or set members `entry` for `key`, into the state of `block_hash`.
+        """
+        if self.key_filter_error_rate is not False:
+            self.key_filters[table].add(key)
+        
+        if self._in_block_transaction(block_hash):
+            self.txn_states[table] = self._get_state(table, block_hash).set(key, entry)
+            self.txn_writes[table] = self.txn_writes.get(table, EMPTY_MAP).set(key, entry)
+            return
+        
+        self.storage.put(table, block_hash, key, entry)
+        
+        kk = (table, block_hash)
+        if kk in self.view_cache:
+            self.view_cache[kk] = self.view_cache[kk].set(key, entry)
+        
+    @timed_op('store')
+    def store(self,
+              table,                                ## Table name
+              key,                                  ## Key
+              value,                                ## Value
+              cur_hash = False,                     ## Transaction is bound to this hash in the transaction tree.
+              as_set_op = False,                    ## Do store as a set add (or remove if following flag is set) operation.
+              set_remove = False,                   ## Do store as a set remove operation.
+              nonce = False,                        ## Monotonically increasing nonce from the end user, determines priority.
+              at_block_num = False,                 ## Store at block_num, on same chain as cur_hash. Must be < cur_hash's block_num!
+              is_pending = False,                   ## Update came from pending transaction.
+              is_pending_dependent_on_hash = False, ## Ignore update if this block_hash isn't in recent committed history.
+              is_pending_timeout = False,           ## Ignore update if after this time limit.
+              is_pending_replaces_nonce = False,    ## Either accept this update, or other update with given nonce, not both.
+              sender = False,                       ## Sender of the transaction. With `nonce`, identifies the write in the pending pool.
+              ):
+        """
+        Low-level key-value storage. Called from `logic_callback()`. We also attach a bunch of block-tracking info
+        to allow the manager to determine where this state lies on the transaction tree.
+        
+        General idea:
+        - Compute the tree of most likely future outcomes.
+        - Select a single most likely outcome chain based on all provided constraints.
+        
+        - maintain both sides in 1 tree:
+          (read_val, read_nonce, is_pending, pending_val, pending_nonce, pending_hash, pending_timeout, pending_replaces_nonce)
+        
+        Only show pending side if:
+        - nonce >= than read_side nonce
+        - latest read_side block_num < is_pending_timeout
+        - if is_pending_dependent_on_cur_hash and latest read_side has cur_hash is in its ancestors.
+        
+        Contract protections:
+        - nonce: contract only accepts transactions with increasing (sender, nonce) and abs(nonce - time()) < 90.
+        - is_pending_replaces_nonce: contract must either accept this newer (sender, nonce) transaction, or the older, but not both.
+        - is_pending_dependent_on_cur_hash: contract must ensure that cur_hash is within the last 256 ancestors of current fork.
+        - is_pending_timeout: contract refuses write if more than N blocks have passed since cur_hash's block num.
+        
+        get_failed() - to get list of stale direct for retrying (only for is_pending_bind_to_hash = False)
+        
+        Pending writes are tracked in the pending pool, and evicted from the pending view once:
+        - confirmed: a confirmed store() with the same (sender, nonce), or for the same key (and set member) with a
+          nonce at least as high, at which point the pending value could never be shown anymore.
+        - timed out: `is_pending_timeout` (or the `pending_timeout` default) blocks have passed.
+        - replaced: another pending write by the same sender passed this write's nonce as `is_pending_replaces_nonce`.
+        - reorged out: `is_pending_dependent_on_hash` is no longer within recent ancestors of the head.
+        
+        monotonic nonces: performance.now, 
+        https://developers.google.com/web/updates/2012/08/When-milliseconds-are-not-enough-performance-now
+        
+        """
+        assert cur_hash or is_pending
+        
+        #assert (len(cur_hash) == 66) or (cur_hash == 'latest'), (cur_hash,)
+
+        cur_hash = self.head_block_hash ## TEMP: write to head to be safe.
+        
+        assert cur_hash == self.head_block_hash, (self.block_details[cur_hash]['number'], self.block_details[self.head_block_hash]['number'])
+        
+        if set_remove:
+            assert as_set_op
+
+        with self.the_lock:
+            
+            if not is_pending:
+                self._check_block_loaded(cur_hash)
+            
+            rr = self._store_tracked(table, key, value, cur_hash, as_set_op, set_remove, nonce, is_pending,
+                                     sender, is_pending_timeout, is_pending_dependent_on_hash, is_pending_replaces_nonce)
+            
+            self._publish_after_store(is_pending)
+            
+            return rr
+
+    @timed_op('store_many')
+    def store_many(self,
+                   items,                                ## List of (table, key, value, nonce) tuples.
+                   cur_hash = False,                     ## Transactions are bound to this hash in the transaction tree.
+                   as_set_op = False,                    ## Do stores as set add (or remove if following flag is set) operations.
+                   set_remove = False,                   ## Do stores as set remove operations.
+                   is_pending = False,                   ## Updates came from pending transactions.
+                   is_pending_dependent_on_hash = False, ## See store(), same for all writes.
+                   is_pending_timeout = False,           ## See store(), same for all writes.
+                   is_pending_replaces_nonce = False,    ## See store(), evicted before the first write.
+                   sender = False,                       ## Sender of the transactions, see store().
+                   ):
+        """
+        Batch store(), all writes bound to the same block. The block is resolved, and the lock taken, once per batch.
+        Writes are applied in order. Returns a list of store() results, False for writes ignored due to old nonces,
+        or dependent on a block no longer in recent history.
+        """
+        assert cur_hash or is_pending
+        
+        cur_hash = self.head_block_hash ## TEMP: write to head to be safe, same as store().
+        
+        if set_remove:
+            assert as_set_op
+        
+        with self.the_lock:
+            
+            if not is_pending:
+                self._check_block_loaded(cur_hash)
+            
+            rr = [self._store_tracked(table, key, value, cur_hash, as_set_op, set_remove, nonce, is_pending,
+                                      sender, is_pending_timeout, is_pending_dependent_on_hash, is_pending_replaces_nonce)
+                  for table, key, value, nonce in items]
+            
+            self._publish_after_store(is_pending)
+            
+            return rr
+
+    def _store_tracked(self, table, key, value, cur_hash, as_set_op, set_remove, nonce, is_pending,
+                       sender, timeout, dependent_on_hash, replaces_nonce):
+        """
+        Write a single key, and maintain the pending pool: track pending writes, evict those made obsolete.
+        """
+        if (self.txn_hash is not False) and (self.txn_undo['pending'] is False) and (is_pending or self.pending_pool.writes):
+            ## First change to the pending state within this block transaction, save it for rollback:
+            self.txn_undo['pending'] = (dict(self.hh_pending), self.pending_pool.copy())
+        
+        if is_pending:
+            if (dependent_on_hash is not False) and (not self._is_recent_block(dependent_on_hash)):
+                print ('IGNORE_PENDING_DEPENDENT_ON_OLD_HASH', dependent_on_hash)
+                return False
+            
+            if replaces_nonce is not False:
+                self._evict_pending(self.pending_pool.by_sender_nonce.get((sender, replaces_nonce), ()))
+        
+        if not self._store_one(table, key, value, cur_hash, as_set_op, set_remove, nonce, is_pending):
+            return False
+        
+        if is_pending:
+            ## Older writes to the same key (or set member) no longer contribute to the pending view:
+            for write_id, ww in self.pending_pool.key_writes(table, key):
+                if (ww['as_set_op'] == as_set_op) and ((not as_set_op) or (ww['value'] == value)):
+                    self.pending_pool.remove(write_id)
+            
+            if timeout is False:
+                timeout = self.pending_timeout
+            self.pending_pool.add(table, key, value, nonce, as_set_op, set_remove, sender,
+                                  (timeout is not False) and (self.head_block_num + timeout),
+                                  dependent_on_hash,
+                                  )
+        
+        elif self.pending_pool.writes:
+            ## Evict pending writes now confirmed, or that can't be shown over the confirmed value anymore:
+            evict = set()
+            if (sender is not False) and (nonce is not False):
+                evict.update(self.pending_pool.by_sender_nonce.get((sender, nonce), ()))
+            for write_id, ww in self.pending_pool.key_writes(table, key):
+                if (ww['as_set_op'] != as_set_op) or (as_set_op and (ww['value'] != value)):
+                    continue
+                if not (ww['nonce'] > nonce):
+                    evict.add(write_id)
+            self._evict_pending(evict)
+        
+        return True
+
+    def _publish_after_store(self, is_pending):
+        """
+        Confirmed writes made while a block is being applied only show up once the whole block is published. Pending
+        writes, and any confirmed writes made outside of block processing, show up right away.
+        """
+        if is_pending:
+            self._publish_head_view(refresh_states = False)
+        elif not self.running_check_block_loaded:
+            self._publish_head_view()
+    
+    def _publish_head_view(self, refresh_states = True):
+        """
+        Swap in a new HeadView of the head block's states and the current pending states. A single attribute
+        assignment, so readers see either the previous view or this one. With `refresh_states` False, only the
+        pending states are updated, keeping the confirmed states of the previous view.
+        """
+        if (not refresh_states) and (self.head_view is not False):
+            states = self.head_view.states
+        elif self.head_block_hash not in self.loaded_blocks:
+            states = dict((table, EMPTY_MAP) for table in self.table_names)
+        else:
+            states = dict((table, self._get_state(table, self.head_block_hash)) for table in self.table_names)
+        
+        self.head_view = HeadView(self.head_block_hash,
+                                  self.head_block_num,
+                                  states,
+                                  dict(self.hh_pending),
+                                  self.indexes,
+                                  )
+    
+    def _evict_pending(self, write_ids):
+        """
+        Remove writes from the pending pool, then rebuild the pending view of each affected key by replaying its
+        remaining writes.
+        """
+        keys = set()
+        for write_id in list(write_ids):
+            ww = self.pending_pool.remove(write_id)
+            keys.add((ww['table'], ww['key']))
+        
+        for table, key in keys:
+            old_entry = self.hh_pending[table].get(key, KeyError)
+            
+            if old_entry is KeyError:
+                continue
+            
+            self.hh_pending[table] = self.hh_pending[table].discard(key)
+            
+            for index_name in self.table_indexes.get(table, []):
+                index_key = self.indexes[index_name][1](key, old_entry[0])
+                members = self.hh_pending[index_name].get(index_key, KeyError)
+                if (index_key is not None) and (members is not KeyError):
+                    self.hh_pending[index_name] = self.hh_pending[index_name].set(index_key, members.discard(key))
+            
+            for write_id, ww in self.pending_pool.key_writes(table, key):
+                rr = self._store_one(table, key, ww['value'], self.head_block_hash, ww['as_set_op'],
+                                     ww['set_remove'], ww['nonce'], True)
+                if not rr:
+                    self.pending_pool.remove(write_id)
+        
+        if keys:
+            print ('EVICTED_PENDING', len(keys), 'remaining:', len(self.pending_pool))
+
+    def _expire_pending(self):
+        """
+        Evict pending writes that timed out, or whose dependent block is no longer a recent ancestor of the head.
+        Called after each new block.
+        """
+        evict = set(self.pending_pool.pop_expired(self.head_block_num))
+        
+        for block_hash, write_ids in self.pending_pool.by_dependent_hash.items():
+            if not self._is_recent_block(block_hash):
+                evict.update(write_ids)
+        
+        self._evict_pending(evict)
+
+    def _is_recent_block(self, block_hash):
+        """
+        True if `block_hash` is the head or one of its last PENDING_DEPENDENT_HASH_MAX_DEPTH ancestors.
+        """
+        if (block_hash not in self.ancestor_index) or (self.head_block_hash not in self.ancestor_index):
+            return False
+        
+        num_back = self.ancestor_index[self.head_block_hash][0] - self.ancestor_index[block_hash][0]
+        
+        if (num_back < 0) or (num_back > PENDING_DEPENDENT_HASH_MAX_DEPTH):
+            return False
+        
+        if (self.pruned_root_hash is not False) and (self.ancestor_index[block_hash][0] < self.ancestor_index[self.pruned_root_hash][0]):
+            return False
+        
+        return self._resolve_offset(self.head_block_hash, -num_back) == block_hash
+
+    def _store_one(self, table, key, value, cur_hash, as_set_op, set_remove, nonce, is_pending):
+        """
+        Write a single key, once store() or store_many() have resolved and loaded `cur_hash`.
+        """
+        if self.stats_enabled:
+            self.the_stats.count(table, 'stores')
+        
+        if is_pending:
+            the_state = self.hh_pending[table]
+        else:
+            the_state = self._get_state(table, cur_hash)
+        
+        if nonce is not False:
+            if as_set_op:
+                ## Per member, members not yet in the set have no nonce to beat:
+                old_entry = the_state.get(key, EMPTY_MEMBERS).get(value, KeyError)
+            else:
+                old_entry = the_state.get(key, KeyError)
+            if old_entry is not KeyError:
+                old_val, old_nonce = old_entry
+                if old_nonce >= nonce:
+                    print ('IGNORE_OLD_NONCE')
+                    return False
+            elif as_set_op and (not is_pending) and ((table, key, value) in self.compacted_nonces):
+                ## Same check as against the member's tombstone, before it was compacted away:
+                if self.compacted_nonces[(table, key, value)][0] >= nonce:
+                    return False
+        
+        entry = self._make_entry(the_state.get(key, EMPTY_MEMBERS if as_set_op else EMPTY_MAP), value, nonce, as_set_op, set_remove)
+        
+        if table in self.table_indexes:
+            assert not as_set_op, ('SET_TABLES_CANNOT_BE_INDEXED', table)
+            self._update_indexes(table, key, the_state.get(key, KeyError), value, cur_hash, is_pending)
+        
+        if is_pending:
+            self.hh_pending[table] = the_state.set(key, entry)
+        else:
+            self._put_entry(table, cur_hash, key, entry)
+            if set_remove and (self.finality_depth is not False):
+                block_num = self.block_hash_to_block_num[cur_hash]
+                if self.compaction_latest.get((table, key, value), -maxint) < block_num:
+                    self.compaction_queue.append((block_num, table, key, value))
+                    self.compaction_latest[(table, key, value)] = block_num
+
+        ## Propagate state forward, until a newer value is set:
+        
+        cur = cur_hash
+        
+        while True:
+            if cur not in self.child_lookup:
+                break
+            child = self.child_lookup[cur]
+            
+            if is_pending:
+                the_state = self.hh_pending[table]
+            else:
+                the_state = self._get_state(table, cur)
+
+            if key in the_state:
+                ## New value reached.
+                break
+
+            print ('PROPAGATE_FORWARD', table, key, cur)
+            assert False
+            
+            self._put_entry(table, cur, key, self._make_entry(the_state.get(key, EMPTY_MAP), value, nonce, as_set_op, set_remove))
+            
+            cur = child
+        
+        return True
+
+    def _update_indexes(self, table, key, old_entry, value, cur_hash, is_pending):
+        """
+        Move `key` from its old index key to its new one, in every index on `table`.
+        """
+        for index_name in self.table_indexes[table]:
+            index_func = self.indexes[index_name][1]
+            
+            old_index_key = None
+            if old_entry is not KeyError:
+                old_index_key = index_func(key, old_entry[0])
+            new_index_key = index_func(key, value)
+            
+            if is_pending:
+                index_state = self.hh_pending[index_name]
+            else:
+                index_state = self._get_state(index_name, cur_hash)
+            
+            changes = []
+            if (old_index_key is not None) and (old_index_key != new_index_key):
+                changes.append((old_index_key, index_state.get(old_index_key, EMPTY_MAP).discard(key)))
+            if new_index_key is not None:
+                members = index_state.get(new_index_key, EMPTY_MAP)
+                if key not in members:
+                    changes.append((new_index_key, members.set(key, (True, False))))
+            
+            for index_key, members in changes:
+                if is_pending:
+                    self.hh_pending[index_name] = self.hh_pending[index_name].set(index_key, members)
+                else:
+                    self._put_entry(index_name, cur_hash, index_key, members)
+
+    def _make_entry(self, old_entry, value, nonce, as_set_op, set_remove):
+        """
+        Returns the new stored entry for a key. Sets are stored as nested MemberMap's of
+        {member:(is_present, nonce)}, so set updates also only copy the changed path.
+        """
+        if as_set_op:
+            if set_remove:
+                return old_entry.set(value, (False, nonce))
+            else:
+                return old_entry.set(value, (True, nonce))
+        
+        return (value, nonce)
+    
+    @timed_op('lookup')
+    def lookup(self,
+               table,                ## Table name.
+               key,                  ## Key.
+               at_hash = 'latest',   ## Consider state as of end of the block with this block hash.
+               block_offset = 0,     ## Consider state as of the end of the given block offset, relative to at_hash.
+               default = KeyError,   ## Default value if missing.
+               allow_pending = True, ## Consider pending transactions, depending on nonces & timeouts set at store().
+               ):
+        """
+        Low-level lookup of value in the key_value storage, as of `at_hash`.
+        """
+        #print ('lookup', key, at_hash, block_offset, default)
+        
+        with self.the_lock:
+            
+            use_hash = self._resolve_lookup_hash(at_hash, block_offset)
+            
+            if use_hash is False:
                 if default is KeyError:
                     raise KeyError
                 return default
+            
+            return self._lookup_one(table, key, use_hash, default, allow_pending)
+
+    @timed_op('lookup_many')
+    def lookup_many(self,
+                    keys,                 ## List of (table, key) pairs.
+                    at_hash = 'latest',   ## Consider state as of end of the block with this block hash.
+                    block_offset = 0,     ## Consider state as of the end of the given block offset, relative to at_hash.
+                    default = KeyError,   ## Default value for any missing keys.
+                    allow_pending = True, ## Consider pending transactions, depending on nonces & timeouts set at store().
+                    ):
+        """
+        Batch lookup(), all keys as of the same block. The block and offset are resolved, and the lock taken, once
+        per batch. Returns values in the same order as `keys`.
+        """
+        with self.the_lock:
+            
+            use_hash = self._resolve_lookup_hash(at_hash, block_offset)
+            
+            if use_hash is False:
+                if keys and (default is KeyError):
+                    raise KeyError
+                return [default for x in keys]
+            
+            return [self._lookup_one(table, key, use_hash, default, allow_pending)
+                    for table, key in keys]
+
+    @timed_op('index_lookup')
+    def index_lookup(self,
+                     index_name,           ## Index name, as passed to setup_tables().
+                     index_key,            ## Index key, as returned by the index function.
+                     at_hash = 'latest',   ## Consider state as of end of the block with this block hash.
+                     block_offset = 0,     ## Consider state as of the end of the given block offset, relative to at_hash.
+                     allow_pending = True, ## Consider pending transactions, depending on nonces & timeouts set at store().
+                     ):
+        """
+        Items of the indexed table with the given index key, as a list of (key, value) pairs, in O(result).
+        
+        Values are the same as lookup() returns. Since pending and confirmed values may disagree on an item's
+        index key, items are re-checked against the index function, and only returned under their current one.
+        """
+        table, index_func = self.indexes[index_name]
+        
+        with self.the_lock:
+            
+            use_hash = self._resolve_lookup_hash(at_hash, block_offset)
+            
+            if use_hash is False:
+                return []
+            
+            if allow_pending:
+                pending, pending_index = self.hh_pending[table], self.hh_pending[index_name]
+            else:
+                pending, pending_index = EMPTY_MAP, EMPTY_MAP
+            
+            return fused_index_items(index_func,
+                                     index_key,
+                                     self._get_state(table, use_hash),
+                                     pending,
+                                     self._get_state(index_name, use_hash),
+                                     pending_index,
+                                     )
+
+    def _resolve_lookup_hash(self, at_hash, block_offset):
+        """
+        Resolve lookup() args to the block whose state is read, loading it if needed. False if no blocks are loaded yet.
+        
+        The head block hash is set before the head block is done loading. Until then, 'latest' from threads other than
+        the ingestion thread resolves to the block of the last published head view, i.e. the last fully loaded one.
+        """
+        assert block_offset <= 0
+        
+        if not at_hash:
+            #assert False, ('no at_hash', at_hash)
+            ## for is_pending:
+            at_hash = 'latest'
+        
+        if at_hash == 'latest':
+            if self.latest_hash is False:
+                return False
             #at_hash = self.latest_hash[1]
             at_hash = self.head_block_hash
-            
-        self._check_block_loaded(at_hash)
+            if (at_hash not in self.loaded_blocks) and (self.ingestion_thread is not False) and \
+               (current_thread() is not self.ingestion_thread):
+                head_view = self.head_view
+                if (head_view is False) or (head_view.block_hash not in self.loaded_blocks):
+                    return False
+                at_hash = head_view.block_hash
         
-        use_hash = at_hash
-        for x in xrange(abs(block_offset)):
-            xx = self.parent_lookup[use_hash]
-            if self.block_hash_to_block_num[use_hash] == self.starting_block_num:
-                print 'GENESIS_BREAK'
-                break
-            if use_hash == self.starting_block_hash:
-                print 'GENESIS_BREAK'
-                break
-            use_hash = xx
+        if at_hash not in self.loaded_blocks:
+            assert (self.ingestion_thread is False) or (current_thread() is self.ingestion_thread), ('BLOCK_NOT_LOADED', at_hash)
+            self._check_block_loaded(at_hash)
         
-        rr = self.hh[table][use_hash]['s'].get(key, KeyError)
+        return self._resolve_offset(at_hash, block_offset)
+
+    def _lookup_one(self, table, key, use_hash, default, allow_pending):
+        """
+        Lookup a single key in the state of resolved block `use_hash`, fused with the pending state.
+        """
+        rr, rr2 = self._entries(table, key, use_hash, allow_pending)
         
-        if allow_pending:
-            rr2 = self.hh_pending[table].get(key, KeyError)
-        else:
-            rr2 = KeyError
+        if self.stats_enabled:
+            outcome = resolution_outcome(rr, rr2)
+            self.the_stats.resolutions[outcome] += 1
+            if outcome == 'missing':
+                self.the_stats.count(table, 'misses')
         
-        if (rr is KeyError) and (rr2 is KeyError):
-            ## lookup(s) failed:
-            if default is not KeyError:
-                return default
-            raise KeyError
-        
-        elif (rr is not KeyError) and (rr2 is not KeyError):
-            ## prioritize by nonces:    
-            if rr2[1] > rr[1]:
-                if type(rr2) == dict:
-                    return {x:y for x,(y,z) in rr2.iteritems()}
-                return rr2[0]
-            else:
-                if type(rr) == dict:
-                    return {x:y for x,(y,z) in rr.iteritems()}
-                return rr[0]
-        
-        elif (rr is not KeyError):
-            ## confirmed:
-            if type(rr) == dict:
-                return {x:y for x,(y,z) in rr.iteritems()}
-            return rr[0]
+        return fuse_entries(rr, rr2, default)
+
+    def _entries(self, table, key, use_hash, allow_pending):
+        """
+        Raw confirmed and pending entries of a key, either KeyError if missing.
+        """
+        if self.stats_enabled:
+            self.the_stats.count(table, 'lookups')
         
-        elif (rr2 is not KeyError):
-            ## pending:
-            if type(rr2) == dict:
-                return {x:y for x,(y,z) in rr2.iteritems()}
-            return rr2[0]
+        if (use_hash is False) or ((self.key_filter_error_rate is not False) and (key not in self.key_filters[table])):
+            ## Never written, no need to materialize the state:
+            if self.stats_enabled and (use_hash is not False):
+                self.the_stats.count(table, 'filtered')
+            rr = KeyError
+        else:
+            rr = self._get_state(table, use_hash).get(key, KeyError)
         
+        if allow_pending and (use_hash is not False):
+            rr2 = self.hh_pending[table].get(key, KeyError)
         else:
-            assert False, 'cannot get here'
+            rr2 = KeyError
+        
+        return rr, rr2
+
+    @timed_op('set_contains')
+    def set_contains(self,
+                     table,                ## Table name.
+                     key,                  ## Key, whose value is a set, see store(as_set_op = True).
+                     member,               ## Set member.
+                     at_hash = 'latest',   ## Consider state as of end of the block with this block hash.
+                     block_offset = 0,     ## Consider state as of the end of the given block offset, relative to at_hash.
+                     allow_pending = True, ## Consider pending transactions, depending on nonces & timeouts set at store().
+                     ):
+        """
+        True if `member` is present in the set, in O(log n). Unlike lookup(), set accessors don't copy the set.
+        """
+        with self.the_lock:
+            use_hash = self._resolve_lookup_hash(at_hash, block_offset)
+            return fused_set_contains(*self._entries(table, key, use_hash, allow_pending) + (member,))
+
+    @timed_op('set_cardinality')
+    def set_cardinality(self,
+                        table,                ## Table name.
+                        key,                  ## Key, whose value is a set.
+                        at_hash = 'latest',   ## Consider state as of end of the block with this block hash.
+                        block_offset = 0,     ## Consider state as of the end of the given block offset, relative to at_hash.
+                        allow_pending = True, ## Consider pending transactions, depending on nonces & timeouts set at store().
+                        ):
+        """
+        Number of present members of the set, excluding removed ones. O(1), plus O(pending writes to this key).
+        """
+        with self.the_lock:
+            use_hash = self._resolve_lookup_hash(at_hash, block_offset)
+            return fused_set_cardinality(*self._entries(table, key, use_hash, allow_pending))
+
+    @timed_op('iter_set_members')
+    def iter_set_members(self,
+                         table,                ## Table name.
+                         key,                  ## Key, whose value is a set.
+                         at_hash = 'latest',   ## Consider state as of end of the block with this block hash.
+                         block_offset = 0,     ## Consider state as of the end of the given block offset, relative to at_hash.
+                         allow_pending = True, ## Consider pending transactions, depending on nonces & timeouts set at store().
+                         ):
+        """
+        Lazily yield present members of the set. Like iter_items(), unaffected by writes after the call.
+        """
+        with self.the_lock:
+            use_hash = self._resolve_lookup_hash(at_hash, block_offset)
+            return iter_fused_set_members(*self._entries(table, key, use_hash, allow_pending))
 
     def iterate_items(self,
                       table,                ## Table name.
@@ -525,38 +2075,70 @@ class StateManager:
                       allow_pending = True, ## Consider pending transactions, depending on nonces & timeouts set at store().
                       ):
         """
-        Iterate items in a table.
+        Iterate items in a table. Returns a list, see iter_items() to stream them instead.
         """
         print ('iterate_items', table, at_hash, block_offset, allow_pending)
-
-        if at_hash == 'latest':
-            if self.latest_hash is False:
-                return []
-            #at_hash = self.latest_hash[1]
-            at_hash = self.head_block_hash
-        
-        k1 = self.hh[table][at_hash]['s'].keys()
-        k2 = self.hh_pending[table].keys()
         
-        rr = []
-        for kk in set(k1).union(k2):
-            try:
-                vv = self.lookup(table,
-                                 kk,
-                                 at_hash = at_hash,
-                                 block_offset = block_offset,
-                                 allow_pending = allow_pending,
-                                 )
-            except KeyError:
-                continue
-            rr.append((kk, vv))
+        return list(self.iter_items(table,
+                                    at_hash = at_hash,
+                                    block_offset = block_offset,
+                                    allow_pending = allow_pending,
+                                    ))
+
+    @timed_op('iter_items')
+    def iter_items(self,
+                   table,                ## Table name.
+                   at_hash = 'latest',   ## Consider state as of end of the block with this block hash.
+                   block_offset = 0,     ## Consider state as of the end of the given block offset, relative to at_hash.
+                   allow_pending = True, ## Consider pending transactions, depending on nonces & timeouts set at store().
+                   prefix = False,       ## Only yield string keys starting with this prefix.
+                   ):
+        """
+        Lazily yield (key, value) items of a table, same values as lookup() would return for each key.
         
-        return rr
+        The block and offset are resolved once, when called. Since states are persistent, the generator keeps
+        iterating the states as of that call, unaffected by later writes.
+        """
+        with self.the_lock:
             
-    
+            use_hash = self._resolve_lookup_hash(at_hash, block_offset)
+            
+            if use_hash is False:
+                return iter([])
+            
+            confirmed = self._get_state(table, use_hash)
+            
+            if allow_pending:
+                pending = self.hh_pending[table]
+            else:
+                pending = EMPTY_MAP
+        
+        return iter_fused_items(confirmed, pending, prefix)
+
+    def enable_stats(self, enabled = True):
+        """ Start or stop collecting stats. Stats collected so far are kept. """
+        self.stats_enabled = enabled
+
+    def stats(self):
+        """
+        Snapshot of stats collected while enabled, since the last reset_stats(), as a dict of:
+        - tables: {table:{'stores', 'lookups', 'misses', 'filtered'}}. `filtered` lookups skipped reading state due to
+                  the key filters, `misses` found the key neither confirmed nor pending.
+        - ops: {op:{'count', 'total_time', 'max_time', 'histogram'}}, latency of each public method, plus
+               `check_block_loaded` and `apply_block`. Histograms are {max_micros:count}, with power of 2 buckets.
+        - offset_walks: {num_hops:count}, ancestor index hops of block_offset resolutions. `offset_cached` counts those
+                        already resolved for their block.
+        - resolutions: how lookups were resolved, {'confirmed', 'pending', 'missing', 'set'}.
+        - check_block_loaded: {'calls', 'already_loaded', 'blocks_applied'}.
+        """
+        return self.the_stats.snapshot()
+
+    def reset_stats(self):
+        self.the_stats.reset()
+
 
                         
-def test_state():
+def make_test_blocks():
     ## genesis parentHash = '0x0000000000000000000000000000000000000000000000000000000000000000'
     
     blocks = [{'number':1,
@@ -604,96 +2186,110 @@ def test_state():
                'event_log': [11, 12],
                },
               ]
+    return blocks
     
-    
-    class MockApp:
-        def __init__(self, sdb, bcc):
-            self.sdb = sdb
-            self.calls = []
-            bcc.setup_event_callbacks(log_handlers = {'DEFAULT':self.logic_callback},
-                                      simulate_handlers = {'DEFAULT':self.simulate_pending_callback},
-                                      )
-            sdb.setup_tables(table_names = ['table1'])
-        
-        def simulate_pending_callback(self,
-                                      args_sig,
-                                      args,
-                                      *_1, **_2):
-            print ('simulate_pending_callback()')
-            return [{"type": "mined", 
-                     "data": args[0], ## TODO: need to solidity-encode this string, or not?
-                     "topics": [topic_id], 
-                     "blockHash": None,
-                     "transactionHash": None,
-                     }]
-            
-        def logic_callback(self, log, *args, **kw):
-            print ('logic_callback()', log)
-            
-            self.calls.append(log)
-            
-            cur_hash = log['blockHash']
-            
-            action = log['data'] ## parse action(s) from data
-            
-            prev = sdb.lookup('table1',
-                              'k',
-                              at_hash = cur_hash,
-                              default = 0,
-                              )
-
-            sdb.store('table1',
-                      'k',
-                      action + prev,
-                      cur_hash = cur_hash,
-                      )
-            
-    class MockBlockchain:
-        def __init__(self):
-            self.yielded = []
-            self.block_lookup = {x['number']:x for x in blocks if x['hash'] != 'h4'} ## TODO
-            self.blocks_h = {x['hash']:x for x in blocks}
-            
-        def get_block_by_hash_callback(self, block_hash):
-            print ('get_block_by_hash_callback', block_hash,)
-            return self.blocks_h[block_hash]
-
-        def get_logs_by_block_num_callback(self, block_num):
-            print ('get_logs_by_block_num_callback', block_num)
-            the_block = self.block_lookup[block_num]
-            for cc, val in enumerate(the_block['event_log']):
-                self.yielded.append(val)
-                yield {'blockHash':the_block['hash'],
-                       'blockNumber':block_num,
-                       'data':val,
-                       'logIndex':cc,
-                       }
-
-        def get_latest_block_callback(self):
-            print ('get_latest_block_callback')
-            return blocks[-1]
-
-        def setup_event_callbacks(self,
-                                  log_handlers,
-                                  simulate_handlers,
-                                  ):
-            self.log_handlers = log_handlers
-            self.simulate_handlers = simulate_handlers
 
-        def logic_callback(self, *args, **kw):
-            self.log_handlers['DEFAULT'](*args, **kw)
-        
-        def simulate_pending(self, *args, **kw):
-            self.simulate_handlers['DEFAULT'](*args, **kw)
+class MockApp:
+    def __init__(self, sdb, bcc):
+        self.sdb = sdb
+        self.calls = []
+        bcc.setup_event_callbacks(log_handlers = {'DEFAULT':self.logic_callback},
+                                  simulate_handlers = {'DEFAULT':self.simulate_pending_callback},
+                                  )
+        sdb.setup_tables(table_names = ['table1'])
+
+    def simulate_pending_callback(self,
+                                  args_sig,
+                                  args,
+                                  *_1, **_2):
+        print ('simulate_pending_callback()')
+        return [{"type": "mined", 
+                 "data": args[0], ## TODO: need to solidity-encode this string, or not?
+                 "topics": [topic_id], 
+                 "blockHash": None,
+                 "transactionHash": None,
+                 }]
+
+    def logic_callback(self, log, *args, **kw):
+        print ('logic_callback()', log)
+
+        self.calls.append(log)
+
+        cur_hash = log['blockHash']
+
+        action = log['data'] ## parse action(s) from data
+
+        prev = self.sdb.lookup('table1',
+                               'k',
+                               at_hash = cur_hash,
+                               default = 0,
+                               )
+
+        self.sdb.store('table1',
+                       'k',
+                       action + prev,
+                       cur_hash = cur_hash,
+                       )
+
+
+class MockBlockchain:
+    def __init__(self, blocks):
+        self.blocks = blocks
+        self.yielded = []
+        self.block_lookup = {x['number']:x for x in blocks if x['hash'] != 'h4'} ## TODO
+        self.blocks_h = {x['hash']:x for x in blocks}
+        self.num_block_calls = 0
+
+    def get_block_by_hash_callback(self, block_hash):
+        print ('get_block_by_hash_callback', block_hash,)
+        self.num_block_calls += 1
+        return self.blocks_h[block_hash]
+
+    def get_block_by_num_callback(self, block_num):
+        print ('get_block_by_num_callback', block_num,)
+        return self.block_lookup.get(block_num)
+
+    def get_logs_by_block_num_callback(self, block_num):
+        print ('get_logs_by_block_num_callback', block_num)
+        the_block = self.block_lookup[block_num]
+        for cc, val in enumerate(the_block['event_log']):
+            self.yielded.append(val)
+            yield {'blockHash':the_block['hash'],
+                   'blockNumber':block_num,
+                   'data':val,
+                   'logIndex':cc,
+                   }
+
+    def get_latest_block_callback(self):
+        print ('get_latest_block_callback')
+        return self.blocks[-1]
+
+    def setup_event_callbacks(self,
+                              log_handlers,
+                              simulate_handlers,
+                              ):
+        self.log_handlers = log_handlers
+        self.simulate_handlers = simulate_handlers
+
+    def logic_callback(self, *args, **kw):
+        self.log_handlers['DEFAULT'](*args, **kw)
+
+    def simulate_pending(self, *args, **kw):
+        self.simulate_handlers['DEFAULT'](*args, **kw)
+
+    def loop_once_blockchain(self):
+        pass
 
-        def loop_once_blockchain(self):
-            pass
+                        
+def test_state(**state_manager_args):
+    
+    blocks = make_test_blocks()
     
     ## Instantiate:
     
-    bcc = MockBlockchain()
+    bcc = MockBlockchain(blocks)
     
-    sdb = StateManager(bcc)
+    sdb = StateManager(bcc, **state_manager_args)
     
     app = MockApp(sdb, bcc)
             
@@ -733,6 +2329,10 @@ def test_state():
     assert cur == expected
 
     print ('ITER', sdb.iterate_items('table1'))
+
+    ## Older block states are unaffected by writes to their descendants:
+    assert sdb.lookup('table1', 'k', at_hash = 'h3') == sum([1, 2, 3, 4, 5, 6])
+    assert sdb.lookup('table1', 'k', at_hash = 'h6') == sum([1, 2, 3, 4, 5, 6, 9, 10, 11, 12])
     
     if False:
         for x in bcc.yielded:
@@ -741,9 +2341,786 @@ def test_state():
         for x in app.calls:
             print ('calls', x)
 
-        for x in sorted(sdb.hh):
-            print x, sdb.hh[x]
+
+def test_state_delta():
+    test_state(state_mode = 'delta', checkpoint_interval = 2, view_cache_size = 2)
+
+
+def test_state_prefetch():
+    test_state(prefetch_window = 3)
+    
+    ## Prefetched data that went stale, e.g. fetched right before a reorg, gets refetched:
+    
+    blocks = make_test_blocks()
+    bcc = MockBlockchain(blocks)
+    stale = {'logs':set([2, 3]), 'headers':set([2]), 'empty':set([5])}
+    
+    ## Block 5's logs are first fetched from an orphaned empty block, right before a reorg back onto h5:
+    get_logs = bcc.get_logs_by_block_num_callback
+    def get_logs_stale(block_num):
+        if block_num in stale['empty']:
+            stale['empty'].remove(block_num)
+            return []
+        if block_num in stale['logs']:
+            stale['logs'].remove(block_num)
+            return [dict(x, blockHash = 'stale') for x in get_logs(block_num)]
+        return get_logs(block_num)
+    bcc.get_logs_by_block_num_callback = get_logs_stale
+    
+    get_block = bcc.get_block_by_num_callback
+    def get_block_stale(block_num):
+        if block_num in stale['headers']:
+            stale['headers'].remove(block_num)
+            return bcc.blocks_h['h1']
+        return get_block(block_num)
+    bcc.get_block_by_num_callback = get_block_stale
+    
+    sdb = StateManager(bcc, prefetch_window = 2)
+    MockApp(sdb, bcc)
+    sdb.loop_once()
+    
+    assert stale == {'logs':set(), 'headers':set(), 'empty':set()}, stale
+    assert sdb.lookup('table1', 'k') == sum([1, 2, 3, 4, 5, 6, 9, 10, 11, 12])
+    assert sdb.lookup('table1', 'k', at_hash = 'h3') == sum([1, 2, 3, 4, 5, 6])
+    
+    pool = sdb.prefetch_pool
+    sdb.close()
+    assert sdb.prefetch_pool is False
+    assert not [x for x in pool._pool if x.is_alive()]
+
+
+def test_state_sqlite():
+    import tempfile, shutil
+    from os.path import join
+    from node_storage import SQLiteStateStorage
+    
+    dd = tempfile.mkdtemp()
+    try:
+        test_state(state_mode = 'delta',
+                   checkpoint_interval = 2,
+                   view_cache_size = 2,
+                   storage = SQLiteStateStorage(join(dd, 'state.db')),
+                   )
+    finally:
+        shutil.rmtree(dd)
+
+
+def test_state_snapshot():
+    import tempfile, shutil
+    from os.path import join
+    
+    dd = tempfile.mkdtemp()
+    fn = join(dd, 'snapshot.pkl')
+    
+    try:
+        blocks = make_test_blocks()
+        bcc = MockBlockchain(blocks)
+        sdb = StateManager(bcc)
+        MockApp(sdb, bcc)
+        sdb.loop_once()
+        
+        assert sdb.save_snapshot(fn, confirm_depth = 1, history = 1) == 'h5'
+        
+        blocks.append({'number':6,
+                       'hash':'h8',
+                       'timestamp': 0,
+                       'parentHash':'h6',
+                       'totalDifficulty':7,
+                       'event_log': [30],
+                       })
+        expected = sum([1, 2, 3, 4, 5, 6, 9, 10, 11, 12, 30])
+        
+        ## Resume, only blocks after the snapshot get processed:
+        
+        bcc = MockBlockchain(blocks)
+        sdb = StateManager(bcc)
+        MockApp(sdb, bcc)
+        assert sdb.load_snapshot(fn) == 'h5'
+        sdb.loop_once()
+        
+        assert sdb.lookup('table1', 'k') == expected
+        assert sdb.lookup('table1', 'k', at_hash = 'h6', block_offset = -2) == sum([1, 2, 3, 4, 5, 6])
+        assert bcc.yielded == [11, 12, 30], bcc.yielded
+        
+        ## Corrupt snapshot, falls back to full replay:
+        
+        with open(fn, 'r+b') as f:
+            f.seek(-3, 2)
+            f.write('xxx')
+        
+        bcc = MockBlockchain(blocks)
+        sdb = StateManager(bcc, state_mode = 'delta', checkpoint_interval = 2)
+        MockApp(sdb, bcc)
+        assert sdb.load_snapshot(fn) is False
+        sdb.loop_once()
+        
+        assert sdb.lookup('table1', 'k') == expected
+        assert bcc.yielded == [1, 2, 3, 4, 5, 6, 9, 10, 11, 12, 30], bcc.yielded
+    finally:
+        shutil.rmtree(dd)
+
+
+def test_state_pruning():
+    for state_manager_args in [{},
+                               {'state_mode':'delta', 'checkpoint_interval':4, 'view_cache_size':2},
+                               ]:
+        blocks = make_test_blocks()
+        bcc = MockBlockchain(blocks)
+        sdb = StateManager(bcc, finality_depth = 3, **state_manager_args)
+        MockApp(sdb, bcc)
+        sdb.loop_once()
+        
+        ## Reorg onto h4, then extend that chain, orphaning h5 & h6:
+        
+        bcc.block_lookup[4] = bcc.blocks_h['h4']
+        parent_hash = 'h4'
+        for num in xrange(5, 13):
+            block = {'number':num,
+                     'hash':'c%d' % num,
+                     'timestamp': 0,
+                     'parentHash':parent_hash,
+                     'totalDifficulty':num + 2,
+                     'event_log': [num],
+                     }
+            bcc.block_lookup[num] = block
+            bcc.blocks_h[block['hash']] = block
+            blocks.append(block)
+            parent_hash = block['hash']
+        
+        sdb.loop_once()
+        
+        expected = sum([1, 2, 3, 4, 5, 6, 7, 8]) + sum(range(5, 13))
+        assert sdb.lookup('table1', 'k') == expected
+        assert sdb.lookup('table1', 'k', block_offset = -3) == expected - sum([10, 11, 12])
+        
+        ## Only the root and its descendants are left. In delta mode, the root is the newest finalized checkpoint:
+        if sdb.state_mode == 'full':
+            root_num = 9
+        else:
+            root_num = 8
+        
+        assert sdb.pruned_root_hash == 'c%d' % root_num, sdb.pruned_root_hash
+        assert sorted(sdb.block_hash_to_block_num.values()) == range(root_num, 13), sdb.block_hash_to_block_num
+        for block_hash in ['h1', 'h3', 'h5', 'h6', 'c%d' % (root_num - 1)]:
+            assert not sdb._has_block_state(block_hash), block_hash
+        
+        ## Pruning never writes states, the root was already a checkpoint:
+        assert sdb.storage.get_block('table1', sdb.pruned_root_hash)[1], sdb.pruned_root_hash
+        assert not sdb.storage.get_block('table1', 'c%d' % (root_num + 1))[1] or (sdb.state_mode == 'full')
+        
+        for kw in [{'block_offset':-(13 - root_num)},
+                   {'at_hash':'h6'},
+                   ]:
+            try:
+                sdb.lookup('table1', 'k', **kw)
+                assert False, ('expected PREVIOUSLY_PRUNED_REQUESTED_BLOCK', kw)
+            except AssertionError as e:
+                assert 'PREVIOUSLY_PRUNED_REQUESTED_BLOCK' in str(e), e
+
+
+def test_ancestor_index():
+    blocks = []
+    parent_hash = 'b0'
+    for num in xrange(1, 101):
+        blocks.append({'number':num,
+                       'hash':'b%d' % num,
+                       'timestamp': 0,
+                       'parentHash':parent_hash,
+                       'totalDifficulty':num,
+                       'event_log': [num],
+                       })
+        parent_hash = blocks[-1]['hash']
+    
+    bcc = MockBlockchain(blocks)
+    sdb = StateManager(bcc)
+    MockApp(sdb, bcc)
+    sdb.loop_once()
+    
+    for at_num in [1, 2, 37, 64, 100]:
+        for num_back in [0, 1, 2, 5, 31, 32, 33, 63, 99, 150]:
+            expected = sum(range(1, max(1, at_num - num_back) + 1))
+            for x in xrange(2): ## Second time is from offset_cache.
+                got = sdb.lookup('table1', 'k', at_hash = 'b%d' % at_num, block_offset = -num_back)
+                assert got == expected, (at_num, num_back, got, expected)
+    
+    assert sdb.ancestor_index['b100'][0] == 99
+    assert sdb.ancestor_index['b100'][1] == ['b99', 'b98', 'b96', 'b92', 'b84', 'b68', 'b36']
+
+
+def test_loaded_blocks_fast_path():
+    bcc = MockBlockchain(make_test_blocks())
+    sdb = StateManager(bcc)
+    MockApp(sdb, bcc)
+    sdb.loop_once()
+    
+    assert sdb.loaded_blocks == set(['h1', 'h2', 'h3', 'h5', 'h6']), sdb.loaded_blocks
+    
+    num_block_calls = bcc.num_block_calls
+    
+    assert sdb.lookup('table1', 'k') == sum([1, 2, 3, 4, 5, 6, 9, 10, 11, 12])
+    assert sdb.lookup('table1', 'k', at_hash = 'h3', block_offset = -1) == sum([1, 2, 3, 4])
+    assert sdb.lookup_many([('table1', 'k')], at_hash = 'h5') == [sum([1, 2, 3, 4, 5, 6, 9, 10])]
+    sdb.iterate_items('table1')
+    sdb.store('table1', 'x', 1, cur_hash = 'h6')
+    
+    ## No blockchain calls for already loaded blocks:
+    assert bcc.num_block_calls == num_block_calls, (bcc.num_block_calls, num_block_calls)
+    
+    ## Other threads never drive block loading:
+    errors = []
+    def web_lookup():
+        try:
+            sdb.lookup('table1', 'k', at_hash = 'h4')
+        except AssertionError as e:
+            errors.append(e)
+    t = Thread(target = web_lookup)
+    t.start()
+    t.join()
+    assert errors and ('BLOCK_NOT_LOADED' in str(errors[0])), errors
+    assert bcc.num_block_calls == num_block_calls
+
+
+def test_lookup_store_many():
+    bcc = MockBlockchain(make_test_blocks())
+    sdb = StateManager(bcc)
+    MockApp(sdb, bcc)
+    
+    assert sdb.lookup_many([('table1', 'k'), ('table1', 'x')], default = 0) == [0, 0]
+    
+    sdb.loop_once()
+    
+    assert sdb.store_many([('table1', 'a', 1, False),
+                           ('table1', 'b', 2, 5),
+                           ('table1', 'b', 3, 4), ## Older nonce, ignored.
+                           ],
+                          cur_hash = 'h6',
+                          ) == [True, True, False]
+    assert sdb.store_many([('table1', 's', 'm1', False),
+                           ('table1', 's', 'm2', False),
+                           ],
+                          cur_hash = 'h6',
+                          as_set_op = True,
+                          is_pending = True,
+                          ) == [True, True]
+    
+    assert sdb.lookup_many([('table1', 'a'), ('table1', 'b'), ('table1', 's'), ('table1', 'x')],
+                           default = None,
+                           ) == [1, 2, {'m1':True, 'm2':True}, None]
+    assert sdb.lookup_many([('table1', 'k'), ('table1', 'a')],
+                           block_offset = -2,
+                           default = None,
+                           ) == [sum([1, 2, 3, 4, 5, 6]), None]
+    try:
+        sdb.lookup_many([('table1', 'a'), ('table1', 'x')])
+        assert False, 'expected KeyError'
+    except KeyError:
+        pass
+
+
+def test_iter_items():
+    bcc = MockBlockchain(make_test_blocks())
+    sdb = StateManager(bcc)
+    MockApp(sdb, bcc)
+    
+    assert list(sdb.iter_items('table1')) == []
+    
+    sdb.loop_once()
+    
+    sdb.store_many([('table1', 'v|a', 1, 1),
+                    ('table1', 'v|b', 2, 1),
+                    ],
+                   cur_hash = 'h6',
+                   )
+    sdb.store_many([('table1', 'v|b', 3, 2),
+                    ('table1', 'v|c', 4, 1),
+                    ('table1', 'x', 5, 1),
+                    ],
+                   cur_hash = 'h6',
+                   is_pending = True,
+                   )
+    
+    ## Later writes don't affect an already started iteration:
+    xx = sdb.iter_items('table1', prefix = 'v|')
+    sdb.store('table1', 'v|d', 6, cur_hash = 'h6')
+    
+    assert sorted(xx) == [('v|a', 1), ('v|b', 3), ('v|c', 4)]
+    assert sorted(sdb.iter_items('table1', prefix = 'v|', allow_pending = False)) == [('v|a', 1), ('v|b', 2), ('v|d', 6)]
+    assert sorted(sdb.iter_items('table1', block_offset = -2)) == [('k', sum([1, 2, 3, 4, 5, 6])), ('v|b', 3), ('v|c', 4), ('x', 5)]
+    assert sorted(sdb.iterate_items('table1')) == sorted(sdb.iter_items('table1'))
+
+
+def test_indexes():
+    bcc = MockBlockchain(make_test_blocks())
+    sdb = StateManager(bcc)
+    MockApp(sdb, bcc)
+    sdb.setup_tables(table_names = ['table1', 'people'],
+                     indexes = {'people_by_city':('people', lambda key, value:value['city'])},
+                     )
+    sdb.loop_once()
+    
+    sdb.store_many([('people', 'ann', {'city':'oslo'}, 1),
+                    ('people', 'bob', {'city':'oslo'}, 1),
+                    ('people', 'cat', {'city':'rome'}, 1),
+                    ],
+                   cur_hash = 'h6',
+                   )
+    
+    index_keys = lambda *args, **kw: sorted(k for k, v in sdb.index_lookup('people_by_city', *args, **kw))
+    
+    assert sorted(sdb.index_lookup('people_by_city', 'oslo')) == [('ann', {'city':'oslo'}), ('bob', {'city':'oslo'})]
+    assert index_keys('paris') == []
+    
+    ## Pending move:
+    sdb.store('people', 'bob', {'city':'rome'}, nonce = 2, cur_hash = 'h6', is_pending = True)
+    assert index_keys('rome') == ['bob', 'cat']
+    assert index_keys('oslo') == ['ann']
+    assert index_keys('oslo', allow_pending = False) == ['ann', 'bob']
+    
+    ## Confirmed move:
+    sdb.store('people', 'ann', {'city':'rome'}, nonce = 2, cur_hash = 'h6')
+    assert index_keys('oslo', allow_pending = False) == ['bob']
+    assert index_keys('rome', allow_pending = False) == ['ann', 'cat']
+    
+    ## Per block:
+    assert index_keys('rome', block_offset = -1) == ['bob']
+
+
+def test_pending_pool():
+    blocks = make_test_blocks()
+    bcc = MockBlockchain(blocks)
+    sdb = StateManager(bcc, pending_timeout = 2)
+    MockApp(sdb, bcc)
+    sdb.loop_once()
+    
+    get = lambda key: sdb.lookup('table1', key, default = None)
+    
+    sdb.store('table1', 'p', 1, nonce = 5, sender = 'u1', is_pending = True, is_pending_timeout = 100)
+    sdb.store('table1', 'q', 2, nonce = 6, sender = 'u1', is_pending = True, is_pending_timeout = 100)
+    sdb.store('table1', 'd', 3, nonce = 1, sender = 'u2', is_pending = True, is_pending_timeout = 100,
+              is_pending_dependent_on_hash = 'h6')
+    sdb.store('table1', 't', 4, nonce = 1, sender = 'u3', is_pending = True)
+    sdb.store('table1', 't', 5, nonce = 2, sender = 'u3', is_pending = True)
+    assert [get(x) for x in ['p', 'q', 'd', 't']] == [1, 2, 3, 5]
+    assert len(sdb.pending_pool) == 4
+    
+    ## Replaced:
+    sdb.store('table1', 'r', 6, nonce = 7, sender = 'u1', is_pending = True, is_pending_timeout = 100,
+              is_pending_replaces_nonce = 6)
+    assert (get('q'), get('r')) == (None, 6)
+    
+    ## Confirmed:
+    sdb.store('table1', 'p', 1, nonce = 5, sender = 'u1', cur_hash = 'h6')
+    assert 'p' not in sdb.hh_pending['table1']
+    assert get('p') == 1
+    assert len(sdb.pending_pool) == 3
+    
+    ## Same options for batches:
+    assert sdb.store_many([('table1', 'm', 7, 1), ('table1', 'n', 8, 2)], is_pending = True, sender = 'u4',
+                          is_pending_timeout = 100) == [True, True]
+    assert sdb.store_many([('table1', 'o', 9, 3)], is_pending = True, sender = 'u4', is_pending_timeout = 100,
+                          is_pending_replaces_nonce = 2, is_pending_dependent_on_hash = 'h6') == [True]
+    assert [get(x) for x in ['m', 'n', 'o']] == [7, None, 9]
+    assert len(sdb.pending_pool) == 5
+    
+    ## Reorg drops writes dependent on h6, new blocks time out the rest:
+    bcc.block_lookup[4] = bcc.blocks_h['h4']
+    parent_hash = 'h4'
+    for num in [5, 6, 7, 8]:
+        block = {'number':num,
+                 'hash':'c%d' % num,
+                 'timestamp': 0,
+                 'parentHash':parent_hash,
+                 'totalDifficulty':num + 2,
+                 'event_log': [num],
+                 }
+        bcc.block_lookup[num] = block
+        bcc.blocks_h[block['hash']] = block
+        blocks.append(block)
+        parent_hash = block['hash']
+    
+    sdb.loop_once()
+    
+    assert [get(x) for x in ['d', 't', 'r', 'm', 'o']] == [None, None, 6, 7, None]
+    assert sdb.hh_pending['table1'] == {'r':(6, 7), 'm':(7, 1)}
+    assert len(sdb.pending_pool) == 2
+    assert sdb.store_many([('table1', 'x', 1, False)], is_pending = True, is_pending_dependent_on_hash = 'h6') == [False]
+    
+    assert sdb.store('table1', 'x', 1, is_pending = True, is_pending_dependent_on_hash = 'h6') is False
+
+
+def test_head_view():
+    bcc = MockBlockchain(make_test_blocks())
+    sdb = StateManager(bcc)
+    MockApp(sdb, bcc)
+    sdb.setup_tables(table_names = ['table1', 'people'],
+                     indexes = {'people_by_city':('people', lambda key, value:value['city'])},
+                     )
+    assert sdb.head_view.lookup('table1', 'k', default = None) is None
+    
+    ## Mid-block, readers still see the whole previous block, never a partially applied one:
+    seen = []
+    logic_callback = bcc.log_handlers['DEFAULT']
+    def watch_callback(log, *args, **kw):
+        seen.append((log['blockHash'], sdb.head_view.block_hash, sdb.head_view.lookup('table1', 'k', default = 0)))
+        logic_callback(log, *args, **kw)
+    bcc.log_handlers['DEFAULT'] = watch_callback
+    
+    sdb.loop_once()
+    
+    assert seen[2:4] == [('h2', 'h1', 3), ('h2', 'h1', 3)], seen
+    
+    ## Other threads' lookup() of 'latest' wait for the block transaction, and until the head block is marked
+    ## loaded, they read the last published head view's block:
+    seen_other = []
+    def other_lookup():
+        seen_other.append(sdb.lookup('table1', 'k', default = 0))
+    sdb.head_block_hash = 'h7'
+    tt = Thread(target = other_lookup)
+    tt.start()
+    tt.join()
+    sdb.head_block_hash = 'h6'
+    assert seen_other == [63], seen_other
+    
+    view = sdb.head_view
+    assert (view.block_hash, view.block_num) == ('h6', 5)
+    assert view.lookup('table1', 'k') == sdb.lookup('table1', 'k') == 63
+    
+    ## Pending writes show up right away, in a new view. Old views are unaffected:
+    sdb.store('people', 'ann', {'city':'oslo'}, nonce = 1, is_pending = True)
+    assert sdb.head_view is not view
+    assert view.lookup('people', 'ann', default = None) is None
+    assert sdb.head_view.lookup('people', 'ann') == {'city':'oslo'}
+    assert sdb.head_view.lookup('people', 'ann', default = None, allow_pending = False) is None
+    assert sdb.head_view.index_lookup('people_by_city', 'oslo') == [('ann', {'city':'oslo'})]
+    assert list(sdb.head_view.iter_items('people')) == [('ann', {'city':'oslo'})]
+    assert sdb.head_view.lookup_many([('table1', 'k'), ('people', 'bob')], default = None) == [63, None]
+
+
+def test_block_transaction():
+    for state_manager_args in [{}, {'state_mode':'delta', 'checkpoint_interval':4}]:
+        bcc = MockBlockchain(make_test_blocks())
+        sdb = StateManager(bcc, **state_manager_args)
+        MockApp(sdb, bcc)
+        sdb.setup_tables(table_names = ['table1', 'seen'])
+        
+        ## Fails on the 2nd log of h3, after its 1st log was applied:
+        fail_on = [6]
+        logic_callback = bcc.log_handlers['DEFAULT']
+        def failing_callback(log, *args, **kw):
+            if log['data'] in fail_on:
+                fail_on.remove(log['data'])
+                assert False, 'BLOCK_FAILED'
+            ## Read-your-writes within the block:
+            if log['logIndex'] == 1:
+                assert sdb.lookup('seen', log['blockHash'], default = None, allow_pending = False) == log['data'] - 1
+            sdb.store('seen', log['blockHash'], log['data'], cur_hash = log['blockHash'])
+            sdb.store('table1', 'p' + str(log['data']), 1, is_pending = True)
+            logic_callback(log, *args, **kw)
+        bcc.log_handlers['DEFAULT'] = failing_callback
+        
+        try:
+            sdb.loop_once()
+            assert False, 'expected BLOCK_FAILED'
+        except AssertionError as e:
+            assert 'BLOCK_FAILED' in str(e), e
+        
+        ## Nothing of h3 is left, not even its pending writes:
+        assert sdb.head_block_hash == 'h2'
+        assert 'h3' not in sdb.loaded_blocks
+        assert not sdb._has_block_state('h3')
+        assert sorted(sdb.hh_pending['table1']) == ['p1', 'p2', 'p3', 'p4']
+        assert sdb.lookup('table1', 'k') == 10
+        
+        ## Applied from scratch next time:
+        sdb.loop_once()
+        assert sdb.lookup('table1', 'k', at_hash = 'h3') == 21
+        assert sdb.lookup('seen', 'h3', at_hash = 'h3') == 6
+        assert sdb.lookup('table1', 'k') == 63
+
+
+def test_batch_callbacks():
+    bcc = MockBlockchain(make_test_blocks())
+    sdb = StateManager(bcc)
+    app = MockApp(sdb, bcc)
+    
+    batches = []
+    ends = []
+    def logic_batch_callback(logs, is_pending, is_noop):
+        assert not is_pending
+        batches.append([log['data'] for log in logs])
+        for log in logs:
+            app.logic_callback(log)
+    def end_block_callback(block_hash, block_num):
+        ends.append((block_hash, block_num, sdb.lookup('table1', 'k', at_hash = block_hash)))
+    bcc.logic_batch_callback = logic_batch_callback
+    bcc.end_block_callback = end_block_callback
+    
+    sdb.loop_once()
+    
+    assert batches == [[1, 2], [3, 4], [5, 6], [9, 10], [11, 12]], batches
+    assert ends == [('h1', 1, 3), ('h2', 2, 10), ('h3', 3, 21), ('h5', 4, 40), ('h6', 5, 63)], ends
+    assert len(app.calls) == 10
+
+
+def test_key_filters():
+    bcc = MockBlockchain(make_test_blocks())
+    sdb = StateManager(bcc, state_mode = 'delta', checkpoint_interval = 4)
+    MockApp(sdb, bcc)
+    sdb.loop_once()
+    
+    materialized = []
+    get_state = sdb._get_state
+    def counting_get_state(table, block_hash):
+        materialized.append((table, block_hash))
+        return get_state(table, block_hash)
+    sdb._get_state = counting_get_state
+    
+    ## Never written, answered without materializing any state:
+    assert sdb.lookup('table1', 'missing', default = None) is None
+    assert sdb.lookup_many([('table1', 'x%d' % c) for c in xrange(100)], block_offset = -2, default = 0) == [0] * 100
+    assert materialized == [], materialized
+    
+    assert sdb.lookup('table1', 'k', block_offset = -2) == 21
+    assert materialized == [('table1', 'h3')], materialized
+    
+    ## Pending writes aren't in the filter, but are still found:
+    sdb.store('table1', 'p', 1, is_pending = True)
+    assert sdb.lookup('table1', 'p') == 1
+    assert 'p' not in sdb.key_filters['table1']
+
+
+def test_stats():
+    bcc = MockBlockchain(make_test_blocks())
+    sdb = StateManager(bcc, stats_enabled = True)
+    MockApp(sdb, bcc)
+    sdb.loop_once()
+    
+    st = sdb.stats()
+    assert st['check_block_loaded']['blocks_applied'] == st['ops']['apply_block']['count'] > 0, st
+    assert st['tables']['table1']['stores'] == st['ops']['store']['count'] > 0, st
+    
+    sdb.reset_stats()
+    assert sdb.stats()['ops'] == {}
+    
+    sdb.lookup('table1', 'k')
+    sdb.lookup('table1', 'missing', default = None)
+    sdb.lookup('table1', 'k', block_offset = -3)
+    sdb.lookup('table1', 'k', block_offset = -3)
+    sdb.store('table1', 'p', 1, is_pending = True)
+    sdb.lookup('table1', 'p')
+    
+    st = sdb.stats()
+    assert st['tables'] == {'table1':{'stores':1, 'lookups':5, 'misses':1, 'filtered':2}}, st['tables']
+    assert st['resolutions'] == {'confirmed':3, 'pending':1, 'missing':1, 'set':0}, st['resolutions']
+    assert (st['offset_walks'], st['offset_cached']) == ({2:1}, 1), (st['offset_walks'], st['offset_cached'])
+    assert st['ops']['lookup']['count'] == sum(st['ops']['lookup']['histogram'].values()) == 5
+    
+    ## Nothing recorded while disabled:
+    sdb.enable_stats(False)
+    sdb.lookup('table1', 'k')
+    assert sdb.stats()['ops']['lookup']['count'] == 5
+
+
+def test_view_cache_per_table():
+    bcc = MockBlockchain(make_test_blocks())
+    sdb = StateManager(bcc, state_mode = 'delta', checkpoint_interval = 8, view_cache_size = 2, key_filter_error_rate = False)
+    MockApp(sdb, bcc)
+    sdb.setup_tables(table_names = ['table1', 'table2', 'table3', 'table4'])
+    sdb.loop_once()
+    
+    ## Reading every table at two older blocks keeps them all cached, not just the last `view_cache_size`:
+    for block_offset in [-1, -2]:
+        for table in sdb.table_names:
+            sdb.lookup(table, 'k', block_offset = block_offset, default = None)
+    for block_offset in [-1, -2]:
+        for table in sdb.table_names:
+            assert (table, sdb._resolve_offset(sdb.head_block_hash, block_offset)) in sdb.view_cache, (table, block_offset)
+
+
+def test_set_accessors():
+    bcc = MockBlockchain(make_test_blocks())
+    sdb = StateManager(bcc)
+    MockApp(sdb, bcc)
+    sdb.setup_tables(table_names = ['table1', 'voters'])
+    sdb.loop_once()
+    
+    for c, member in enumerate(['u1', 'u2', 'u3']):
+        sdb.store('voters', 'post1', member, nonce = 1, as_set_op = True, cur_hash = 'h6')
+    sdb.store('voters', 'post1', 'u2', nonce = 2, as_set_op = True, set_remove = True, cur_hash = 'h6')
+    
+    ## Pending layer: removes u1, re-adds u2, adds u4, and an old-nonce remove of u3 that loses:
+    sdb.store('voters', 'post1', 'u1', nonce = 3, as_set_op = True, set_remove = True, is_pending = True)
+    sdb.store('voters', 'post1', 'u2', nonce = 3, as_set_op = True, is_pending = True)
+    sdb.store('voters', 'post1', 'u4', nonce = 3, as_set_op = True, is_pending = True)
+    sdb.store('voters', 'post1', 'u3', nonce = 0, as_set_op = True, set_remove = True, is_pending = True)
+    
+    assert sdb.set_cardinality('voters', 'post1', allow_pending = False) == 2
+    assert sorted(sdb.iter_set_members('voters', 'post1', allow_pending = False)) == ['u1', 'u3']
+    assert sdb.set_cardinality('voters', 'post1') == 3
+    assert sorted(sdb.iter_set_members('voters', 'post1')) == ['u2', 'u3', 'u4']
+    assert [sdb.set_contains('voters', 'post1', x) for x in ['u1', 'u2', 'u3', 'u4', 'u5']] == [False, True, True, True, False]
+    assert sdb.set_cardinality('voters', 'missing') == 0
+    assert sdb.head_view.set_cardinality('voters', 'post1') == 3
+    assert sdb.head_view.set_contains('voters', 'post1', 'u2')
+    
+    ## lookup() fuses per member too:
+    assert sdb.lookup('voters', 'post1') == {'u1':False, 'u2':True, 'u3':True, 'u4':True}
+
+
+def test_tombstone_compaction():
+    ## Set ops per block number: (key, member, nonce, set_remove):
+    ops = {2:[('post1', 'u1', 1, False), ('post1', 'u2', 1, False), ('post1', 'u3', 1, False), ('post1', 'u4', 1, False),
+              ('post2', 'u1', 1, False)],
+           3:[('post1', 'u1', 2, True), ('post2', 'u1', 2, True)],
+           5:[('post1', 'u2', 3, True)],
+           6:[('post1', 'u3', 4, True)],
+           }
+    
+    for state_manager_args in [{}, {'state_mode':'delta', 'checkpoint_interval':3, 'view_cache_size':2}]:
+        blocks = []
+        bcc = MockBlockchain(blocks)
+        sdb = StateManager(bcc, finality_depth = 3, compaction_batch = 1, **state_manager_args)
+        MockApp(sdb, bcc)
+        sdb.setup_tables(table_names = ['table1', 'voters'])
+        
+        def logic_callback(log, *args, **kw):
+            for key, member, nonce, set_remove in ops.get(log['blockNumber'], []):
+                sdb.store('voters', key, member, nonce = nonce, as_set_op = True, set_remove = set_remove,
+                          cur_hash = log['blockHash'])
+        bcc.log_handlers['DEFAULT'] = logic_callback
+        
+        def add_blocks(nums):
+            for num in nums:
+                block = {'number':num,
+                         'hash':'b%d' % num,
+                         'timestamp': 0,
+                         'parentHash':'b%d' % (num - 1),
+                         'totalDifficulty':num,
+                         'event_log': [num],
+                         }
+                bcc.block_lookup[num] = block
+                bcc.blocks_h[block['hash']] = block
+                blocks.append(block)
+        
+        raw = lambda key: sdb._get_state('voters', sdb.head_block_hash)[key]
+        
+        ## Root b3 is reached, but only one of the 2 keys removed from at b3 is compacted per block:
+        add_blocks(xrange(1, 7))
+        sdb.loop_once()
+        assert sdb.pruned_root_num == 3
+        assert raw('post1') == {'u2':(False, 3), 'u3':(False, 4), 'u4':(True, 1)}, raw('post1')
+        assert raw('post2') == {'u1':(False, 2)}
+        
+        add_blocks([7])
+        sdb.loop_once()
+        assert raw('post2') == {}
+        
+        ## Removals of b5 are final at b8, b6's are not yet. In delta mode, the root stays at the b3 checkpoint until
+        ## the b6 one is final:
+        add_blocks([8])
+        sdb.loop_once()
+        if sdb.state_mode == 'full':
+            assert raw('post1') == {'u3':(False, 4), 'u4':(True, 1)}, raw('post1')
+        else:
+            assert sdb.pruned_root_num == 3
+            assert raw('post1') == {'u2':(False, 3), 'u3':(False, 4), 'u4':(True, 1)}, raw('post1')
+        assert sorted(sdb.iter_set_members('voters', 'post1')) == ['u4']
+        assert sdb.set_cardinality('voters', 'post1', block_offset = -3) == 2
+        
+        ## Snapshots keep compaction as of the snapshot block:
+        import tempfile, shutil
+        from os.path import join
+        dd = tempfile.mkdtemp()
+        try:
+            fn = join(dd, 'snapshot.pkl')
+            assert sdb.save_snapshot(fn, confirm_depth = 2, history = 1) == 'b6'
+            bcc2 = MockBlockchain(blocks)
+            sdb2 = StateManager(bcc2, finality_depth = 3, **state_manager_args)
+            MockApp(sdb2, bcc2)
+            sdb2.setup_tables(table_names = ['table1', 'voters'])
+            assert sdb2.load_snapshot(fn) == 'b6'
+            assert list(sdb2.compaction_queue) == list(sdb.compaction_queue), sdb2.compaction_queue
+            assert sdb2.compacted_nonces == sdb.compacted_nonces, sdb2.compacted_nonces
+            if sdb.state_mode == 'full':
+                assert list(sdb2.compaction_queue) == [(6, 'voters', 'post1', 'u3')], sdb2.compaction_queue
+                assert sorted(sdb2.compacted_nonces) == [('voters', 'post1', 'u1'), ('voters', 'post1', 'u2'),
+                                                         ('voters', 'post2', 'u1')]
+        finally:
+            shutil.rmtree(dd)
+        
+        add_blocks([9, 10])
+        sdb.loop_once()
+        assert raw('post1') == {'u4':(True, 1)}, raw('post1')
+        assert not sdb.compaction_queue
+        assert sdb.compacted_nonces == {('voters', 'post1', 'u1'):(2, 3),
+                                        ('voters', 'post1', 'u2'):(3, 5),
+                                        ('voters', 'post1', 'u3'):(4, 6),
+                                        ('voters', 'post2', 'u1'):(2, 3),
+                                        }, sdb.compacted_nonces
+        
+        ## Replays of old nonces after compaction don't re-add members, newer nonces do:
+        ops[11] = [('post1', 'u2', 1, False), ('post1', 'u3', 4, False), ('post2', 'u1', 5, False)]
+        add_blocks([11])
+        sdb.loop_once()
+        assert sorted(sdb.iter_set_members('voters', 'post1')) == ['u4']
+        assert sorted(sdb.iter_set_members('voters', 'post2')) == ['u1']
+
+
+def test_compaction_keeps_acceptance():
+    ## Nonces are per user, so other users' older nonces are still accepted after a removal, compacted or not:
+    ops = {2:[('post1', 'u1', 100, False)],
+           3:[('post1', 'u1', 101, True)],
+           8:[('post1', 'u5', 50, False), ('post1', 'u1', 101, False), ('post1', 'u1', 102, False)],
+           }
+    
+    for finality_depth in [False, 3]:
+        blocks = []
+        for num in xrange(1, 10):
+            blocks.append({'number':num,
+                           'hash':'b%d' % num,
+                           'timestamp': 0,
+                           'parentHash':'b%d' % (num - 1),
+                           'totalDifficulty':num,
+                           'event_log': [num],
+                           })
+        bcc = MockBlockchain(blocks)
+        sdb = StateManager(bcc, finality_depth = finality_depth)
+        MockApp(sdb, bcc)
+        sdb.setup_tables(table_names = ['table1', 'voters'])
+        
+        results = []
+        def logic_callback(log, *args, **kw):
+            for key, member, nonce, set_remove in ops.get(log['blockNumber'], []):
+                results.append(sdb.store('voters', key, member, nonce = nonce, as_set_op = True, set_remove = set_remove,
+                                         cur_hash = log['blockHash']))
+        bcc.log_handlers['DEFAULT'] = logic_callback
+        
+        sdb.loop_once()
+        
+        assert (finality_depth is False) or (('voters', 'post1', 'u1') in sdb.compacted_nonces), sdb.compacted_nonces
+        assert results == [True, True, True, False, True], (finality_depth, results)
+        assert sorted(sdb.iter_set_members('voters', 'post1')) == ['u1', 'u5']
 
 
 if __name__ == '__main__':
     test_state()
+    test_state_delta()
+    test_state_prefetch()
+    test_state_sqlite()
+    test_state_snapshot()
+    test_state_pruning()
+    test_ancestor_index()
+    test_loaded_blocks_fast_path()
+    test_lookup_store_many()
+    test_iter_items()
+    test_indexes()
+    test_pending_pool()
+    test_head_view()
+    test_block_transaction()
+    test_batch_callbacks()
+    test_key_filters()
+    test_stats()
+    test_view_cache_per_table()
+    test_set_accessors()
+    test_tombstone_compaction()
+    test_compaction_keeps_acceptance()
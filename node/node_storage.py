@@ -0,0 +1,379 @@
+#!/usr/bin/env python
+
+"""
+Pluggable storage backends for StateManager block states.
+
+Each table keeps one record per block hash. A record is either:
+- a checkpoint: the full state of the table as of the end of that block, or
+- a delta: only the keys written during that block (its write-set).
+
+Records are addressed as (table, block_hash, key), so a backend never has to hold more than the blocks
+it's asked about in the heap. StateManager resolves full states of delta blocks itself, see `StateManager._get_state()`.
+
+Backends:
+- MemoryStateStorage: dicts of PersistentMap's. Default, used for tests.
+- SQLiteStateStorage: embedded on-disk SQLite file, memory-mapped, WAL journal, writes committed in batches.
+
+Stored entries are whatever StateManager writes: (value, nonce) tuples, or PersistentMap's of set members.
+"""
+
+import sqlite3
+import threading
+import cPickle as pickle
+
+from node_pmap import PersistentMap, EMPTY_MAP
+
+
+class StateStorage:
+    """
+    Interface implemented by all storage backends.
+    """
+
+    ## True if checkpoints are kept as live PersistentMap's, so materializing them is free:
+    in_memory = False
+
+    def add_block(self, table, block_hash, parent_hash, state = None):
+        """ Add record for a block. With `state` (a mapping), the record is a checkpoint holding that full state. """
+        raise NotImplementedError
+
+    def has_block(self, table, block_hash):
+        raise NotImplementedError
+
+    def get_block(self, table, block_hash):
+        """ Returns (parent_hash, is_checkpoint). Raises KeyError if unknown. """
+        raise NotImplementedError
+
+    def put(self, table, block_hash, key, entry):
+        """ Write `entry` for `key` into the block's record. """
+        raise NotImplementedError
+
+    def put_many(self, table, block_hash, items):
+        """ Write each (key, entry) pair of `items` into the block's record. """
+        for key, entry in items:
+            self.put(table, block_hash, key, entry)
+
+    def get(self, table, block_hash, key, default = KeyError):
+        """ Lookup `key` in this block's record only. """
+        raise NotImplementedError
+
+    def block_state(self, table, block_hash):
+        """ Contents of the block's record, as a PersistentMap. """
+        raise NotImplementedError
+
+    def delete_block(self, table, block_hash):
+        raise NotImplementedError
+
+    def flush(self):
+        """ Make all writes so far durable. """
+        pass
+
+    def close(self):
+        pass
+
+
+class MemoryStateStorage(StateStorage):
+    """
+    In-memory backend. Records are PersistentMap's, so checkpoints share structure with each other.
+    """
+
+    in_memory = True
+
+    def __init__(self):
+        ## Checkpoints hold 's', deltas hold 'd':
+        self.hh = {} ## {table:{blockHash:{'h':blockHash, 'p':blockParentHash, 's' or 'd':PersistentMap}}}
+
+    def add_block(self, table, block_hash, parent_hash, state = None):
+        if table not in self.hh:
+            self.hh[table] = {}
+        rec = {'h':block_hash,
+               'p':parent_hash,
+               }
+        if state is not None:
+            if not isinstance(state, PersistentMap):
+                state = PersistentMap(state)
+            rec['s'] = state
+        else:
+            rec['d'] = EMPTY_MAP
+        self.hh[table][block_hash] = rec
+
+    def has_block(self, table, block_hash):
+        return block_hash in self.hh.get(table, {})
+
+    def get_block(self, table, block_hash):
+        rec = self.hh[table][block_hash]
+        return rec['p'], ('s' in rec)
+
+    def put(self, table, block_hash, key, entry):
+        rec = self.hh[table][block_hash]
+        if 's' in rec:
+            rec['s'] = rec['s'].set(key, entry)
+        else:
+            rec['d'] = rec['d'].set(key, entry)
+
+    def put_many(self, table, block_hash, items):
+        rec = self.hh[table][block_hash]
+        if 's' in rec:
+            rec['s'] = rec['s'].update(items)
+        else:
+            rec['d'] = rec['d'].update(items)
+
+    def get(self, table, block_hash, key, default = KeyError):
+        rec = self.hh[table][block_hash]
+        rr = rec.get('s', rec.get('d')).get(key, default)
+        if rr is KeyError:
+            raise KeyError(key)
+        return rr
+
+    def block_state(self, table, block_hash):
+        rec = self.hh[table][block_hash]
+        return rec.get('s', rec.get('d'))
+
+    def delete_block(self, table, block_hash):
+        del self.hh[table][block_hash]
+
+
+def encode_key(key):
+    """
+    Canonical bytes of a key, such that keys that compare equal encode equally, e.g. 5 == 5L, 1 == True == 1.0,
+    u'a' == 'a', and equal tuples however their items are shared. Unlike pickle, which keeps types and memo refs.
+    
+    Supports None, bool, int, long, float, str, unicode (as utf8), and tuples of these. See decode_key().
+    """
+    if key is None:
+        return 'N'
+    if isinstance(key, (bool, int, long)):
+        return 'i%d' % key
+    if isinstance(key, float):
+        if key.is_integer():
+            return 'i%d' % key
+        return 'f' + repr(key)
+    if isinstance(key, unicode):
+        return 's' + key.encode('utf8')
+    if isinstance(key, str):
+        return 's' + key
+    if isinstance(key, tuple):
+        return 't' + ''.join(['%d:%s' % (len(x), x) for x in [encode_key(y) for y in key]])
+    assert False, ('UNSUPPORTED_KEY_TYPE', type(key), key)
+
+def decode_key(x):
+    """ Inverse of encode_key(), up to equality: bools come back as ints, unicode as utf8 str. """
+    x = str(x)
+    tag, body = x[0], x[1:]
+    if tag == 'N':
+        return None
+    if tag == 'i':
+        return int(body)
+    if tag == 'f':
+        return float(body)
+    if tag == 's':
+        return body
+    if tag == 't':
+        rr = []
+        i = 0
+        while i < len(body):
+            j = body.index(':', i)
+            n = int(body[i:j])
+            rr.append(decode_key(body[j + 1:j + 1 + n]))
+            i = j + 1 + n
+        return tuple(rr)
+    assert False, ('BAD_ENCODED_KEY', x)
+
+def key_blob(key):
+    """ encode_key(), as an SQLite BLOB. Shared by the SQLite backed tables, see also node_temporal. """
+    return sqlite3.Binary(encode_key(key))
+
+def dump_value(x):
+    """ Values, unlike keys, are never compared, so are just pickled into an SQLite BLOB. """
+    return sqlite3.Binary(pickle.dumps(x, pickle.HIGHEST_PROTOCOL))
+
+def load_value(x):
+    """ Inverse of dump_value(). """
+    return pickle.loads(str(x))
+
+
+class SQLiteStateStorage(StateStorage):
+    """
+    On-disk backend using an embedded SQLite file.
+
+    - Memory-mapped reads (`mmap_size`), WAL journal.
+    - Writes are committed every `batch_size` writes or on flush(), which StateManager calls after each block.
+    """
+
+    in_memory = False
+
+    def __init__(self,
+                 fn,
+                 mmap_size = 1 << 30,
+                 batch_size = 10000,
+                 wipe = True,
+                 ):
+        """
+        - wipe: clear any records left in `fn` from a previous run. Block records are only meaningful together with
+                the StateManager's in-memory block tree they were written with.
+        """
+        self.fn = fn
+        self.batch_size = batch_size
+        self.num_uncommitted = 0
+        self.the_lock = threading.RLock()
+
+        ## Accessed from both the background ingestion thread and web threads, serialized by `the_lock`:
+        self.con = sqlite3.connect(fn, check_same_thread = False)
+        self.con.execute('PRAGMA journal_mode = WAL')
+        self.con.execute('PRAGMA synchronous = NORMAL')
+        self.con.execute('PRAGMA mmap_size = %d' % int(mmap_size))
+
+        self.con.execute('CREATE TABLE IF NOT EXISTS blocks (tbl TEXT, block_hash TEXT, parent_hash TEXT, is_checkpoint INTEGER, '
+                         'PRIMARY KEY (tbl, block_hash))')
+        self.con.execute('CREATE TABLE IF NOT EXISTS writes (tbl TEXT, block_hash TEXT, key BLOB, entry BLOB, '
+                         'PRIMARY KEY (tbl, block_hash, key))')
+        if wipe:
+            self.con.execute('DELETE FROM blocks')
+            self.con.execute('DELETE FROM writes')
+        self.con.commit()
+
+    def _wrote(self, n = 1):
+        self.num_uncommitted += n
+        if self.num_uncommitted >= self.batch_size:
+            self.flush()
+
+    def add_block(self, table, block_hash, parent_hash, state = None):
+        with self.the_lock:
+            self.con.execute('DELETE FROM writes WHERE tbl = ? AND block_hash = ?', (table, block_hash))
+            self.con.execute('INSERT OR REPLACE INTO blocks VALUES (?, ?, ?, ?)',
+                             (table, block_hash, parent_hash, (state is not None) and 1 or 0))
+            if state:
+                self.con.executemany('INSERT INTO writes VALUES (?, ?, ?, ?)',
+                                     ((table, block_hash, key_blob(k), dump_value(v)) for k, v in state.iteritems()))
+                self._wrote(len(state))
+            self._wrote()
+
+    def has_block(self, table, block_hash):
+        with self.the_lock:
+            rr = self.con.execute('SELECT 1 FROM blocks WHERE tbl = ? AND block_hash = ?', (table, block_hash)).fetchone()
+        return rr is not None
+
+    def get_block(self, table, block_hash):
+        with self.the_lock:
+            rr = self.con.execute('SELECT parent_hash, is_checkpoint FROM blocks WHERE tbl = ? AND block_hash = ?',
+                                  (table, block_hash)).fetchone()
+        if rr is None:
+            raise KeyError(block_hash)
+        return rr[0], bool(rr[1])
+
+    def put(self, table, block_hash, key, entry):
+        with self.the_lock:
+            self.con.execute('INSERT OR REPLACE INTO writes VALUES (?, ?, ?, ?)',
+                             (table, block_hash, key_blob(key), dump_value(entry)))
+            self._wrote()
+
+    def put_many(self, table, block_hash, items):
+        rows = [(table, block_hash, key_blob(k), dump_value(v)) for k, v in items]
+        with self.the_lock:
+            self.con.executemany('INSERT OR REPLACE INTO writes VALUES (?, ?, ?, ?)', rows)
+            self._wrote(len(rows))
+
+    def get(self, table, block_hash, key, default = KeyError):
+        with self.the_lock:
+            rr = self.con.execute('SELECT entry FROM writes WHERE tbl = ? AND block_hash = ? AND key = ?',
+                                  (table, block_hash, key_blob(key))).fetchone()
+        if rr is None:
+            if default is KeyError:
+                raise KeyError(key)
+            return default
+        return load_value(rr[0])
+
+    def block_state(self, table, block_hash):
+        with self.the_lock:
+            rr = self.con.execute('SELECT key, entry FROM writes WHERE tbl = ? AND block_hash = ?',
+                                  (table, block_hash)).fetchall()
+        return PersistentMap((decode_key(k), load_value(v)) for k, v in rr)
+
+    def delete_block(self, table, block_hash):
+        with self.the_lock:
+            self.con.execute('DELETE FROM writes WHERE tbl = ? AND block_hash = ?', (table, block_hash))
+            self.con.execute('DELETE FROM blocks WHERE tbl = ? AND block_hash = ?', (table, block_hash))
+            self._wrote()
+
+    def flush(self):
+        with self.the_lock:
+            self.con.commit()
+            self.num_uncommitted = 0
+
+    def close(self):
+        with self.the_lock:
+            self.con.commit()
+            self.con.close()
+
+
+def test_state_storage():
+    print ('START test_state_storage()')
+    import tempfile, shutil
+    from os.path import join
+
+    dd = tempfile.mkdtemp()
+    try:
+        for xx in [MemoryStateStorage(),
+                   SQLiteStateStorage(join(dd, 'state.db'), batch_size = 2),
+                   ]:
+            xx.add_block('t1', 'h1', 'h0', state = PersistentMap({'a':(1, False)}))
+            xx.add_block('t1', 'h2', 'h1')
+            xx.put('t1', 'h2', u'b', (2, 5))
+            xx.put('t1', 'h2', 'c', EMPTY_MAP.set('x', (True, False)))
+            xx.put_many('t1', 'h1', [('d', (4, 1)), ('a', (5, 2))])
+
+            assert xx.has_block('t1', 'h2')
+            assert not xx.has_block('t1', 'h3')
+            assert xx.get_block('t1', 'h1') == ('h0', True)
+            assert xx.get_block('t1', 'h2') == ('h1', False)
+            assert xx.get('t1', 'h1', 'a') == (5, 2)
+            assert xx.get('t1', 'h1', 'd') == (4, 1)
+            assert xx.get('t1', 'h2', 'b') == (2, 5)
+            assert xx.get('t1', 'h2', 'a', default = None) is None
+            assert xx.block_state('t1', 'h2') == {'b':(2, 5), 'c':{'x':(True, False)}}
+
+            xx.delete_block('t1', 'h2')
+            assert not xx.has_block('t1', 'h2')
+            xx.flush()
+            xx.close()
+    finally:
+        shutil.rmtree(dd)
+    print ('PASSED')
+
+
+def test_encode_key():
+    print ('START test_encode_key()')
+    a = 'a' * 3
+    equal_keys = [[('aaa', 5), (u'aaa', 5L), ('aa' + 'a', 5.0)],
+                  [1, True, 1L, 1.0],
+                  [(a, a), ('aaa', 'aa' + 'a')],
+                  [(('x', None), 2.5), ((u'x', None), 2.5)],
+                  ]
+    for keys in equal_keys:
+        assert len(set([encode_key(x) for x in keys])) == 1, keys
+        for x in keys:
+            assert decode_key(encode_key(x)) == x, x
+    
+    ## Distinct keys stay distinct, including across tuple boundaries:
+    distinct = ['1', 1, ('1',), ('1:s', 'x'), ('1', ':sx'), ('',), (), None, '', 0, (0,), ((0,),)]
+    assert len(set([encode_key(x) for x in distinct])) == len(distinct)
+    
+    ## Equal keys hit the same SQLite row:
+    import tempfile, shutil
+    from os.path import join
+    dd = tempfile.mkdtemp()
+    try:
+        xx = SQLiteStateStorage(join(dd, 'state.db'))
+        xx.add_block('t1', 'h1', 'h0')
+        xx.put('t1', 'h1', (a, 5), 'x')
+        xx.put('t1', 'h1', ('aaa', 5L), 'y')
+        assert xx.get('t1', 'h1', (u'aaa', True + 4)) == 'y'
+        assert xx.block_state('t1', 'h1') == {('aaa', 5):'y'}
+        xx.close()
+    finally:
+        shutil.rmtree(dd)
+    print ('PASSED')
+
+
+if __name__ == '__main__':
+    test_state_storage()
+    test_encode_key()
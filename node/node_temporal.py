@@ -21,24 +21,43 @@ Maintains a stable view of / access to state:
 ##
 
 from sys import maxint
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict
 import threading
 import multiprocessing
+import sqlite3
+
+from node_storage import key_blob, decode_key, dump_value, load_value
 
 class TemporalTable:
     """
     Temporal in-memory database. Update and lookup historical values of a key.
     
-    TODO:
-    - Also create version with SQL backend.
+    Set values, see store(as_set_op = True), are kept as {member:True or False (removed)} per block. Only every
+    `set_checkpoint_interval`th version of a key holds the full set, the rest only hold the members changed at their
+    block. Full sets are reconstructed on lookup, see _set_state().
+    
+    See SQLiteTemporalTable for an on-disk version.
     """
     
     def __init__(self,
                  process_safe = True,
                  manager = False,
+                 set_checkpoint_interval = 16,
+                 set_cache_size = 256,
                  ):
+        """
+        - process_safe: keep everything in `manager` proxies, so the table can be shared with other processes. 
+                        Otherwise use plain dicts guarded by a threading.RLock, only shared between threads, and
+                        without the IPC round trips and BUG1 copies on every access.
+        - set_checkpoint_interval: max number of versions of a set-valued key to resolve per lookup.
+        - set_cache_size: number of set-valued keys whose reconstructed sets are cached. Only without `process_safe`,
+                          since other processes can't invalidate this process's cache.
+        """
         self.process_safe = process_safe
-        
-        assert process_safe, 'TODO - double check thread-based concurrency support by TemporalForks & TemporalDB'
+        self.set_checkpoint_interval = set_checkpoint_interval
+        self.set_cache_size = set_cache_size
+        self.set_cache = OrderedDict() ## {key:{block_num:{member:is_present}}}, in LRU order.
         
         if self.process_safe:
             if manager is not False:
@@ -48,16 +67,26 @@ class TemporalTable:
             self.process_safe = True
             self.the_lock = self.manager.RLock()
             self.hh = self.manager.dict()
+            self.block_nums = self.manager.dict()
+            self.set_checkpoints = self.manager.dict()
+            self.set_own = self.manager.dict()
             self.current_latest = self.manager.dict()
             self.all_block_nums = self.manager.dict()
+            self.sorted_block_nums = self.manager.list()
             self.largest_pruned = self.manager.Value('i', -maxint)
+            self.compaction_queue = self.manager.list()
         else:
             self.process_safe = False
             self.the_lock = threading.RLock()
             self.hh = {}             ## {key:{block_num:value}}
+            self.block_nums = {}     ## {key:[block_num, ...]}, sorted block_nums of versions in `hh`.
+            self.set_checkpoints = {} ## {key:[block_num, ...]}, sorted block_nums of full set versions, for set keys only.
+            self.set_own = {}        ## {key:{block_num:{member:True}}}, members written by each checkpoint's own block.
             self.current_latest = {} ## {key:block_num}
-            self.all_block_nums = {} ## set, but have to use dict
+            self.all_block_nums = {}    ## {block_num:{key:True}}, keys with a version at each block.
+            self.sorted_block_nums = [] ## Sorted keys of `all_block_nums`.
             self.largest_pruned = -maxint
+            self.compaction_queue = [] ## [(start_block, key), ...] of set removals, see compact_set_tombstones().
 
     def _get_largest_pruned(self):
         if self.process_safe:
@@ -70,6 +99,109 @@ class TemporalTable:
             self.largest_pruned.value = val
         else:
             self.largest_pruned = val
+    
+    def _add_block_num(self, key, block_num):
+        """ Keep `block_nums` sorted, in O(log v) to find the position. """
+        ## BUG1:
+        bns = self.block_nums.get(key, [])
+        i = bisect_left(bns, block_num)
+        if (i == len(bns)) or (bns[i] != block_num):
+            bns.insert(i, block_num)
+            self.block_nums[key] = bns
+    
+    def _set_state(self, key, block_num):
+        """ Full set of `key`, as of its version at `block_num`: nearest checkpoint, plus the deltas after it. """
+        if (not self.process_safe) and self.set_cache_size:
+            cc = self.set_cache.pop(key, {})
+            self.set_cache[key] = cc
+            if block_num in cc:
+                return cc[block_num]
+        
+        cps = self.set_checkpoints[key]
+        cp = cps[bisect_right(cps, block_num) - 1]
+        
+        tm = self.hh[key]
+        bns = self.block_nums[key]
+        
+        rr = dict(tm[cp])
+        for bn in bns[bisect_right(bns, cp):bisect_right(bns, block_num)]:
+            rr.update(tm[bn])
+        
+        if (not self.process_safe) and self.set_cache_size:
+            cc[block_num] = rr
+            while len(self.set_cache) > self.set_cache_size:
+                self.set_cache.popitem(last = False)
+        
+        return rr
+    
+    def _store_set_member(self, key, member, start_block, is_present):
+        """
+        Record `member` as present or removed at `start_block`, in that block's delta or checkpoint. A checkpoint's
+        dict also holds state carried over from older blocks, so `set_own` tells which members its own block wrote.
+        """
+        ## BUG1:
+        tm = self.hh[key]
+        bns = self.block_nums.get(key, [])
+        cps = self.set_checkpoints.get(key, [])
+        own = self.set_own.get(key, {})
+        
+        if start_block not in tm:
+            prev = self._version_at(key, -maxint, start_block)
+            if prev is False:
+                tm[start_block] = {}
+                insort(cps, start_block)
+            else:
+                num_deltas = bisect_right(bns, prev) - bisect_left(bns, cps[bisect_right(cps, prev) - 1])
+                if num_deltas >= self.set_checkpoint_interval:
+                    tm[start_block] = dict(self._set_state(key, prev))
+                    insort(cps, start_block)
+                else:
+                    tm[start_block] = {}
+        
+        tm2 = tm[start_block]
+        tm2[member] = is_present
+        tm[start_block] = tm2
+        if start_block in cps:
+            own2 = own.get(start_block, {})
+            own2[member] = True
+            own[start_block] = own2
+        
+        ## Newer checkpoints have the member's old state, up to the first newer block that changed it:
+        for bn in bns[bisect_right(bns, start_block):]:
+            if bn in cps:
+                if member in own.get(bn, {}):
+                    break
+                tm2 = tm[bn]
+                tm2[member] = is_present
+                tm[bn] = tm2
+            elif member in tm[bn]:
+                break
+        
+        self.hh[key] = tm
+        self.set_checkpoints[key] = cps
+        self.set_own[key] = own
+        self.set_cache.pop(key, None)
+    
+    def _pop_block_keys(self, i, j):
+        """ Remove blocks `sorted_block_nums[i:j]` from the block index, returns keys written at them. """
+        rr = set()
+        for bn in self.sorted_block_nums[i:j]:
+            rr.update(self.all_block_nums.pop(bn).keys())
+        del self.sorted_block_nums[i:j]
+        return rr
+    
+    def _version_at(self, key, start_block, end_block):
+        """ Block_num of the newest version of `key` between `start_block` and `end_block`, or False. """
+        bns = self.block_nums.get(key)
+        if not bns:
+            return False
+        if end_block == 'latest':
+            i = len(bns)
+        else:
+            i = bisect_right(bns, end_block)
+        if (i == 0) or (bns[i - 1] < start_block):
+            return False
+        return bns[i - 1]
         
     def store(self, key, value, start_block, as_set_op = False, remove_set_op = False):
         """ """
@@ -93,36 +225,9 @@ class TemporalTable:
                     self.hh[key] = {}
 
             if as_set_op:
-                if start_block not in self.hh[key]:
-                    if self.process_safe:
-                        if as_set_op:
-                            ## copy whole previous in:
-                            tm = self.hh[key]
-                            if key in self.current_latest:
-                                tm[start_block] = self.hh[key][self.current_latest[key]].copy()
-                            else:
-                                tm[start_block] = self.manager.dict()
-                            self.hh[key] = tm
-                        else:
-                            ## BUG1:
-                            #self.hh[key][start_block] = self.manager.dict()
-                            tm = self.hh[key]
-                            tm[start_block] = self.manager.dict()
-                            self.hh[key] = tm
-                    else:
-                        self.hh[key][start_block] = {}
-                ## BUG1:
-                #self.hh[key][start_block][value] = True ## Must have already setup in previous call.
-                tm = self.hh[key]
-                tm2 = tm[start_block]
-                #print 'aa', key ,start_block, self.hh
-                #print 'hh', self.hh[key][start_block]
+                self._store_set_member(key, value, start_block, not remove_set_op)
                 if remove_set_op:
-                    tm2[value] = False ## Must have already setup in previous call.
-                else:
-                    tm2[value] = True ## Must have already setup in previous call.
-                tm[start_block] = tm2
-                self.hh[key] = tm
+                    self.compaction_queue.append((start_block, key))
             else:
                 #self.hh[key][start_block] = value
                 ## BUG1:
@@ -131,8 +236,17 @@ class TemporalTable:
                 self.hh[key] = tm
 
             self.current_latest[key] = max(start_block, self.current_latest.get(key, -maxint))
-
-            self.all_block_nums[start_block] = True
+            
+            self._add_block_num(key, start_block)
+            
+            ## BUG1:
+            kk = self.all_block_nums.get(start_block)
+            if kk is None:
+                kk = {}
+                insort(self.sorted_block_nums, start_block)
+            if key not in kk:
+                kk[key] = True
+                self.all_block_nums[start_block] = kk
         
     def remove(self, key, value, start_block, as_set_op = False):
 
@@ -175,6 +289,12 @@ class TemporalTable:
                 tm = self.hh[key]
                 del tm[start_block]
                 self.hh[key] = tm
+                bns = self.block_nums[key]
+                bns.remove(start_block)
+                self.block_nums[key] = bns
+                kk = self.all_block_nums[start_block]
+                del kk[key]
+                self.all_block_nums[start_block] = kk
                 
             self.current_latest[key] = max(start_block, self.current_latest.get(key, -maxint))
     
@@ -188,54 +308,36 @@ class TemporalTable:
             if (start_block > -maxint) and (start_block <= self._get_largest_pruned()):
                 assert False, ('PREVIOUSLY_PRUNED_REQUESTED_BLOCK', start_block, self._get_largest_pruned())
 
-            if (key not in self.hh) or (not self.hh[key]):
+            ## Closest <= end_block, by binary search:
+            
+            xx = self._version_at(key, start_block, end_block)
+            
+            if xx is False:
                 if default is KeyError:
                     raise KeyError
                 if with_block_num:
                     return default, False
                 else:
                     return default
-
-            ## Latest:
             
-            if end_block == 'latest':
-                end_block = max(end_block, self.current_latest[key])
-
-            ## Exactly end_block:
-
-            if start_block == end_block:
-                if end_block in self.hh[key]:
-                    if with_block_num:
-                        return self.hh[key][end_block], start_block
-                    else:
-                        return self.hh[key][end_block]
-
-            ## Closest <= block_num:
+            if key in self.set_checkpoints:
+                rr = self._set_state(key, xx)
+            else:
+                rr = self.hh[key][xx]
             
-            for xx in sorted(self.hh.get(key,{}).keys(), reverse = True):
-                if xx > end_block:
-                    continue
-                if xx < start_block:
-                    continue
-                if with_block_num:
-                    return self.hh[key][xx], xx
-                else:
-                    return self.hh[key][xx]
+            if with_block_num:
+                return rr, xx
             else:
-                if default is KeyError:
-                    raise KeyError
-                if with_block_num:
-                    return default, False
-                else:
-                    return default
-
-            assert False,'should not reach'
+                return rr
 
     def iterate_set_depth(self, start_block = -maxint, end_block = 'latest'):
         ## TODO
         ## [x.keys() for x in xx.tables['table2'].forks['fork1'].hh['z'].values()]
         pass
             
+    def iter_keys(self):
+        return self.current_latest.keys()
+    
     def iterate_block_items(self, start_block = -maxint, end_block = 'latest'):
         """ Iterate latest version of all known keys, between start_block and end_block. """
         with self.the_lock:
@@ -250,30 +352,317 @@ class TemporalTable:
     def prune_historical(self, end_block):
         """ Prune ONLY OUTDATED records prior to and including `end_block`, e.g. to clear outdated historical state. """
         with self.the_lock:
-            for key in self.hh.keys():
-                for bn in sorted(self.hh.get(key,{}).keys()):
-                    if bn > end_block:
-                        break
-                    ## BUG1:
-                    #del self.hh[key][bn]
-                    tm = self.hh[key]
+            ## Only keys with versions in the pruned blocks:
+            for key in self._pop_block_keys(0, bisect_right(self.sorted_block_nums, end_block)):
+                bns = self.block_nums[key]
+                i = bisect_right(bns, end_block)
+                if not i:
+                    continue
+                ## BUG1:
+                #del self.hh[key][bn]
+                tm = self.hh[key]
+                if key in self.set_checkpoints:
+                    ## Oldest remaining version must hold the full set:
+                    cps = self.set_checkpoints[key]
+                    own = self.set_own.get(key, {})
+                    if (i < len(bns)) and (bns[i] not in cps):
+                        own[bns[i]] = dict([(x, True) for x in tm[bns[i]]])
+                        tm[bns[i]] = dict(self._set_state(key, bns[i]))
+                        cps.append(bns[i])
+                    self.set_checkpoints[key] = sorted([x for x in cps if x > end_block])
+                    self.set_own[key] = dict([(x, y) for x, y in own.items() if x > end_block])
+                    self.set_cache.pop(key, None)
+                for bn in bns[:i]:
                     del tm[bn]
-                    self.hh[key] = tm
+                self.hh[key] = tm
+                self.block_nums[key] = bns[i:]
                     
-            self._set_largest_pruned(max(end_block, self.largest_pruned))
+            self._set_largest_pruned(max(end_block, self._get_largest_pruned()))
+        
+    def compact_set_tombstones(self, final_block, max_keys = 100):
+        """
+        Drop removed set members, kept as False, that were removed at or before `final_block`, e.g. the block
+        finality depth behind the head. Only does up to `max_keys` queued removals per call, so call it after each
+        block to spread the work out. Returns number of removals processed.
+        """
+        with self.the_lock:
+            num_done = 0
+            while len(self.compaction_queue) and (num_done < max_keys):
+                start_block, key = self.compaction_queue[0]
+                if start_block > final_block:
+                    break
+                self.compaction_queue.pop(0)
+                num_done += 1
+                
+                last_final = self._version_at(key, -maxint, final_block)
+                if last_final is False:
+                    ## Pruned or wiped since:
+                    continue
+                
+                ## Last final version becomes a checkpoint without the removed members. Deltas before it still need
+                ## their removals, to resolve older versions:
+                full = self._set_state(key, last_final)
+                final = set([x for x, is_present in full.items() if not is_present])
+                
+                ## BUG1:
+                tm = self.hh[key]
+                cps = self.set_checkpoints[key]
+                own = self.set_own.get(key, {})
+                if last_final not in cps:
+                    own[last_final] = dict([(x, True) for x in tm[last_final]])
+                    insort(cps, last_final)
+                tm[last_final] = dict([(x, True) for x, is_present in full.items() if is_present])
+                
+                ## Other checkpoints hold their own copies of removed members:
+                for bn in cps:
+                    if bn == last_final:
+                        continue
+                    tm2 = tm[bn]
+                    if bn < last_final:
+                        drop = [x for x, is_present in tm2.items() if not is_present]
+                    else:
+                        drop = [x for x in final if tm2.get(x, True) is False]
+                    if drop:
+                        for x in drop:
+                            del tm2[x]
+                        tm[bn] = tm2
+                self.hh[key] = tm
+                self.set_checkpoints[key] = cps
+                self.set_own[key] = own
+                self.set_cache.pop(key, None)
+            
+            return num_done
         
     def wipe_newer(self, start_block):
         """ Wipe blocks newer than and and including `start_block` e.g. for blockchain reorganization. """
         with self.the_lock:
-            for key in self.hh.keys():
-                for bn in sorted(self.hh.get(key,{}).keys(), reverse = True):
-                    if bn < start_block:
-                        break
-                    ## BUG1:
-                    #del self.hh[key][bn]
-                    tm = self.hh[key]
+            ## Only keys with versions in the wiped blocks:
+            for key in self._pop_block_keys(bisect_left(self.sorted_block_nums, start_block), len(self.sorted_block_nums)):
+                bns = self.block_nums[key]
+                i = bisect_left(bns, start_block)
+                if i == len(bns):
+                    continue
+                ## BUG1:
+                #del self.hh[key][bn]
+                tm = self.hh[key]
+                for bn in bns[i:]:
                     del tm[bn]
-                    self.hh[key] = tm
+                self.hh[key] = tm
+                self.block_nums[key] = bns[:i]
+                if key in self.set_checkpoints:
+                    self.set_checkpoints[key] = [x for x in self.set_checkpoints[key] if x < start_block]
+                    self.set_own[key] = dict([(x, y) for x, y in self.set_own.get(key, {}).items() if x < start_block])
+                    self.set_cache.pop(key, None)
+                
+                ## Next store() copies set versions from the latest remaining one:
+                if i:
+                    self.current_latest[key] = bns[i - 1]
+                else:
+                    del self.current_latest[key]
+            
+            self.compaction_queue[:] = [x for x in self.compaction_queue if x[0] < start_block]
+
+class SQLiteTemporalTable:
+    """
+    TemporalTable backed by an embedded on-disk SQLite file, so histories larger than RAM stay queryable.
+    
+    - Versions are rows keyed by (key, block_num), so lookup() is a single `ORDER BY block_num DESC LIMIT 1` query.
+    - Set members are rows keyed by (key, member, block_num). A set is resolved with one query grouped by member.
+    - WAL journal, memory-mapped reads. Writes are committed every `batch_size` writes or on flush().
+    
+    Only shared between threads of this process, see TemporalTable(process_safe = False).
+    """
+    
+    process_safe = False
+    
+    def __init__(self,
+                 fn,
+                 mmap_size = 1 << 30,
+                 batch_size = 10000,
+                 wipe = True,
+                 ):
+        """
+        - wipe: clear any versions left in `fn` from a previous run.
+        """
+        self.fn = fn
+        self.batch_size = batch_size
+        self.num_uncommitted = 0
+        self.the_lock = threading.RLock()
+        
+        self.con = sqlite3.connect(fn, check_same_thread = False)
+        self.con.execute('PRAGMA journal_mode = WAL')
+        self.con.execute('PRAGMA synchronous = NORMAL')
+        self.con.execute('PRAGMA mmap_size = %d' % int(mmap_size))
+        
+        self.con.execute('CREATE TABLE IF NOT EXISTS versions (key BLOB, block_num INTEGER, value BLOB, is_set INTEGER, '
+                         'PRIMARY KEY (key, block_num))')
+        self.con.execute('CREATE INDEX IF NOT EXISTS versions_block_num ON versions (block_num)')
+        self.con.execute('CREATE TABLE IF NOT EXISTS set_members (key BLOB, member BLOB, block_num INTEGER, is_present INTEGER, '
+                         'PRIMARY KEY (key, member, block_num))')
+        self.con.execute('CREATE INDEX IF NOT EXISTS set_members_removed ON set_members (block_num) WHERE is_present = 0')
+        self.con.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER)')
+        if wipe:
+            self.con.execute('DELETE FROM versions')
+            self.con.execute('DELETE FROM set_members')
+            self.con.execute('DELETE FROM meta')
+        self.con.commit()
+        
+        rr = self.con.execute("SELECT value FROM meta WHERE name = 'largest_pruned'").fetchone()
+        self.largest_pruned = (rr is None) and -maxint or rr[0]
+    
+    def _wrote(self, n = 1):
+        self.num_uncommitted += n
+        if self.num_uncommitted >= self.batch_size:
+            self.flush()
+    
+    def _get_largest_pruned(self):
+        return self.largest_pruned
+    
+    def _check_pruned(self, start_block):
+        if (start_block > -maxint) and (start_block <= self.largest_pruned):
+            assert False, ('PREVIOUSLY_PRUNED_REQUESTED_BLOCK', start_block, self.largest_pruned)
+    
+    def _set_state(self, kk, block_num):
+        """
+        {member:is_present} of serialized key `kk`, as of `block_num`, from each member's latest row. Members whose
+        latest row is a compacted removal (is_present = -1) are left out, see compact_set_tombstones().
+        """
+        rr = self.con.execute('SELECT member, is_present, MAX(block_num) FROM set_members '
+                              'WHERE key = ? AND block_num <= ? GROUP BY member', (kk, block_num)).fetchall()
+        return dict([(decode_key(member), bool(is_present)) for member, is_present, bn in rr if is_present >= 0])
+    
+    def store(self, key, value, start_block, as_set_op = False, remove_set_op = False):
+        assert start_block != -maxint, 'ERROR: -MAXINT IS RESERVED'
+        
+        kk = key_blob(key)
+        
+        with self.the_lock:
+            if as_set_op:
+                self.con.execute('INSERT OR IGNORE INTO versions VALUES (?, ?, NULL, 1)', (kk, start_block))
+                self.con.execute('INSERT OR REPLACE INTO set_members VALUES (?, ?, ?, ?)',
+                                 (kk, key_blob(value), start_block, (not remove_set_op) and 1 or 0))
+                self._wrote(2)
+            else:
+                self.con.execute('INSERT OR REPLACE INTO versions VALUES (?, ?, ?, 0)', (kk, start_block, dump_value(value)))
+                self._wrote()
+    
+    def remove(self, key, value, start_block, as_set_op = False):
+        with self.the_lock:
+            if as_set_op:
+                self.store(key, value, start_block, as_set_op = True, remove_set_op = True)
+                return
+            self.con.execute('DELETE FROM versions WHERE key = ? AND block_num = ?', (key_blob(key), start_block))
+            self._wrote()
+    
+    def lookup(self, key, start_block = -maxint, end_block = 'latest', default = KeyError, with_block_num = True):
+        """ Return only latest, between start_block and end_block. """
+        
+        assert with_block_num
+        
+        if end_block == 'latest':
+            end_block = maxint
+        
+        kk = key_blob(key)
+        
+        with self.the_lock:
+            
+            self._check_pruned(start_block)
+            
+            rr = self.con.execute('SELECT block_num, value, is_set FROM versions WHERE key = ? AND block_num BETWEEN ? AND ? '
+                                  'ORDER BY block_num DESC LIMIT 1', (kk, start_block, end_block)).fetchone()
+            
+            if rr is None:
+                if default is KeyError:
+                    raise KeyError
+                return default, False
+            
+            block_num, value, is_set = rr
+            
+            if is_set:
+                return self._set_state(kk, block_num), block_num
+            
+            return load_value(value), block_num
+    
+    def iter_keys(self):
+        with self.the_lock:
+            return [decode_key(kk) for kk, in self.con.execute('SELECT DISTINCT key FROM versions')]
+    
+    def iterate_block_items(self, start_block = -maxint, end_block = 'latest'):
+        """ Iterate latest version of all known keys, between start_block and end_block. """
+        
+        if end_block == 'latest':
+            end_block = maxint
+        
+        with self.the_lock:
+            
+            self._check_pruned(start_block)
+            
+            rr = self.con.execute('SELECT key, MAX(block_num), value, is_set FROM versions WHERE block_num BETWEEN ? AND ? '
+                                  'GROUP BY key ORDER BY key', (start_block, end_block)).fetchall()
+            
+            for kk, block_num, value, is_set in rr:
+                if is_set:
+                    yield (decode_key(kk), self._set_state(kk, block_num))
+                else:
+                    yield (decode_key(kk), load_value(value))
+    
+    def prune_historical(self, end_block):
+        """
+        Prune records prior to and including `end_block`, like TemporalTable.prune_historical(). Each set member's
+        latest row is kept as the base state of keys that still have newer versions.
+        """
+        with self.the_lock:
+            self.con.execute('DELETE FROM set_members WHERE block_num <= ? AND '
+                             '((key NOT IN (SELECT key FROM versions WHERE block_num > ?)) OR '
+                             ' (block_num < (SELECT MAX(s2.block_num) FROM set_members s2 WHERE s2.key = set_members.key '
+                             '               AND s2.member = set_members.member AND s2.block_num <= ?)))',
+                             (end_block, end_block, end_block))
+            ## With nothing older left to hide, compacted removals are the same as no row:
+            self.con.execute('DELETE FROM set_members WHERE block_num <= ? AND is_present = -1', (end_block,))
+            self.con.execute('DELETE FROM versions WHERE block_num <= ?', (end_block,))
+            
+            self.largest_pruned = max(end_block, self.largest_pruned)
+            self.con.execute("INSERT OR REPLACE INTO meta VALUES ('largest_pruned', ?)", (self.largest_pruned,))
+            self._wrote()
+    
+    def compact_set_tombstones(self, final_block, max_keys = 100):
+        """
+        Like TemporalTable.compact_set_tombstones(): for up to `max_keys` keys, members that are removed as of
+        `final_block` are left out of the set from their removal on. Their removal row is rewritten as is_present = -1
+        rather than deleted, so older rows still resolve older versions. Returns number of keys compacted.
+        """
+        with self.the_lock:
+            keys = self.con.execute('SELECT DISTINCT key FROM set_members s WHERE is_present = 0 AND block_num <= ? AND '
+                                    'block_num = (SELECT MAX(s2.block_num) FROM set_members s2 WHERE s2.key = s.key '
+                                    '             AND s2.member = s.member AND s2.block_num <= ?) LIMIT ?',
+                                    (final_block, final_block, max_keys)).fetchall()
+            
+            for kk, in keys:
+                self.con.execute('UPDATE set_members SET is_present = -1 WHERE key = ? AND is_present = 0 AND block_num = '
+                                 '(SELECT MAX(s2.block_num) FROM set_members s2 WHERE s2.key = set_members.key '
+                                 ' AND s2.member = set_members.member AND s2.block_num <= ?)',
+                                 (kk, final_block))
+            self._wrote(len(keys))
+            
+            return len(keys)
+    
+    def wipe_newer(self, start_block):
+        """ Wipe blocks newer than and and including `start_block` e.g. for blockchain reorganization. """
+        with self.the_lock:
+            self.con.execute('DELETE FROM versions WHERE block_num >= ?', (start_block,))
+            self.con.execute('DELETE FROM set_members WHERE block_num >= ?', (start_block,))
+            self._wrote()
+    
+    def flush(self):
+        with self.the_lock:
+            self.con.commit()
+            self.num_uncommitted = 0
+    
+    def close(self):
+        with self.the_lock:
+            self.con.commit()
+            self.con.close()
+
 
 T_ANY_FORK = 'T_ANY_FORK'
 
@@ -294,10 +683,15 @@ class TemporalForks:
                  max_non_master_age = False,
                  manager = False,
                  CONST_ANY_FORK = T_ANY_FORK, ## just in case you really need to change it
+                 process_safe = True,
+                 make_table = False,
                  ):
         """
         - master_fork_name: name of master fork
         - max_non_master_age: number of blocks before non-master blocks expire.
+        - process_safe: share state with other processes through `manager`, see TemporalTable.
+        - make_table: function of fork name, returning a TemporalTable-compatible table for that fork, e.g. a
+                      SQLiteTemporalTable. Defaults to TemporalTable's.
         """
         
         assert master_fork_name in fork_names
@@ -305,7 +699,11 @@ class TemporalForks:
 
         self.T_ANY_FORK = CONST_ANY_FORK
         
-        if manager is not False:
+        self.process_safe = process_safe
+        
+        if not process_safe:
+            self.manager = False
+        elif manager is not False:
             self.manager = manager
         else:
             self.manager = multiprocessing.Manager()
@@ -313,18 +711,33 @@ class TemporalForks:
         self.forks = {} ## Doesn't ever change after this function, so regular dict.
         
         for fork in fork_names:
-            self.forks[fork] = TemporalTable(process_safe = True, manager = self.manager)
+            if make_table is not False:
+                self.forks[fork] = make_table(fork)
+            else:
+                self.forks[fork] = TemporalTable(process_safe = process_safe, manager = self.manager)
         
         self.master_fork_name = master_fork_name
         self.max_non_master_age = max_non_master_age
-        self.latest_master_block_num = self.manager.Value('i', -maxint)
         
-        self.the_lock = self.manager.RLock()
+        if process_safe:
+            self.latest_master_block_num = self.manager.Value('i', -maxint)
+            self.the_lock = self.manager.RLock()
+        else:
+            self.latest_master_block_num = -maxint
+            self.the_lock = threading.RLock()
 
+    def _get_latest_master_block_num(self):
+        if self.process_safe:
+            return self.latest_master_block_num.value
+        else:
+            return self.latest_master_block_num
         
     def update_latest_master_block_num(self, block_num):
         with self.the_lock:
-            self.latest_master_block_num.value = max(block_num, self.latest_master_block_num.value)
+            if self.process_safe:
+                self.latest_master_block_num.value = max(block_num, self.latest_master_block_num.value)
+            else:
+                self.latest_master_block_num = max(block_num, self.latest_master_block_num)
         
     def store(self, fork_name, *args, **kw):
         """ store in specific fork """
@@ -367,7 +780,7 @@ class TemporalForks:
                                                     default = default,
                                                     )
             
-            assert self.latest_master_block_num.value != -maxint, 'Must call self.update_latest_master_block_num() first.'
+            assert self._get_latest_master_block_num() != -maxint, 'Must call self.update_latest_master_block_num() first.'
             
             biggest_num = -maxint
             biggest_val = False
@@ -375,7 +788,7 @@ class TemporalForks:
             start_block_non_master = start_block
             
             if self.max_non_master_age is not False:
-                start_block_non_master = max(self.latest_master_block_num.value - self.max_non_master_age,
+                start_block_non_master = max(self._get_latest_master_block_num() - self.max_non_master_age,
                                              start_block,
                                              )            
             
@@ -418,7 +831,7 @@ class TemporalForks:
             do_keys = set()
             
             for fork in self.forks.values():                
-                   do_keys.update(fork.current_latest.keys()) 
+                   do_keys.update(fork.iter_keys()) 
             
                    
             for kk in do_keys:
@@ -446,6 +859,15 @@ class TemporalForks:
 
             for fork_name, fork in self.forks.items():                
                 fork.wipe_newer(*args, **kw)
+    
+    def compact_set_tombstones(self, fork_name, *args, **kw):
+        with self.the_lock:
+            if fork_name != self.T_ANY_FORK:
+                assert fork_name in self.forks, repr(fork_name)
+                return self.forks[fork_name].compact_set_tombstones(*args, **kw)
+
+            for fork_name, fork in self.forks.items():                
+                fork.compact_set_tombstones(*args, **kw)
 
 
 class TemporalDB:
@@ -456,15 +878,24 @@ class TemporalDB:
                  table_names,
                  master_fork_name,
                  fork_names,
+                 process_safe = True,
                  ):
-        self.manager = multiprocessing.Manager()
-        self.the_lock = self.manager.RLock()
+        """
+        - process_safe: share state with other processes through a multiprocessing.Manager, see TemporalTable.
+        """
+        if process_safe:
+            self.manager = multiprocessing.Manager()
+            self.the_lock = self.manager.RLock()
+        else:
+            self.manager = False
+            self.the_lock = threading.RLock()
 
         self.tables = {}
         for table_name in table_names:
             self.tables[table_name] = TemporalForks(master_fork_name = master_fork_name,
                                                     fork_names = fork_names,
                                                     manager = self.manager,
+                                                    process_safe = process_safe,
                                                     )
     
     def __getattr__(self, func_name):
@@ -494,9 +925,9 @@ class TemporalDB:
         return handle
         
             
-def test_temporal_table():
-    print ('START test_temporal_table()')
-    xx = TemporalTable()
+def test_temporal_table(**temporal_args):
+    print ('START test_temporal_table()', temporal_args)
+    xx = TemporalTable(**temporal_args)
     xx.store('a', 'b', start_block = 1)
     assert xx.lookup('a')[0] == 'b', xx.lookup('a')[0]
     xx.store('a', 'c', start_block = 3)
@@ -509,12 +940,72 @@ def test_temporal_table():
     xx.store('e','g',3)
     assert tuple(xx.iterate_block_items()) == (('a', 'c'), ('e', 'g'))
     assert tuple(xx.iterate_block_items(end_block = 1)) == (('a', 'b'), ('e', 'h'))
+    
+    ## Versions stored out of order, looked up by range:
+    for bn in [5, 1, 9, 3]:
+        xx.store('h', 'v%d' % bn, bn)
+    assert xx.block_nums['h'] == [1, 3, 5, 9]
+    assert xx.lookup('h', end_block = 4) == ('v3', 3)
+    assert xx.lookup('h', start_block = 4, end_block = 8) == ('v5', 5)
+    assert xx.lookup('h', start_block = 6, end_block = 8, default = None) == (None, False)
+    assert xx.lookup('h', end_block = 0, default = None) == (None, False)
+    
+    xx.prune_historical(3)
+    assert xx.lookup('h', end_block = 4, default = None) == (None, False)
+    assert list(xx.sorted_block_nums) == [5, 9]
+    xx.wipe_newer(9)
+    assert xx.lookup('h') == ('v5', 5)
+    assert dict(xx.all_block_nums) == {5:{'h':True}}
+    xx.store('h', 'v7', 7)
+    assert xx.lookup('h') == ('v7', 7)
+    
+    ## Set versions are deltas between checkpoints, including writes to older blocks:
+    xx = TemporalTable(set_checkpoint_interval = 3, **temporal_args)
+    for bn in xrange(1, 11):
+        xx.store('s', 'm%d' % bn, bn, as_set_op = True)
+    xx.remove('s', 'm2', 5, as_set_op = True)
+    xx.store('s', 'x', 3, as_set_op = True)
+    xx.remove('s', 'x', 8, as_set_op = True)
+    assert len(xx.set_checkpoints['s']) > 2, xx.set_checkpoints['s']
+    
+    def members(bn):
+        return set([m for m, is_present in xx.lookup('s', end_block = bn)[0].items() if is_present])
+    def expected(bn):
+        rr = set(['m%d' % c for c in xrange(1, bn + 1)])
+        if bn >= 5:
+            rr.discard('m2')
+        if 3 <= bn < 8:
+            rr.add('x')
+        return rr
+    for bn in xrange(1, 11):
+        assert members(bn) == expected(bn), (bn, members(bn))
+    
+    xx.prune_historical(4)
+    for bn in xrange(5, 11):
+        assert members(bn) == expected(bn), (bn, members(bn))
+    
+    ## Writes to older blocks don't override a newer checkpoint's own writes:
+    xx = TemporalTable(set_checkpoint_interval = 2, **temporal_args)
+    for bn in xrange(1, 5):
+        xx.store('s', 'a%d' % bn, bn, as_set_op = True)
+    xx.store('s', 'm', 5, as_set_op = True)
+    xx.remove('s', 'm', 5, as_set_op = True)
+    assert 5 in xx.set_checkpoints['s'], xx.set_checkpoints['s']
+    xx.store('s', 'm', 1, as_set_op = True)
+    assert xx.lookup('s', end_block = 4)[0]['m'] is True
+    assert xx.lookup('s', end_block = 5)[0]['m'] is False
+    xx.store('s', 'n', 1, as_set_op = True)
+    assert xx.lookup('s', end_block = 5)[0]['n'] is True
     print ('PASSED')
 
 
-def test_temporal_forks():
-    print ('START test_temporal_forks()')
-    xx = TemporalForks(master_fork_name = 'fork1', fork_names = ['fork1', 'fork2'])
+def test_temporal_table_in_process():
+    test_temporal_table(process_safe = False)
+
+
+def test_temporal_forks(**temporal_args):
+    print ('START test_temporal_forks()', temporal_args)
+    xx = TemporalForks(master_fork_name = 'fork1', fork_names = ['fork1', 'fork2'], **temporal_args)
     xx.update_latest_master_block_num(1)
     xx.store('fork1', 'a', 'b', start_block = 1)
     assert xx.lookup('fork1', 'a')[0] == 'b'
@@ -535,7 +1026,7 @@ def test_temporal_forks():
     assert tuple(xx.iterate_block_items('fork1', end_block = 1)) == (('a', 'b'), ('e', 'h'))
     print ('PASSED_FORKS_BASIC')
 
-    xx = TemporalForks(master_fork_name = 'fork1', fork_names = ['fork1', 'fork2'], max_non_master_age = 5)
+    xx = TemporalForks(master_fork_name = 'fork1', fork_names = ['fork1', 'fork2'], max_non_master_age = 5, **temporal_args)
     xx.update_latest_master_block_num(1)
     xx.store('fork1', 'z', 'e', start_block = 1)
     xx.update_latest_master_block_num(2)
@@ -547,9 +1038,13 @@ def test_temporal_forks():
     print ('PASSED_FORKS')
 
 
-def test_temporal_db():
-    print ('START test_temporal_db()')
-    xx = TemporalDB(table_names = ['table1', 'table2'], master_fork_name = 'fork1', fork_names = ['fork1', 'fork2'])
+def test_temporal_forks_in_process():
+    test_temporal_forks(process_safe = False)
+
+
+def test_temporal_db(**temporal_args):
+    print ('START test_temporal_db()', temporal_args)
+    xx = TemporalDB(table_names = ['table1', 'table2'], master_fork_name = 'fork1', fork_names = ['fork1', 'fork2'], **temporal_args)
     xx.all_update_latest_master_block_num(1)
     xx.store('table1', 'fork1', 'a', 'b', start_block = 1)
     assert xx.lookup('table1', 'fork1', 'a')[0] == 'b'
@@ -586,6 +1081,13 @@ def test_temporal_db():
     xx.remove('table2', 'fork1', 'z', '1', start_block = 60, as_set_op = True,)
     assert tuple([a for a,b in xx.lookup('table2', 'fork1', 'z', end_block = 60)[0].items() if b]) == tuple()
     
+    ## Tombstones only dropped once final, newer versions keep the removal:
+    assert xx.tables['table2'].forks['fork1'].compact_set_tombstones(final_block = 57) == 0
+    xx.all_compact_set_tombstones(T_ANY_FORK, final_block = 58, max_keys = 5)
+    assert tuple(sorted(xx.lookup('table2', 'fork1', 'z', end_block = 58)[0].items())) == (('1', True), ('2', True))
+    assert xx.lookup('table2', 'fork1', 'z', end_block = 57)[0]['3'] is True
+    assert xx.lookup('table2', 'fork1', 'z', end_block = 59)[0]['2'] is False
+    
     xx.all_wipe_newer(T_ANY_FORK, start_block = 58)
     assert tuple(sorted([a for a,b in xx.lookup('table2', 'fork1', 'z', end_block = 59)[0].items() if b])) == ('1','2','3')
     
@@ -593,9 +1095,89 @@ def test_temporal_db():
     
     print ('PASSED_DB_BASIC')
 
+
+def test_temporal_db_in_process():
+    test_temporal_db(process_safe = False)
+
+
+def test_sqlite_temporal_table():
+    print ('START test_sqlite_temporal_table()')
+    import tempfile, shutil
+    from os.path import join
+    
+    dd = tempfile.mkdtemp()
+    try:
+        xx = SQLiteTemporalTable(join(dd, 'temporal.db'), batch_size = 2)
+        xx.store('a', 'b', start_block = 1)
+        xx.store('a', 'c', start_block = 3)
+        xx.store('a', 'd', start_block = 2)
+        assert xx.lookup('a') == ('c', 3)
+        assert xx.lookup('a', end_block = 2) == ('d', 2)
+        assert xx.lookup('a', start_block = 4, default = None) == (None, False)
+        xx.store('e','h',1)
+        xx.store('e','f',2)
+        xx.store('e','g',3)
+        assert tuple(xx.iterate_block_items()) == (('a', 'c'), ('e', 'g'))
+        assert tuple(xx.iterate_block_items(end_block = 1)) == (('a', 'b'), ('e', 'h'))
+        
+        ## Sets:
+        for bn, member in [(55, '1'), (56, '2'), (57, '3')]:
+            xx.store('z', member, bn, as_set_op = True)
+        xx.remove('z', '3', 58, as_set_op = True)
+        xx.remove('z', '2', 59, as_set_op = True)
+        assert xx.lookup('z', end_block = 56) == ({'1':True, '2':True}, 56)
+        assert xx.lookup('z', end_block = 58) == ({'1':True, '2':True, '3':False}, 58)
+        assert xx.lookup('z') == ({'1':True, '2':False, '3':False}, 59)
+        
+        assert xx.compact_set_tombstones(final_block = 57) == 0
+        assert xx.compact_set_tombstones(final_block = 58) == 1
+        assert xx.lookup('z', end_block = 58)[0] == {'1':True, '2':True}
+        assert xx.lookup('z')[0] == {'1':True, '2':False}
+        ## Older versions unchanged:
+        assert xx.lookup('z', end_block = 57)[0] == {'1':True, '2':True, '3':True}
+        assert xx.compact_set_tombstones(final_block = 58) == 0
+        
+        ## Reorg, then prune keeping the base state of newer versions:
+        xx.wipe_newer(59)
+        assert xx.lookup('z') == ({'1':True, '2':True}, 58)
+        xx.store('z', '4', 60, as_set_op = True)
+        xx.prune_historical(58)
+        assert xx.lookup('z') == ({'1':True, '2':True, '4':True}, 60)
+        assert xx.lookup('a', default = None) == (None, False)
+        try:
+            xx.lookup('z', start_block = 58)
+            assert False, 'SHOULD_FAIL'
+        except AssertionError as e:
+            assert 'PREVIOUSLY_PRUNED_REQUESTED_BLOCK' in str(e), e
+        xx.close()
+        
+        ## History persists across reopening:
+        xx = SQLiteTemporalTable(join(dd, 'temporal.db'), wipe = False)
+        assert xx.lookup('z') == ({'1':True, '2':True, '4':True}, 60)
+        assert xx.largest_pruned == 58
+        xx.close()
+        
+        ## As the tables of a TemporalForks:
+        xx = TemporalForks(master_fork_name = 'fork1',
+                           fork_names = ['fork1', 'fork2'],
+                           process_safe = False,
+                           make_table = lambda fork_name: SQLiteTemporalTable(join(dd, fork_name + '.db')),
+                           )
+        xx.store('fork1', 'z', 'e', start_block = 1)
+        xx.store('fork2', 'z', 'g', start_block = 2)
+        assert xx.lookup(T_ANY_FORK, 'z') == ('g', 2)
+        assert tuple(xx.iterate_block_items(T_ANY_FORK)) == (('z', 'g'),)
+    finally:
+        shutil.rmtree(dd)
+    print ('PASSED')
+
     
     
 if __name__ == '__main__':
     test_temporal_table()
+    test_temporal_table_in_process()
     test_temporal_forks()
+    test_temporal_forks_in_process()
     test_temporal_db()
+    test_temporal_db_in_process()
+    test_sqlite_temporal_table()
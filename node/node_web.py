@@ -658,20 +658,18 @@ class handle_login_2(BaseHandler):
         if hh['requested_username'] and (hh['requested_username'] in self.cccoin.DBL['TAKEN_USERNAMES_DB']):
             username_success = False
         
-        if hh['requested_username'] and self.cccoin.sdb.lookup('username_to_user_id',
-                                                               hh['requested_username'],
-                                                               default = False,
-                                                               at_hash = 'latest'
-                                                               ):
+        if hh['requested_username'] and self.cccoin.sdb.head_view.lookup('username_to_user_id',
+                                                                         hh['requested_username'],
+                                                                         default = False,
+                                                                         ):
             username_success = False
         
         ## Check if user already registered a username before:
         
-        uu = self.cccoin.tdb.lookup('user_id_to_username',
-                                    the_address,
-                                    default = False,
-                                    at_hash = 'latest'
-                                    )
+        uu = self.cccoin.sdb.head_view.lookup('user_id_to_username',
+                                              the_address,
+                                              default = False,
+                                              )
         
         if uu:
             got_username = hh['requested_username']
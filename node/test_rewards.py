@@ -39,4 +39,66 @@ def test_rewards(cccoin_core):
 
     # TODO: doesn't seem like I'm testing the right thing here..
     #assert(u1_rewards is not None)
-    #assert(u3_rewards is not None)
\ No newline at end of file
+    #assert(u3_rewards is not None)
+
+
+def test_rewards_unvoted():
+    """
+    Voters that un-vote a post no longer count towards the number of voters sharing its curation rewards.
+    
+    Runs process_end_block() directly on mock blocks, so it doesn't need a blockchain.
+    """
+    from node_core import CCCoinCore
+    from node_state import StateManager, MockBlockchain, make_test_blocks
+    from node_records import PostRecord, address_bin, vote_key
+    
+    class MockCoreBlockchain(MockBlockchain):
+        def setup_event_callbacks(self, log_handlers, pending_handlers, end_block_handler):
+            ## Mock blocks have no CCCoin logs:
+            self.log_handlers = {'DEFAULT':lambda *args, **kw: None}
+    
+    bcc = MockCoreBlockchain(make_test_blocks())
+    sdb = StateManager(bcc)
+    cccoin_core = CCCoinCore(sdb = sdb, bcc = bcc, settings_rewards = cccoin_rewards_settings)
+    sdb.loop_once()
+    
+    poster = '0x' + '33' * 20
+    u1 = '0x' + '11' * 20
+    u2 = '0x' + '22' * 20
+    
+    ## p3 is sponsored, and upvoted by u1 and u2, then u2 un-votes. p4 is upvoted by u1:
+    for post_id, extra in [('p3', {'sponsor':'s1'}), ('p4', {})]:
+        post = dict({'post_id':post_id,
+                     'image_title':post_id,
+                     'status':{'confirmed':True,
+                               'created_time':100,
+                               'created_block_num':5,
+                               'created_block_hash':'h6',
+                               'creator_address':poster,
+                               'creator_pub':'04' + 'ab' * 64,
+                               },
+                     }, **extra)
+        sdb.store('posts', post_id, PostRecord.from_json(post), cur_hash = 'h6')
+    
+    for nonce, (voter, item_id, direction) in enumerate([(u1, 'p3', 1), (u2, 'p3', 1), (u2, 'p3', 0), (u1, 'p4', 1)]):
+        sdb.store('unblinded_votes', vote_key(voter, item_id), direction, cur_hash = 'h6')
+        sdb.store('post_voters_1', item_id, address_bin(voter), nonce = nonce, as_set_op = True,
+                  set_remove = (direction != 1), cur_hash = 'h6')
+    
+    assert cccoin_core.sdb.set_cardinality('post_voters_1', 'p3') == 1
+    
+    earned = lambda user_id: sdb.lookup('earned_rewards_per_user', user_id, default = 0, allow_pending = True)
+    
+    ## Blocks with no logs compute no rewards:
+    cccoin_core.process_end_block('h6', 5)
+    assert earned('s1') == 0
+    
+    cccoin_core.logged_block_hash = 'h6'
+    cccoin_core.process_end_block('h6', 5)
+    
+    ## p3 has lock 0.5 + 1.0 of u1 & u2, shared by u1 and the poster. p4 has u1's other 0.5, shared by u1 and the
+    ## poster. The sponsor of p3 earns as much as p3's curators, (1.5 / 2.0) / 2 = 0.375, out of a total of
+    ## 0.375 + 0.375 + 0.125. When u2 still counted, it earned (1.5 / 2.0) / 3 = 0.25 out of 0.625:
+    rewards = [earned(x) for x in ['s1', u1, u2, poster]]
+    assert abs(rewards[0] - (3 / 7.0)) < 1e-9, rewards
+    assert abs(sum(rewards) - cccoin_rewards_settings['REWARDS_CURATION']) < 1e-9, rewards